@@ -0,0 +1,49 @@
+"""
+通过 LocalProxy 访问属性的开销，对比直接引用对象
+
+python benchmarks/local.py
+"""
+import os
+import sys
+import timeit
+from contextvars import ContextVar
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from binwen.local import LocalProxy, global_proxy  # noqa: E402
+
+
+class App:
+    def __init__(self):
+        self.config = {'DEBUG': False}
+
+
+class Request:
+    def __init__(self, request):
+        self.request = request
+
+
+_app = App()
+_request_ctx = ContextVar('request_ctx')
+_request_ctx.set(Request(_app))
+
+
+def bench(stmt, namespace, number):
+    return min(timeit.repeat(stmt, globals=namespace, number=number, repeat=5)) / number * 1e9
+
+
+def main(number=500000):
+    namespace = {
+        'app': _app,
+        'lambda_proxy': LocalProxy(lambda: _app),
+        'global_proxy': global_proxy(globals(), '_app'),
+        'context_proxy': LocalProxy(_request_ctx, name='request'),
+    }
+    print(f'{"access":<36}{"ns/op":>10}')
+    for stmt in ('app.config', 'lambda_proxy.config', 'global_proxy.config', 'context_proxy.config',
+                 "global_proxy.config['DEBUG']"):
+        print(f'{stmt:<36}{bench(stmt, namespace, number):>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
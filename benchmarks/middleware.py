@@ -0,0 +1,59 @@
+"""
+中间件链每次调用的开销，对比逐层嵌套的中间件实例和 compile_handler 编译后的调用
+
+python benchmarks/middleware.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from binwen.middleware import MiddlewareMixin  # noqa: E402
+from binwen.servicer import compile_handler  # noqa: E402
+
+
+class NoopMiddleware(MiddlewareMixin):
+    pass
+
+
+class BeforeMiddleware(MiddlewareMixin):
+    def before_handler(self, servicer, request, context):
+        return request, context
+
+
+class AroundMiddleware(MiddlewareMixin):
+    def __call__(self, servicer, request, context):
+        return self.handler(servicer, request, context)
+
+
+def handler(servicer, request, context):
+    return request
+
+
+def nested(middlewares):
+    h = handler
+    for m in middlewares:
+        h = m(None, h, handler)
+    return h
+
+
+def bench(h, number):
+    return min(timeit.repeat(lambda: h(None, 1, None), number=number, repeat=5)) / number * 1e9
+
+
+def main(number=200000):
+    base = bench(handler, number)
+    print(f'{"middlewares":<28}{"nested ns/call":>16}{"compiled ns/call":>18}')
+    for name, m in (('noop', NoopMiddleware), ('before_handler', BeforeMiddleware), ('__call__', AroundMiddleware)):
+        for n in (0, 3, 10):
+            middlewares = [m] * n
+            print(
+                f'{f"{n} x {name}":<28}'
+                f'{bench(nested(middlewares), number) - base:>16.0f}'
+                f'{bench(compile_handler(None, handler, middlewares), number) - base:>18.0f}'
+            )
+
+
+if __name__ == '__main__':
+    main()
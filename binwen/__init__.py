@@ -1 +1 @@
-from binwen.globals import current_app, create_app
+from binwen.globals import current_app, current_request, current_context, current_metadata, current_config, create_app
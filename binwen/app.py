@@ -1,10 +1,16 @@
+import sys
 import inspect
 import logging
 import os.path
+import threading
+import importlib
+from contextlib import contextmanager
 
-from binwen import exceptions
-from binwen.config import Config, ConfigAttribute, DEFAULT_CONFIG
+from binwen import exceptions, signals
+from binwen.config import Config, ConfigAttribute, FrozenConfig, DEFAULT_CONFIG
 from binwen.datastructures import ConstantsObject
+from binwen.extension import ExtensionLoader
+from binwen.local import LocalProxy
 from binwen.utils.functional import import_obj
 from binwen.utils.cache import cached_property
 from binwen.utils.log import has_level_handler
@@ -12,9 +18,13 @@ from binwen.utils.log import has_level_handler
 
 class BaseApp:
     config_class = Config
+    frozen_config_class = FrozenConfig
     debug = ConfigAttribute('DEBUG')
     testing = ConfigAttribute('TESTING')
     tz = ConfigAttribute('TIMEZONE')
+    # 只在启动时生效的配置项, 热加载时不允许修改
+    static_config_keys = ('INSTALLED_APPS', 'MIDDLEWARE', 'MIDDLEWARE_SCOPES', 'GRPC_PROCESSES', 'GRPC_WORKERS',
+                          'ACCESS_LOG_PROPAGATE', 'ACCESS_LOG_FORMAT')
 
     def __init__(self, root_path, env):
         if not os.path.isabs(root_path):
@@ -26,12 +36,106 @@ class BaseApp:
         self.config = self.make_config()
         self._servicers = {}
         self._extensions = {}
+        # 每次 load_extensions_in_module 一个 ExtensionLoader, 按加载的顺序
+        self._extension_loaders = []
+        self._extension_objects = {}
+        # 已初始化的扩展 -> init_app 耗时(秒), 按初始化完成的顺序, 见 binwen.extension.ExtensionLoader
+        self.extension_init_times = {}
         self._middlewares = []
+        self.config_lock = threading.RLock()
 
     def make_config(self) -> Config:
         config = self.config_class(DEFAULT_CONFIG)
         return config
 
+    def config_modules(self):
+        """
+        已导入的项目配置模块, 当前环境的模块排在最后
+        """
+        name = f'config.{self.env}'
+        modules = [m for n, m in sys.modules.items() if n.startswith('config.') and n != name]
+        return modules + [sys.modules[name]] if name in sys.modules else modules
+
+    def load_config(self, reload=False) -> Config:
+        """
+        按 DEFAULT_CONFIG < config/<env>.py < BINWEN_* 环境变量 < CONFIG_JSON 指定的 JSON 文件 的顺序加载配置,
+        reload 为 True 时重新执行已导入的配置模块
+        """
+        module = importlib.import_module(f'config.{self.env}')
+        if reload:
+            for m in self.config_modules():
+                importlib.reload(m)
+
+        config = self.make_config()
+        config.from_object(module)
+        # CONFIG_JSON 也可以由环境变量指定; 环境变量在进程启动后不再变化, JSON 文件在最后加载, 热加载时修改的值才能生效
+        config.from_env()
+        if config.get('CONFIG_JSON'):
+            config.from_json(config['CONFIG_JSON'])
+        return config
+
+    def validate_config(self, config):
+        """
+        热加载的配置不能修改 static_config_keys 中的配置项, 已有配置项的类型不能改变
+        """
+        current = self.config
+        for key in self.static_config_keys:
+            if config.get(key) != current.get(key):
+                raise exceptions.ConfigException(f'{key} can not be changed without restart')
+        for key, value in config.items():
+            old = current.get(key)
+            if old is not None and value is not None and type(old) is not type(value):
+                raise exceptions.ConfigException(
+                    f'{key} type changed from {type(old).__name__} to {type(value).__name__}'
+                )
+
+    def reload_config(self):
+        """
+        重新加载配置, 校验通过后整体替换 app.config 并发送 config_changed 信号，
+        进行中的调用通过 current_config 读取时仍然是调用开始时的配置快照;
+        配置文件和环境变量中没有的配置项(如 ready()、扩展的 init_app 或 update_config 中添加的)沿用当前的值
+
+        @signals.config_changed.connect
+        def on_config_changed(app, old, new):
+            limiter.limit = new['CONCURRENCY_LIMIT_INITIAL_LIMIT']
+        """
+        config = self.load_config(reload=True)
+        with self.config_lock:
+            for key, value in self.config.items():
+                config.setdefault(key, value)
+            self.validate_config(config)
+            old = self.config
+            if isinstance(old, FrozenConfig):
+                config = self.frozen_config_class(config)
+            self.config = config
+        signals.config_changed.send(self, old=old, new=config)
+        return config
+
+    def freeze_config(self):
+        """
+        把配置冻结为只读快照, create_app 在 ready() 之后调用
+        """
+        if not isinstance(self.config, FrozenConfig):
+            self.config = self.frozen_config_class(self.config)
+        return self.config
+
+    @contextmanager
+    def update_config(self):
+        """
+        在副本上修改配置，退出时整体替换 app.config, 正在读取旧快照的代码不受影响
+
+        with app.update_config() as config:
+            config.from_mapping({'GRPC_GRACE': 10})
+        """
+        with self.config_lock:
+            old = self.config
+            config = self.config_class(old)
+            yield config
+            if isinstance(old, FrozenConfig):
+                config = self.frozen_config_class(config)
+            self.config = config
+        signals.config_changed.send(self, old=old, new=config)
+
     @cached_property
     def logger(self):
         logger = logging.getLogger('binwen.app')
@@ -80,12 +184,6 @@ class BaseApp:
                 m = inspect.getmodule(b)
                 return getattr(m, f'add_{b.__name__}_to_server')
 
-    def _register_extension(self, name, ext):
-        ext.init_app(self)
-        if name in self._extensions:
-            raise exceptions.ConfigException(f'extension duplicated: {name}')
-        self._extensions[name] = ext
-
     def load_middleware(self):
         middleware = ['binwen.middleware.GuardMiddleware'] + self.config["MIDDLEWARE"]
         for mn in middleware:
@@ -95,13 +193,58 @@ class BaseApp:
 
     def load_extensions_in_module(self, module):
         def is_ext(ins):
-            return not inspect.isclass(ins) and hasattr(ins, 'init_app')
+            # 模块中导入的 current_request 等代理在启动时没有绑定对象, 不是扩展
+            return not inspect.isclass(ins) and not isinstance(ins, LocalProxy) and hasattr(ins, 'init_app')
 
-        for n, ext in inspect.getmembers(module, is_ext):
-            self._register_extension(n, ext)
+        extensions = inspect.getmembers(module, is_ext)
+        for name, _ in extensions:
+            if name in self._extensions:
+                raise exceptions.ConfigException(f'extension duplicated: {name}')
 
+        loader = ExtensionLoader(self, extensions, self.config.get('EXTENSION_INIT_WORKERS'))
+        self._extension_loaders.append(loader)
+        self._extension_objects.update(extensions)
+        self._extensions.update(loader.load())
         return self.extensions
 
+    def extension_report(self):
+        return ', '.join(filter(None, (loader.report() for loader in self._extension_loaders)))
+
+    def call_extension_hook(self, hook):
+        """
+        调用扩展的生命周期钩子, 扩展没有定义对应的方法时跳过:
+
+        before_fork(app): fork worker 之前在父进程中调用, 如关闭 init_app 中创建的连接
+        after_fork_child(app): fork worker 之后在子进程中调用, 如重新创建连接池
+        warmup(app): grpc server 启动之前调用, 如预先创建连接, 见 binwen.server.Server.warmup
+        on_server_start(app): grpc server 启动之后调用, 多进程模式下每个 worker 各调用一次
+        on_server_stop(app): grpc server 停止之后调用
+
+        按扩展的依赖顺序调用(before_fork 和 on_server_stop 按相反的顺序), 还没有初始化的 lazy 扩展跳过;
+        fork 钩子只由 binwen.prefork.Master 在 fork worker 时调用, handler 中使用 multiprocessing/subprocess
+        fork 的子进程不会触发, 需要在子进程中使用扩展时自行调用这两个钩子
+
+        class RedisExt:
+            def init_app(self, app):
+                self.pool = None
+
+            def after_fork_child(self, app):
+                self.pool = None  # 子进程中第一次使用时再创建
+
+            def on_server_stop(self, app):
+                if self.pool is not None:
+                    self.pool.disconnect()
+        """
+        order = [name for loader in self._extension_loaders for name in loader.order]
+        names = [name for name in order if name in self.extension_init_times]
+        names += [name for name in self.extension_init_times if name not in order]
+        if hook in ('before_fork', 'on_server_stop'):
+            names.reverse()
+        for name in names:
+            method = getattr(self._extension_objects[name], hook, None)
+            if method is not None:
+                method(self)
+
     def load_servicers_in_app(self):
         for app in self.config["INSTALLED_APPS"]:
             app_module = import_obj(f"{app}.servicers")
@@ -7,15 +7,24 @@ from binwen.server import Server
 
 @cli.command('run', help='Run Server')
 @cli.option('addrport', nargs='?', help='Optional port number, or ipaddr:port')
-@cli.option("-w", "--workers", default=3, type=int, help='Number of maximum worker threads')
-def run_server(addrport, workers, **extra):
+@cli.option("-w", "--workers", type=int, help='Number of maximum worker threads (default: GRPC_WORKERS)')
+@cli.option("-p", "--processes", type=int, help='Number of pre-forked worker processes (default: GRPC_PROCESSES)')
+@cli.option("--async", dest='aio', action='store_true', help='Run an asyncio server (grpc.aio)')
+@cli.option("--gc-freeze", action='store_true', default=None, help='Call gc.freeze() after warmup (default: GC_FREEZE)')
+def run_server(addrport, workers, processes, aio, gc_freeze, **extra):
     if addrport:
         if ":" not in addrport:
             addrport = f"[::]:{addrport}"
     else:
         addrport = "[::]:50051"
 
-    s = Server(app=current_app, addrport=addrport, workers=workers)
+    if workers is None:
+        workers = current_app.config['GRPC_WORKERS']
+    if processes is None:
+        processes = current_app.config['GRPC_PROCESSES']
+
+    s = Server(app=current_app, addrport=addrport, workers=workers, processes=processes, aio=aio,
+               gc_freeze=gc_freeze)
     s.run()
     return 0
 
@@ -1,9 +1,11 @@
+import os
 import logging
 from importlib import import_module
 from typing import Any, Callable, Dict, Mapping, Optional, Union
 
+from binwen.exceptions import ConfigException
 from binwen.utils.encoding import json_decode
-from binwen.datastructures import ConstantsObject, ImmutableDict
+from binwen.datastructures import ConstantsObject, ImmutableDict, is_immutable
 
 DEFAULT_CONFIG = ImmutableDict({
     'DEBUG': False,
@@ -13,10 +15,31 @@ DEFAULT_CONFIG = ImmutableDict({
     'GRPC_LOG_HANDLER': logging.StreamHandler(),
     'GRPC_LOG_FORMAT': '[%(asctime)s %(levelname)s in %(module)s] %(message)s',
     'GRPC_GRACE': 5,
+    'GRPC_WORKERS': 3,
+    'GRPC_PROCESSES': 1,
+    'ACCESS_LOG_FORMAT': '[%(asctime)s] %(message)s',
+    'ACCESS_LOG_LEVEL': 'INFO',
+    'ACCESS_LOG_PROPAGATE': True,
+    'ERROR_REPORT_INTERVAL': 60,
+    'EXTENSION_INIT_WORKERS': 1,
+    'WARMUP_REQUESTS': None,
+    'CONFIG_JSON': None,
+    'ENV_TYPES': {},
+    'CONFIG_RELOAD': False,
+    'CONFIG_RELOAD_INTERVAL': 2,
+    'GRPC_MAX_REQUESTS': 0,
+    'GRPC_MAX_REQUESTS_JITTER': 0,
+    'GRPC_MAX_RSS': 0,
+    'GC_FREEZE': False,
+    'GC_THRESHOLD': None,
+    'GC_STATS': False,
+    'GRPC_BULKHEADS': {},
+    'GRPC_PRIORITY_ENABLED': False,
     'MIDDLEWARES': [
         'binwen.middleware.ServiceLogMiddleware',
         'binwen.middleware.RpcErrorMiddleware',
     ],
+    'MIDDLEWARE_SCOPES': {},
     'INSTALLED_APPS': [],
     'PASSWORD_HASHERS': [
         "binwen.contrib.password.PBKDF2PasswordHasher",
@@ -27,6 +50,52 @@ DEFAULT_CONFIG = ImmutableDict({
 })
 
 
+_TRUE_VALUES = {'1', 'true', 'yes', 'on'}
+_FALSE_VALUES = {'0', 'false', 'no', 'off', ''}
+# 可以由环境变量设置的配置项类型, 其它类型(如 GRPC_LOG_HANDLER)的配置项只能在配置模块中设置
+ENV_VALUE_TYPES = (bool, int, float, str, list, tuple, dict)
+# 框架自身使用的环境变量, 不作为配置项: 运行环境, prefork 模式下新主进程通知旧主进程的管道(见 binwen.prefork.Master)
+RESERVED_ENV = frozenset({'BINWEN_ENV', 'BINWEN_MASTER_FD'})
+
+
+def parse_env_value(raw: str, current: Any = None, type_: Optional[type] = None) -> Any:
+    """
+    按声明的类型 type_ 或配置项当前值的类型转换环境变量的值:
+
+    bool: 1/true/yes/on, 0/false/no/off
+    int, float: 数字
+    list, tuple: JSON 数组或逗号分隔的字符串
+    dict: JSON 对象
+    str: 原样使用
+    没有默认值(None)也没有声明类型: 按 str 原样使用, 不猜测类型
+    """
+    if type_ is None:
+        type_ = str if current is None else type(current)
+    if not issubclass(type_, ENV_VALUE_TYPES):
+        raise ValueError(f'unsupported type: {type_.__name__}')
+    if issubclass(type_, bool):
+        value = raw.strip().lower()
+        if value in _TRUE_VALUES:
+            return True
+        if value in _FALSE_VALUES:
+            return False
+        raise ValueError(f'invalid boolean: {raw!r}')
+    if issubclass(type_, (int, float)):
+        return type_(raw.strip())
+    if issubclass(type_, (list, tuple)):
+        if raw.lstrip().startswith('['):
+            value = json_decode(raw)
+        else:
+            value = [v.strip() for v in raw.split(',') if v.strip()]
+        return type_(value)
+    if issubclass(type_, dict):
+        value = json_decode(raw)
+        if not isinstance(value, dict):
+            raise ValueError(f'expected a JSON object: {raw!r}')
+        return value
+    return raw
+
+
 class ConfigAttribute:
     """
     class Object:
@@ -45,11 +114,12 @@ class ConfigAttribute:
     def __get__(self, instance: object, owner: type = None) -> Any:
         if instance is None:
             return self
-        result = instance.config[self.key]
-        if self.converter is not None:
-            return self.converter(result)
-        else:
-            return result
+        config = instance.config
+        if self.converter is None:
+            return config[self.key]
+        if isinstance(config, FrozenConfig):
+            return config.convert(self.key, self.converter)
+        return self.converter(config[self.key])
 
     def __set__(self, instance: object, value: Any) -> None:
         instance.config[self.key] = value
@@ -110,6 +180,38 @@ class Config(dict):
             if key.isupper():
                 self[key] = value
 
+    def from_env(self, prefix: str = 'BINWEN_', environ: Optional[Mapping[str, str]] = None) -> None:
+        """
+        读取以 prefix 开头的环境变量, 去掉前缀后的大写名称作为配置项, 值的类型转换见 parse_env_value;
+        RESERVED_ENV 中的环境变量除外. 没有默认值的配置项按字符串处理, 需要其它类型时在 ENV_TYPES 中声明;
+        值不是 ENV_VALUE_TYPES 的配置项(如 GRPC_LOG_HANDLER)不能由环境变量设置
+
+        BINWEN_GRPC_WORKERS=16 BINWEN_DEBUG=false BINWEN_INSTALLED_APPS=users,orders bw run
+
+        ENV_TYPES = {'REDIS_PORT': int}  # BINWEN_REDIS_PORT=6380 -> 6380
+
+        create_app 中配置的优先级(后者覆盖前者):
+        DEFAULT_CONFIG < config/<BINWEN_ENV>.py < 环境变量 < CONFIG_JSON 指定的 JSON 文件, 见 BaseApp.load_config
+        """
+        environ = os.environ if environ is None else environ
+        types = self.get('ENV_TYPES') or {}
+        for name, raw in environ.items():
+            if not name.startswith(prefix) or name in RESERVED_ENV:
+                continue
+            key = name[len(prefix):]
+            if not key or not key.isupper():
+                continue
+            current = self.get(key)
+            if current is not None and not isinstance(current, ENV_VALUE_TYPES):
+                raise ConfigException(
+                    f'{key} can not be set from environment variable {name}: '
+                    f'{type(current).__name__} value'
+                )
+            try:
+                self[key] = parse_env_value(raw, current, types.get(key))
+            except ValueError as e:
+                raise ConfigException(f'invalid value for environment variable {name}: {e}') from e
+
     def get_namespace(self, namespace: str, lowercase: bool = True, trim_namespace: bool = True) -> Dict[str, Any]:
         """
         config = {'FOO_A': 'a', 'FOO_BAR': 'bar', 'BAR': False}
@@ -151,3 +253,86 @@ class Config(dict):
     def __repr__(self) -> str:
         return '<%s %s>' % (self.__class__.__name__, dict.__repr__(self))
 
+
+class FrozenConfig(Config):
+    """
+    app.ready() 之后的只读配置快照, 由 create_app 创建
+
+    - 配置项同时放在实例的 __dict__ 中, `config.debug`/`config.DEBUG` 直接命中 __dict__
+    - 大写 key 的 `config['DEBUG']` 直接走 dict 的查找, 只有非大写的 key 才转换大小写
+    - get_namespace 和 ConfigAttribute 的 converter 结果按快照缓存
+
+    修改配置需要通过 `app.update_config()` 生成新的快照并整体替换:
+
+    with app.update_config() as config:
+        config['GRPC_GRACE'] = 10
+    """
+    __getitem__ = dict.__getitem__
+
+    def __init__(self, config: Mapping[str, Any]) -> None:
+        super().__init__(config)
+        attrs = object.__getattribute__(self, '__dict__')
+        for key, value in self.items():
+            attrs[key] = value
+            # 不能遮盖 dict 的方法, 这类配置项仍然通过 __getattr__ 获取
+            if not hasattr(FrozenConfig, key.lower()):
+                attrs[key.lower()] = value
+        attrs['_namespaces'] = {}
+        attrs['_converted'] = {}
+
+    def __missing__(self, key: str) -> Any:
+        upper = key.upper()
+        if upper == key:
+            raise KeyError(key)
+        return dict.__getitem__(self, upper)
+
+    def __contains__(self, key: str) -> bool:
+        return dict.__contains__(self, key) or dict.__contains__(self, key.upper())
+
+    def get_namespace(self, namespace: str, lowercase: bool = True, trim_namespace: bool = True) -> Dict[str, Any]:
+        key = (namespace, lowercase, trim_namespace)
+        try:
+            return self._namespaces[key]
+        except KeyError:
+            rv = self._namespaces[key] = super().get_namespace(namespace, lowercase, trim_namespace)
+            return rv
+
+    def convert(self, key: str, converter: Callable) -> Any:
+        try:
+            return self._converted[(key, converter)]
+        except KeyError:
+            rv = self._converted[(key, converter)] = converter(self[key])
+            return rv
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        is_immutable(self)
+
+    def __setattr__(self, key: str, value: Any) -> None:
+        is_immutable(self)
+
+    def __delitem__(self, key: str) -> None:
+        is_immutable(self)
+
+    def __delattr__(self, key: str) -> None:
+        is_immutable(self)
+
+    def setdefault(self, key, default=None):
+        is_immutable(self)
+
+    def update(self, *args, **kwargs):
+        is_immutable(self)
+
+    def pop(self, key, default=None):
+        is_immutable(self)
+
+    def popitem(self):
+        is_immutable(self)
+
+    def clear(self):
+        is_immutable(self)
+
+    def __copy__(self) -> 'FrozenConfig':
+        return self
+
+    def __reduce_ex__(self, protocol):
+        return type(self), (dict(self),)
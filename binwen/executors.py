@@ -0,0 +1,289 @@
+import time
+import heapq
+import itertools
+import threading
+from concurrent import futures
+from functools import wraps
+
+import grpc
+
+from binwen import current_app
+from binwen.pb2 import default_pb2
+from binwen.utils.functional import get_handler_name
+
+_local = threading.local()
+_bulkheads = {}
+_bulkheads_lock = threading.Lock()
+# 舱壁满时被拒绝的调用在这里快速返回 RESOURCE_EXHAUSTED，不占用 grpc 的线程池
+_rejector = futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix='binwen-rejector')
+
+
+class QueueStats:
+    """
+    统计调用在线程池队列中等待的时间(秒)
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, wait):
+        with self._lock:
+            self.count += 1
+            self.total += wait
+            if wait > self.max:
+                self.max = wait
+
+    @property
+    def average(self):
+        return self.total / self.count if self.count else 0.0
+
+
+queue_stats = QueueStats()
+
+
+def queue_wait():
+    """
+    当前线程正在执行的调用在线程池队列中等待的时间(秒)，不是由 binwen 的线程池执行时返回 None
+    """
+    return getattr(_local, 'queue_wait', None)
+
+
+def _run_timed(enqueued_at, fn, *args, **kwargs):
+    wait = time.monotonic() - enqueued_at
+    queue_stats.record(wait)
+    _local.queue_wait = wait
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _local.queue_wait = None
+
+
+def _run_rejected(fn, *args, **kwargs):
+    _local.rejected = True
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _local.rejected = False
+
+
+class TimedThreadPoolExecutor(futures.ThreadPoolExecutor):
+    """
+    记录每个任务在队列中等待的时间, 见 `queue_wait()`
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(_run_timed, time.monotonic(), fn, *args, **kwargs)
+
+
+class BulkheadExecutor(TimedThreadPoolExecutor):
+    """
+    舱壁(bulkhead)线程池: 正在执行和排队的任务数超过 max_workers + max_queue 时拒绝新的任务
+
+    通过 grpc 的 `experimental_thread_pool` 让某个 handler 运行在自己的线程池中，
+    慢的 handler 不会占满整个 server 的线程池:
+
+    executor = BulkheadExecutor('reports', max_workers=4, max_queue=16)
+    handler = executor.bind(handler)
+    """
+
+    def __init__(self, name, max_workers, max_queue=0):
+        super().__init__(max_workers=max_workers, thread_name_prefix=f'binwen-bulkhead-{name}')
+        self.name = name
+        self.max_queue = max_queue
+        self.max_pending = max_workers + max_queue
+        self.pending = 0
+        self.rejected = 0
+        self._pending_lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        with self._pending_lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                return _rejector.submit(_run_rejected, fn, *args, **kwargs)
+            self.pending += 1
+
+        return super().submit(self._run, fn, *args, **kwargs)
+
+    def _run(self, fn, *args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._pending_lock:
+                self.pending -= 1
+
+    def bind(self, handler):
+        @wraps(handler)
+        def bulkhead_handler(servicer, request, context):
+            if getattr(_local, 'rejected', False):
+                context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+                context.set_details(f'Bulkhead {self.name} is full')
+                return default_pb2.Empty()
+            return handler(servicer, request, context)
+
+        bulkhead_handler.experimental_thread_pool = self
+        return bulkhead_handler
+
+
+class PriorityThreadPoolExecutor(futures.Executor):
+    """
+    按优先级调度的线程池，server 的默认线程池 FIFO 执行调用，这里总是先执行优先级高的调用
+
+    优先级取自调用的 metadata(`metadata_key`)，没有时取 handler 的 @priority 声明，默认为 0。
+    为了防止低优先级的调用被饿死，每排队 `aging` 秒相当于提升一级优先级:
+    排序依据为 `提交时间 - priority * aging`
+
+    GRPC_PRIORITY_ENABLED = True
+    GRPC_PRIORITY_METADATA_KEY = 'x-priority'
+    GRPC_PRIORITY_AGING = 1.0
+    """
+
+    def __init__(self, max_workers, metadata_key='x-priority', aging=1.0, max_priority=10,
+                 thread_name_prefix='binwen-priority'):
+        self.max_workers = max_workers
+        self.metadata_key = metadata_key
+        self.aging = aging
+        self.max_priority = max_priority
+        self.thread_name_prefix = thread_name_prefix
+        self._queue = []
+        self._counter = itertools.count()
+        self._threads = set()
+        self._idle = 0
+        self._shutdown = False
+        self._cond = threading.Condition()
+
+    def get_priority(self, args):
+        """
+        grpc 提交到线程池的参数中包含 rpc event(有 invocation_metadata 属性) 和 handler
+        """
+        priority = 0
+        for arg in args[:4]:
+            priority = getattr(arg, '__bwpriority__', priority)
+            metadata = getattr(arg, 'invocation_metadata', None)
+            if not metadata or callable(metadata):
+                continue
+            for key, value in metadata:
+                if key == self.metadata_key:
+                    try:
+                        return max(-self.max_priority, min(int(value), self.max_priority))
+                    except (TypeError, ValueError):
+                        break
+        return priority
+
+    def submit(self, fn, *args, **kwargs):
+        future = futures.Future()
+        enqueued_at = time.monotonic()
+        sort_key = enqueued_at - self.get_priority(args) * self.aging
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+
+            heapq.heappush(self._queue, (sort_key, next(self._counter), enqueued_at, future, fn, args, kwargs))
+            if len(self._queue) > self._idle and len(self._threads) < self.max_workers:
+                t = threading.Thread(
+                    target=self._worker, name=f'{self.thread_name_prefix}_{len(self._threads)}', daemon=True
+                )
+                self._threads.add(t)
+                t.start()
+            else:
+                self._cond.notify()
+        return future
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._shutdown:
+                    self._idle += 1
+                    self._cond.wait()
+                    self._idle -= 1
+                if not self._queue:
+                    return
+                _, _, enqueued_at, future, fn, args, kwargs = heapq.heappop(self._queue)
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = _run_timed(enqueued_at, fn, *args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self._cond:
+            self._shutdown = True
+            if cancel_futures:
+                for item in self._queue:
+                    item[3].cancel()
+                self._queue = []
+            self._cond.notify_all()
+
+        if wait:
+            for t in list(self._threads):
+                t.join()
+
+
+def priority(value):
+    """
+    声明 servicer 方法的默认优先级, 调用的 metadata 中带有优先级时以 metadata 为准
+
+    class SearchServicer(search_pb2_grpc.SearchServicer, metaclass=ServicerMeta):
+
+        @priority(5)
+        def Query(self, request, context):
+            ...
+    """
+    def decorator(func):
+        func.__bwpriority__ = value
+        return func
+    return decorator
+
+
+def bulkhead(max_workers, max_queue=0):
+    """
+    为 servicer 的方法声明独立的线程池, asyncio 模式(grpc.aio)下不支持, 启动时抛出 ConfigException
+
+    class ReportServicer(report_pb2_grpc.ReportServicer, metaclass=ServicerMeta):
+
+        @bulkhead(max_workers=4, max_queue=16)
+        def Generate(self, request, context):
+            ...
+    """
+    def decorator(func):
+        func.__bwbulkhead__ = {'max_workers': max_workers, 'max_queue': max_queue}
+        return func
+    return decorator
+
+
+def get_bulkhead(handler):
+    """
+    按 handler 的 @bulkhead 声明或 GRPC_BULKHEADS 配置返回对应的 BulkheadExecutor，没有配置时返回 None
+
+    GRPC_BULKHEADS = {
+        'ReportServicer.Generate': {'max_workers': 4, 'max_queue': 16},  # 单个方法
+        'ExportServicer': {'max_workers': 2},  # 整个 servicer 的方法共用一个线程池
+    }
+    """
+    method = get_handler_name(handler)
+    servicer = method.split('.')[0]
+    config = current_app.config.get('GRPC_BULKHEADS') or {}
+
+    if hasattr(handler, '__bwbulkhead__'):
+        name, kwargs = method, handler.__bwbulkhead__
+    elif method in config:
+        name, kwargs = method, config[method]
+    elif servicer in config:
+        name, kwargs = servicer, config[servicer]
+    else:
+        return None
+
+    with _bulkheads_lock:
+        if name not in _bulkheads:
+            _bulkheads[name] = BulkheadExecutor(name, **kwargs)
+        return _bulkheads[name]
+
+
+def get_bulkheads():
+    return dict(_bulkheads)
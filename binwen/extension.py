@@ -0,0 +1,171 @@
+import time
+import threading
+from concurrent import futures
+
+from binwen import exceptions
+
+
+class ExtensionLoader:
+    """
+    按依赖关系初始化扩展: 默认在当前(主)线程中按依赖顺序依次调用 init_app, 没有依赖关系的按名字排序;
+    EXTENSION_INIT_WORKERS 大于 1 时, 扩展的依赖都初始化完成后在线程池中调用它的 init_app,
+    互不依赖的扩展(如数据库和缓存)的连接耗时不再累加, 这时 init_app 不能调用 signal.signal 等只能在主线程中调用的函数
+
+    扩展可以声明:
+    depends_on: 依赖的扩展名(extensions 模块中的变量名), 依赖先初始化
+    lazy_init: 为 True 时不在启动时初始化, 第一次访问扩展对象的属性时才调用 init_app
+               (包括 app.extensions 和 `from extensions import db` 直接导入的对象),
+               被非 lazy 的扩展依赖时仍然在启动时初始化
+
+    class Cache:
+        depends_on = ('db', )
+
+        def init_app(self, app):
+            ...
+
+    EXTENSION_INIT_WORKERS = 4  # 默认 1, 按依赖顺序依次初始化
+    """
+
+    def __init__(self, app, extensions, max_workers=1):
+        self.app = app
+        self.extensions = dict(extensions)
+        self.max_workers = max_workers or 1
+        self.dependencies = {name: tuple(getattr(ext, 'depends_on', ())) for name, ext in self.extensions.items()}
+        self._lock = threading.RLock()
+        # 正在初始化的扩展, init_app 中访问扩展自身的属性时不再触发初始化
+        self._initializing = set()
+        # lazy 扩展 -> 原来的类, 初始化完成后恢复
+        self._lazy_classes = {}
+        # 依赖在前的扩展顺序, 扩展的钩子按这个顺序调用
+        self.order = []
+        self.check()
+
+    def check(self):
+        for name, deps in self.dependencies.items():
+            for dep in deps:
+                # 可以依赖之前加载的扩展模块中已经初始化的扩展
+                if dep not in self.extensions and dep not in self.app.extension_init_times:
+                    raise exceptions.ConfigException(f'extension {name} depends on unknown extension: {dep}')
+            self.dependencies[name] = tuple(dep for dep in deps if dep in self.extensions)
+
+        visiting, visited = set(), set()
+
+        def visit(name, path):
+            if name in visited:
+                return
+            if name in visiting:
+                raise exceptions.ConfigException(f'extension dependency cycle: {" -> ".join(path + [name])}')
+            visiting.add(name)
+            for dep in self.dependencies[name]:
+                visit(dep, path + [name])
+            visiting.discard(name)
+            visited.add(name)
+            self.order.append(name)
+
+        for name in self.extensions:
+            visit(name, [])
+
+    def eager(self):
+        """
+        启动时需要初始化的扩展: 非 lazy 的扩展及其依赖
+        """
+        names = set()
+
+        def add(name):
+            if name not in names:
+                names.add(name)
+                for dep in self.dependencies[name]:
+                    add(dep)
+
+        for name, ext in self.extensions.items():
+            if not getattr(ext, 'lazy_init', False):
+                add(name)
+        return names
+
+    def init(self, name):
+        start = time.perf_counter()
+        self.extensions[name].init_app(self.app)
+        with self._lock:
+            self.app.extension_init_times[name] = time.perf_counter() - start
+
+    def resolve(self, name):
+        """
+        返回初始化过的扩展, lazy 的扩展在这里初始化
+        """
+        if name not in self.app.extension_init_times:
+            with self._lock:
+                if name not in self.app.extension_init_times and name not in self._initializing:
+                    self._initializing.add(name)
+                    try:
+                        for dep in self.dependencies[name]:
+                            self.resolve(dep)
+                        self.init(name)
+                    finally:
+                        self._initializing.discard(name)
+                    cls = self._lazy_classes.pop(name, None)
+                    if cls is not None:
+                        self.extensions[name].__class__ = cls
+        return self.extensions[name]
+
+    def defer(self, name):
+        """
+        把 lazy 扩展对象的类临时替换为子类, 第一次访问属性时初始化并恢复原来的类, 之后的访问没有额外开销
+        """
+        ext = self.extensions[name]
+        cls = type(ext)
+        resolve = self.resolve
+
+        def __getattribute__(obj, attr):
+            resolve(name)
+            return cls.__getattribute__(obj, attr)
+
+        lazy_cls = type(cls.__name__, (cls, ), {
+            '__slots__': (), '__module__': cls.__module__, '__qualname__': cls.__qualname__,
+            '__getattribute__': __getattribute__,
+        })
+        try:
+            ext.__class__ = lazy_cls
+        except TypeError:
+            raise exceptions.ConfigException(f'extension {name} can not be lazy: {cls.__name__} does not allow '
+                                             f'__class__ assignment, set lazy_init = False')
+        self._lazy_classes[name] = cls
+
+    def load(self):
+        """
+        初始化启动时需要的扩展，返回 {扩展名: 扩展}, lazy 的扩展在第一次访问属性时才初始化
+        """
+        eager = self.eager()
+        if self.max_workers == 1:
+            for name in self.order:
+                if name in eager:
+                    self.init(name)
+        elif eager:
+            pending = {name: set(self.dependencies[name]) for name in sorted(eager)}
+            running = {}
+            with futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='binwen-ext-init') as pool:
+                while pending or running:
+                    for name in [n for n, deps in pending.items() if not deps]:
+                        del pending[name]
+                        running[pool.submit(self.init, name)] = name
+
+                    done, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+                    for f in done:
+                        name = running.pop(f)
+                        f.result()
+                        for deps in pending.values():
+                            deps.discard(name)
+
+        for name in self.order:
+            if name not in self.app.extension_init_times:
+                self.defer(name)
+        return dict(self.extensions)
+
+    def report(self):
+        """
+        db 0.120s, cache 0.031s, search (lazy)
+        """
+        times = self.app.extension_init_times
+        return ', '.join(
+            f'{name} {times[name]:.3f}s' if name in times else f'{name} (lazy)'
+            for name in sorted(self.extensions, key=lambda n: (n not in times, -times.get(n, 0)))
+        )
@@ -0,0 +1,86 @@
+import gc
+import os
+import time
+import threading
+
+
+class GCStats:
+    """
+    通过 gc.callbacks 统计当前进程每一代的垃圾回收次数和停顿时间
+
+    gc_stats.install()
+    gc_stats.snapshot()
+    # {'collections': [12, 1, 0], 'pause_total': [0.0021, 0.0009, 0.0], 'pause_max': 0.0011, ...}
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started_at = None
+        self.installed = False
+        self.reset()
+
+    def reset(self):
+        self.collections = [0, 0, 0]
+        self.pause_total = [0.0, 0.0, 0.0]
+        self.pause_max = 0.0
+        self.last_pause = 0.0
+        self.collected = 0
+        self.uncollectable = 0
+
+    def install(self):
+        with self._lock:
+            if not self.installed:
+                gc.callbacks.append(self)
+                self.installed = True
+        return self
+
+    def uninstall(self):
+        with self._lock:
+            if self.installed:
+                gc.callbacks.remove(self)
+                self.installed = False
+
+    def __call__(self, phase, info):
+        # 垃圾回收时持有 GIL, 同一时间只有一次回收, 不需要加锁
+        if phase == 'start':
+            self._started_at = time.perf_counter()
+            return
+
+        if self._started_at is None:
+            return
+        pause = time.perf_counter() - self._started_at
+        self._started_at = None
+        generation = info['generation']
+        self.collections[generation] += 1
+        self.pause_total[generation] += pause
+        self.last_pause = pause
+        self.pause_max = max(self.pause_max, pause)
+        self.collected += info['collected']
+        self.uncollectable += info['uncollectable']
+
+    def snapshot(self):
+        return {
+            'collections': list(self.collections),
+            'pause_total': list(self.pause_total),
+            'pause_max': self.pause_max,
+            'last_pause': self.last_pause,
+            'collected': self.collected,
+            'uncollectable': self.uncollectable,
+            'frozen': gc.get_freeze_count(),
+        }
+
+
+gc_stats = GCStats()
+# fork 出来的 worker 只统计自己的回收
+os.register_at_fork(after_in_child=gc_stats.reset)
+
+
+def freeze_gc(collect=True):
+    """
+    把当前所有对象移到永久代, 之后的垃圾回收不再遍历它们(配置, servicer, protobuf 描述符等长期存在的对象).
+    fork 之前冻结时不要先回收: 回收释放的内存会被子进程重新分配, 反而触发 copy-on-write
+    """
+    if collect:
+        gc.collect()
+    gc.freeze()
+    return gc.get_freeze_count()
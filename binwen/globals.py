@@ -1,10 +1,57 @@
 import os
 import sys
+from contextvars import ContextVar
 
 from binwen.utils.functional import import_obj
-from binwen.local import LocalProxy
+from binwen.local import LocalProxy, global_proxy
 
 _app = None
+_request_ctx = ContextVar('binwen.request_ctx')
+
+
+class RequestContext:
+    """
+    当前调用的 request、context 以及解析后的 metadata，由 servicer 的 handler 包装在每次调用开始时设置，
+    多线程和 asyncio 模式下每个调用各自独立
+
+    from binwen.globals import current_request, current_context, current_metadata
+
+    def get_user_id():
+        return current_metadata.get('x-user-id')
+
+    指定 app 时固定调用开始时 app 的配置快照, 调用过程中通过 current_config 读取的始终是该快照, 不受配置热加载影响;
+    app.config 仍然是普通属性, 返回最新的配置
+    """
+    __slots__ = ('request', 'context', '_metadata', 'app', 'config')
+
+    def __init__(self, request, context, app=None):
+        self.request = request
+        self.context = context
+        self._metadata = None
+        self.app = app
+        self.config = app.config if app is not None else None
+
+    @property
+    def metadata(self):
+        """
+        第一次访问时才解析 context.invocation_metadata(), 同一个 key 有多个值时取第一个
+        """
+        if self._metadata is None:
+            metadata = self.context.invocation_metadata() or ()
+            if hasattr(metadata, 'items'):
+                metadata = metadata.items()
+            parsed = {}
+            for key, value in metadata:
+                parsed.setdefault(key, value)
+            self._metadata = parsed
+        return self._metadata
+
+    def push(self):
+        return _request_ctx.set(self)
+
+    @staticmethod
+    def pop(token):
+        _request_ctx.reset(token)
 
 
 def create_app(root_path=None):
@@ -17,19 +64,23 @@ def create_app(root_path=None):
 
     sys.path.append(root_path)
     env = os.environ.get('BINWEN_ENV', 'dev')
-    config = import_obj('config.{}'.format(env))
 
     app_class = import_obj('app:App')
     _app = app_class(root_path, env=env)
-    _app.config.from_object(config)
+    _app.config = _app.load_config()
 
     _app.load_middleware()
     _app.load_extensions_in_module(import_obj('extensions'))
     _app.load_servicers_in_app()
 
     _app.ready()
+    _app.freeze_config()
 
     return _app
 
 
-current_app = LocalProxy(lambda: _app)
+current_app = global_proxy(globals(), '_app')
+current_request = LocalProxy(_request_ctx, name='request')
+current_context = LocalProxy(_request_ctx, name='context')
+current_metadata = LocalProxy(_request_ctx, name='metadata')
+current_config = LocalProxy(_request_ctx, name='config')
@@ -0,0 +1,117 @@
+import math
+import threading
+
+
+class Limiter:
+    """
+    自适应并发数限制，参考 Netflix concurrency-limits
+
+    if limiter.acquire():
+        start = time.perf_counter()
+        try:
+            handle()
+        finally:
+            limiter.release(time.perf_counter() - start)
+    else:
+        reject()
+    """
+
+    def __init__(self, initial_limit=20, min_limit=1, max_limit=1000):
+        self.limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.inflight = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self.inflight >= self.limit:
+                self.rejected += 1
+                return False
+            self.inflight += 1
+            return True
+
+    def release(self, rtt):
+        with self._lock:
+            inflight = self.inflight
+            self.inflight -= 1
+            limit = self.update(rtt, inflight)
+            self.limit = max(self.min_limit, min(self.max_limit, limit))
+
+    def update(self, rtt, inflight):
+        """
+        根据调用耗时 rtt(秒) 和调用开始时的并发数返回新的并发数限制
+        """
+        raise NotImplementedError
+
+
+class AIMDLimiter(Limiter):
+    """
+    加性增乘性减: 耗时超过 timeout 秒时按 backoff_ratio 缩小限制，
+    否则在并发数接近限制时(说明限制确实在起作用)限制加 1
+    """
+
+    def __init__(self, initial_limit=20, min_limit=1, max_limit=1000, backoff_ratio=0.9, timeout=1.0):
+        super().__init__(initial_limit, min_limit, max_limit)
+        self.backoff_ratio = backoff_ratio
+        self.timeout = timeout
+
+    def update(self, rtt, inflight):
+        if rtt > self.timeout:
+            return int(self.limit * self.backoff_ratio)
+        if inflight * 2 >= self.limit:
+            return self.limit + 1
+        return self.limit
+
+
+class GradientLimiter(Limiter):
+    """
+    梯度算法: 比较长期平均耗时与短期平均耗时，耗时变长(排队)时按比例缩小限制，
+    并留出 sqrt(limit) 的排队余量用于探测更高的并发数
+    """
+
+    def __init__(self, initial_limit=20, min_limit=1, max_limit=1000, smoothing=0.2,
+                 long_window=600, short_window=10, tolerance=1.5):
+        super().__init__(initial_limit, min_limit, max_limit)
+        self.smoothing = smoothing
+        self.tolerance = tolerance
+        self._long_factor = 2 / (long_window + 1)
+        self._short_factor = 2 / (short_window + 1)
+        self.long_rtt = None
+        self.short_rtt = None
+        self._estimated = float(initial_limit)
+
+    def update(self, rtt, inflight):
+        if self.long_rtt is None:
+            self.long_rtt = self.short_rtt = rtt
+        else:
+            self.long_rtt += (rtt - self.long_rtt) * self._long_factor
+            self.short_rtt += (rtt - self.short_rtt) * self._short_factor
+
+        # 并发数远低于限制时耗时不能反映限制是否合理
+        if inflight < self._estimated / 2:
+            return self.limit
+
+        gradient = max(0.5, min(1.0, self.tolerance * self.long_rtt / self.short_rtt)) if self.short_rtt else 1.0
+        new_limit = self._estimated * gradient + math.sqrt(self._estimated)
+        self._estimated = self._estimated * (1 - self.smoothing) + new_limit * self.smoothing
+        self._estimated = max(self.min_limit, min(self.max_limit, self._estimated))
+        return int(self._estimated)
+
+
+LIMITERS = {
+    'aimd': AIMDLimiter,
+    'gradient': GradientLimiter,
+}
+
+
+def create_limiter(algorithm='aimd', **kwargs):
+    """
+    CONCURRENCY_LIMIT_ALGORITHM = 'gradient'
+    CONCURRENCY_LIMIT_INITIAL_LIMIT = 50
+    CONCURRENCY_LIMIT_MAX_LIMIT = 500
+
+    create_limiter(**app.config.get_namespace('CONCURRENCY_LIMIT_'))
+    """
+    return LIMITERS[algorithm](**kwargs)
@@ -1,4 +1,8 @@
 import copy
+from contextvars import ContextVar
+from functools import partial
+
+_getattribute = object.__getattribute__
 
 
 def _default_cls_attr(name, type_, cls_value):
@@ -16,13 +20,61 @@ def _default_cls_attr(name, type_, cls_value):
     })
 
 
+def _make_resolver(local, args, kwargs, name):
+    if isinstance(local, ContextVar):
+        def resolve():
+            try:
+                obj = local.get()
+            except LookupError:
+                raise RuntimeError('no object bound to {0}'.format(local.name))
+            return obj if name is None else getattr(obj, name)
+        return resolve
+
+    if hasattr(local, '__release_local__'):
+        def resolve():
+            try:
+                return getattr(local, name)
+            except AttributeError:
+                raise RuntimeError('no object bound to {0}'.format(name))
+        return resolve
+
+    if args or kwargs:
+        return partial(local, *(args or ()), **(kwargs or {}))
+    return local
+
+
+def global_proxy(namespace, name):
+    """
+    代理到模块全局变量(进程内单例)的当前值, 每次访问只是一次 C 实现的 dict.get, 变量被重新赋值(包括测试中的
+    mock.patch)后仍然代理到新的值
+
+    current_app = global_proxy(globals(), '_app')
+    """
+    return LocalProxy(partial(namespace.get, name))
+
+
 class LocalProxy:
-    __slots__ = ('__local', '__args', '__kwargs', '__dict__')
+    """
+    代理到 local 当前绑定的对象, local 可以是:
+
+    - 无参数的可调用对象: 每次访问时调用, 如 `LocalProxy(lambda: _app)`;
+      进程内单例可以传入 C 实现的 getter 避免每次访问都执行 Python 函数, 见 `global_proxy`
+    - ContextVar: 取当前上下文(线程或 asyncio task)中的值, 指定 name 时取该值的 name 属性
+    - 带有 `__release_local__` 的 local 对象: 取 local 的 name 属性
+
+    属性访问通过 __getattribute__ 直接转发, 不再先在代理对象上查找失败后才进入 __getattr__
+
+    _request_ctx = ContextVar('request_ctx')
+    current_request = LocalProxy(_request_ctx, name='request')
+    """
+    __slots__ = ('__local', '__args', '__kwargs', '__name', '__resolve')
 
-    def __init__(self, local, args=None, kwargs=None):
+    def __init__(self, local, args=None, kwargs=None, name=None):
         object.__setattr__(self, '_LocalProxy__local', local)
         object.__setattr__(self, '_LocalProxy__args', args or ())
         object.__setattr__(self, '_LocalProxy__kwargs', kwargs or {})
+        object.__setattr__(self, '_LocalProxy__name', name)
+        object.__setattr__(self, '_LocalProxy__resolve', _make_resolver(local, args, kwargs, name))
 
     @_default_cls_attr('name', str, __name__)
     def __name__(self):
@@ -40,35 +92,27 @@ class LocalProxy:
     def __doc__(self):
         return self._get_current_object().__doc__
 
-    def _get_class(self):
-        return self._get_current_object().__class__
-
-    @property
-    def __class__(self):
-        return self._get_class()
-
     def _get_current_object(self):
-        loc = object.__getattribute__(self, '_LocalProxy__local')
-        if not hasattr(loc, '__release_local__'):
-            return loc(*self.__args, **self.__kwargs)
-        try:
-            # not sure what this is about
-            return getattr(loc, self.__name__)
-        except AttributeError:
-            raise RuntimeError('no object bound to {0.__name__}'.format(self))
-
-    @property
-    def __dict__(self):
-        try:
-            return self._get_current_object().__dict__
-        except RuntimeError:
-            raise AttributeError('__dict__')
+        return _resolve(self)()
+
+    def __getattribute__(self, name):
+        if name in _PROXY_ATTRS:
+            if name == '__members__':
+                return dir(_resolve(self)())
+            if name == '__class__':
+                # 没有绑定对象时返回代理自身的类型, isinstance/inspect.isclass 等检查不抛出 RuntimeError
+                try:
+                    return _resolve(self)().__class__
+                except RuntimeError:
+                    return type(self)
+            return _getattribute(self, name)
+        return getattr(_resolve(self)(), name)
 
     def __repr__(self):
         try:
             obj = self._get_current_object()
         except RuntimeError:
-            return '<{0} unbound>'.format(self.__class__.__name__)
+            return '<{0} unbound>'.format(type(self).__name__)
         return repr(obj)
 
     def __bool__(self):
@@ -83,11 +127,6 @@ class LocalProxy:
         except RuntimeError:
             return []
 
-    def __getattr__(self, name):
-        if name == '__members__':
-            return dir(self._get_current_object())
-        return getattr(self._get_current_object(), name)
-
     def __setitem__(self, key, value):
         self._get_current_object()[key] = value
 
@@ -251,3 +290,10 @@ class LocalProxy:
         return copy.deepcopy(self._get_current_object(), memo)
 
     __rtruediv__ = __rdiv__
+
+
+_PROXY_ATTRS = frozenset({
+    '_get_current_object', '_LocalProxy__local', '_LocalProxy__args', '_LocalProxy__kwargs', '_LocalProxy__name',
+    '_LocalProxy__resolve', '__members__', '__class__',
+})
+_resolve = LocalProxy._LocalProxy__resolve.__get__
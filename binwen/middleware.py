@@ -1,8 +1,15 @@
+import time
+import logging
+import threading
+
 import grpc
 import pendulum
 
 
-from binwen import exceptions
+from binwen import exceptions, executors, signals
+from binwen.limiter import create_limiter
+from binwen.utils.functional import get_handler_name
+from binwen.utils.log import enqueue_handlers, ForwardHandler, ErrorReporter
 from binwen.pb2 import default_pb2
 
 
@@ -17,6 +24,11 @@ class MiddlewareMixin:
         response = self.handler(servicer, request, context)
         return self.after_handler(servicer, response)
 
+    async def __acall__(self, servicer, request, context):
+        request, context = self.before_handler(servicer, request, context)
+        response = await self.handler(servicer, request, context)
+        return self.after_handler(servicer, response)
+
     def before_handler(self, servicer, request, context):
         return request, context
 
@@ -25,17 +37,39 @@ class MiddlewareMixin:
 
 
 class GuardMiddleware(MiddlewareMixin):
+    """
+    未处理的异常返回 INTERNAL，相同的异常经 ErrorReporter 合并后输出, 见 ERROR_REPORT_INTERVAL(支持热加载)
+    """
+    reporter = None
+
+    def __init__(self, app, handler, origin_handler):
+        super().__init__(app, handler, origin_handler)
+        if GuardMiddleware.reporter is None:
+            GuardMiddleware.reporter = ErrorReporter(app.logger, interval=app.config['ERROR_REPORT_INTERVAL'])
+            signals.config_changed.connect(GuardMiddleware.on_config_changed)
+
+    @staticmethod
+    def on_config_changed(app, old, new):
+        if GuardMiddleware.reporter is not None:
+            GuardMiddleware.reporter.interval = new['ERROR_REPORT_INTERVAL']
+
     def __call__(self, servicer, request, context):
         try:
             return self.handler(servicer, request, context)
         except Exception as e:
-            import traceback
-            print(traceback.format_exc())
-            print("exc>>>>", e)
-            self.app.logger.exception(str(e), exc_info=True)
-            context.set_code(grpc.StatusCode.INTERNAL)
-            context.set_details('Internal Error Occured')
-            return default_pb2.Empty()
+            return self.internal_error(e, context)
+
+    async def __acall__(self, servicer, request, context):
+        try:
+            return await self.handler(servicer, request, context)
+        except Exception as e:
+            return self.internal_error(e, context)
+
+    def internal_error(self, e, context):
+        self.reporter.report(e)
+        context.set_code(grpc.StatusCode.INTERNAL)
+        context.set_details('Internal Error Occured')
+        return default_pb2.Empty()
 
 
 class RpcErrorMiddleware(MiddlewareMixin):
@@ -47,11 +81,123 @@ class RpcErrorMiddleware(MiddlewareMixin):
             context.set_details(e.details)
             return default_pb2.Empty()
 
+    async def __acall__(self, servicer, request, context):
+        try:
+            return await self.handler(servicer, request, context)
+        except exceptions.RpcException as e:
+            context.set_code(e.code)
+            context.set_details(e.details)
+            return default_pb2.Empty()
+
+
+class DeadlineMiddleware(MiddlewareMixin):
+    """
+    调用开始执行前 deadline 已经过期(比如在线程池队列中等待太久)时直接返回 DEADLINE_EXCEEDED，
+    不再执行后面的中间件和 handler，应该放在 MIDDLEWARE 的最前面
+
+    MIDDLEWARE = [
+        'binwen.middleware.DeadlineMiddleware',
+        ...
+    ]
+    """
+    rejected = 0
+    _rejected_lock = threading.Lock()
+
+    def __call__(self, servicer, request, context):
+        if self.expired(context):
+            return self.reject(servicer, context)
+        return self.handler(servicer, request, context)
+
+    async def __acall__(self, servicer, request, context):
+        if self.expired(context):
+            return self.reject(servicer, context)
+        return await self.handler(servicer, request, context)
+
+    @staticmethod
+    def expired(context):
+        remaining = context.time_remaining()
+        return remaining is not None and remaining <= 0
+
+    def reject(self, servicer, context):
+        with DeadlineMiddleware._rejected_lock:
+            DeadlineMiddleware.rejected += 1
+        wait = executors.queue_wait()
+        self.app.logger.debug(
+            f'{servicer.__class__.__name__}.{self.origin_handler.__name__} deadline exceeded '
+            f'before handling, waited {wait or 0:.3f}s in queue'
+        )
+        context.set_code(grpc.StatusCode.DEADLINE_EXCEEDED)
+        context.set_details('Deadline Exceeded')
+        return default_pb2.Empty()
+
+
+class ConcurrencyLimitMiddleware(MiddlewareMixin):
+    """
+    根据 handler 的耗时自适应调整当前进程的并发数限制，超过限制的调用直接返回 RESOURCE_EXHAUSTED，
+    算法和参数通过 CONCURRENCY_LIMIT_* 配置, 见 binwen.limiter.create_limiter;
+    热加载修改了 CONCURRENCY_LIMIT_* 时按新的配置重新创建 limiter
+
+    limiter = ConcurrencyLimitMiddleware.limiter
+    limiter.limit, limiter.inflight, limiter.rejected
+    """
+    limiter = None
+
+    def __init__(self, app, handler, origin_handler):
+        super().__init__(app, handler, origin_handler)
+        if ConcurrencyLimitMiddleware.limiter is None:
+            ConcurrencyLimitMiddleware.limiter = create_limiter(**app.config.get_namespace('CONCURRENCY_LIMIT_'))
+            signals.config_changed.connect(ConcurrencyLimitMiddleware.on_config_changed)
+
+    @staticmethod
+    def on_config_changed(app, old, new):
+        # 进行中的调用在取得许可的 limiter 上释放, 新的 limiter 从 0 个进行中的调用开始计数
+        config = new.get_namespace('CONCURRENCY_LIMIT_')
+        if ConcurrencyLimitMiddleware.limiter is not None and config != old.get_namespace('CONCURRENCY_LIMIT_'):
+            ConcurrencyLimitMiddleware.limiter = create_limiter(**config)
+
+    def __call__(self, servicer, request, context):
+        limiter = self.limiter
+        if not limiter.acquire():
+            return self.reject(context)
+
+        start = time.perf_counter()
+        try:
+            return self.handler(servicer, request, context)
+        finally:
+            limiter.release(time.perf_counter() - start)
+
+    async def __acall__(self, servicer, request, context):
+        limiter = self.limiter
+        if not limiter.acquire():
+            return self.reject(context)
+
+        start = time.perf_counter()
+        try:
+            return await self.handler(servicer, request, context)
+        finally:
+            limiter.release(time.perf_counter() - start)
+
+    @staticmethod
+    def reject(context):
+        context.set_code(grpc.StatusCode.RESOURCE_EXHAUSTED)
+        context.set_details('Concurrency Limit Exceeded')
+        return default_pb2.Empty()
+
 
 class ServiceLogMiddleware(MiddlewareMixin):
     def __call__(self, servicer, request, context):
         start_at = pendulum.now(self.app.tz)
         response = self.handler(servicer, request, context)
+        self.log(servicer, start_at)
+        return response
+
+    async def __acall__(self, servicer, request, context):
+        start_at = pendulum.now(self.app.tz)
+        response = await self.handler(servicer, request, context)
+        self.log(servicer, start_at)
+        return response
+
+    def log(self, servicer, start_at):
         finish_at = pendulum.now(self.app.tz)
         delta = finish_at - start_at
         self.app.logger.info(
@@ -62,4 +208,118 @@ class ServiceLogMiddleware(MiddlewareMixin):
                 delta.total_seconds()
             )
         )
+
+
+class _LogSize:
+    """
+    访问日志中请求/响应的大小, 在后台线程中格式化日志时才转换为字符串, 失败的调用没有 response 时为 `-`
+    """
+    __slots__ = ('size', )
+
+    def __init__(self, size):
+        self.size = size
+
+    def __str__(self):
+        return '-' if self.size is None else f'{self.size}B'
+
+
+class AccessLogMiddleware(MiddlewareMixin):
+    """
+    结构化的访问日志, 替代 ServiceLogMiddleware
+
+    用 time.perf_counter_ns 计时, 只在生成 LogRecord 时取一次当前时间(record.created)。
+    日志写入 `binwen.access` logger, 调用线程只生成 LogRecord，格式化和输出在后台线程中完成。
+    LogRecord 带有 method, code, duration_ms, request_size, response_size 属性，可以在 ACCESS_LOG_FORMAT
+    或自定义的 handler/formatter 中使用
+
+    ACCESS_LOG_LEVEL = 'INFO'  # `binwen.access` 的级别, 'WARNING' 关闭访问日志, None 时不修改(由日志配置决定),
+                               # 支持热加载; ACCESS_LOG_PROPAGATE 和 ACCESS_LOG_FORMAT 修改后需要重启
+    ACCESS_LOG_PROPAGATE = True  # 在后台线程中交给上级 logger 的 handler(如 GRPC_LOG_HANDLER)输出;
+                                 # False 时使用单独的 handler, 按 ACCESS_LOG_FORMAT 在后台线程中输出
+    """
+    logger = None
+    message = '%s %s %.3fms request=%s response=%s'
+
+    def __init__(self, app, handler, origin_handler):
+        super().__init__(app, handler, origin_handler)
+        self.method = get_handler_name(origin_handler)
+        if AccessLogMiddleware.logger is None:
+            AccessLogMiddleware.logger = self.setup_logger(app.config)
+            signals.config_changed.connect(AccessLogMiddleware.on_config_changed)
+
+    @staticmethod
+    def on_config_changed(app, old, new):
+        level = new['ACCESS_LOG_LEVEL']
+        if AccessLogMiddleware.logger is not None and level != old['ACCESS_LOG_LEVEL']:
+            AccessLogMiddleware.logger.setLevel(logging.NOTSET if level is None else level)
+
+    @staticmethod
+    def setup_logger(config):
+        logger = logging.getLogger('binwen.access')
+        # 不设置时继承 root 的级别, Server.setup_logger 把 root 设置为 GRPC_LOG_LEVEL(默认 WARNING)
+        if config['ACCESS_LOG_LEVEL'] is not None:
+            logger.setLevel(config['ACCESS_LOG_LEVEL'])
+
+        if not config['ACCESS_LOG_PROPAGATE']:
+            default_handler = logging.StreamHandler()
+            default_handler.setFormatter(logging.Formatter(config['ACCESS_LOG_FORMAT']))
+            return enqueue_handlers(logger, default_handler, propagate=False)
+
+        # 上级 logger 的 handler 也在后台线程中执行: 不再直接向上传递, 由后台线程中的 ForwardHandler 交给上级 logger,
+        # 日志配置中给 `binwen.access` 单独设置的 handler 同样移到后台线程
+        if logger.propagate:
+            logger.addHandler(ForwardHandler(logger, parent=True))
+        return enqueue_handlers(logger, propagate=False)
+
+    def __call__(self, servicer, request, context):
+        if not self.logger.isEnabledFor(logging.INFO):
+            return self.handler(servicer, request, context)
+
+        start = time.perf_counter_ns()
+        try:
+            response = self.handler(servicer, request, context)
+        except Exception as e:
+            self.log(request, None, context, time.perf_counter_ns() - start, self.error_code(e))
+            raise
+        self.log(request, response, context, time.perf_counter_ns() - start)
         return response
+
+    async def __acall__(self, servicer, request, context):
+        if not self.logger.isEnabledFor(logging.INFO):
+            return await self.handler(servicer, request, context)
+
+        start = time.perf_counter_ns()
+        try:
+            response = await self.handler(servicer, request, context)
+        except Exception as e:
+            self.log(request, None, context, time.perf_counter_ns() - start, self.error_code(e))
+            raise
+        self.log(request, response, context, time.perf_counter_ns() - start)
+        return response
+
+    @staticmethod
+    def error_code(e):
+        # 异常在外层的中间件中才转换为状态码: RpcException 为它的 code, 其它异常由 GuardMiddleware 返回 INTERNAL
+        if isinstance(e, exceptions.RpcException):
+            return e.code or grpc.StatusCode.UNKNOWN
+        return grpc.StatusCode.INTERNAL
+
+    def log(self, request, response, context, duration_ns, code=None):
+        if code is None:
+            code = getattr(context, 'code', None)
+            if callable(code):
+                code = code()
+        code = code or grpc.StatusCode.OK
+        duration_ms = duration_ns / 1e6
+        request_size = request.ByteSize() if hasattr(request, 'ByteSize') else None
+        response_size = response.ByteSize() if hasattr(response, 'ByteSize') else None
+        self.logger.info(
+            self.message, self.method, code, duration_ms, _LogSize(request_size), _LogSize(response_size),
+            extra={
+                'method': self.method,
+                'code': code,
+                'duration_ms': duration_ms,
+                'request_size': request_size,
+                'response_size': response_size,
+            }
+        )
@@ -0,0 +1,469 @@
+import os
+import sys
+import time
+import select
+import signal
+import logging
+
+from binwen.gcstats import freeze_gc
+from binwen.recycle import RECYCLE_EXIT_CODE
+from binwen.reloader import ConfigWatcher
+from binwen.utils.log import stop_listeners
+
+logger = logging.getLogger('binwen.server')
+
+
+class Master:
+    """
+    预派生(pre-fork)多进程模式的主进程
+
+    主进程只加载一次 app，然后 fork 出 `server.processes` 个 worker 子进程，
+    每个 worker 各自创建 grpc server 并通过 SO_REUSEPORT 绑定同一个 addrport，
+    由内核在 worker 之间分配连接。主进程负责监控 worker，异常退出时重新拉起，
+    并把停止信号转发给所有 worker。
+
+    app 在主进程中加载, worker 通过 copy-on-write 共享其内存; 每次 fork worker 都会调用扩展的
+    before_fork/after_fork_child 钩子, 连接池等不能跨进程共享的资源应该在 worker 中重新创建,
+    见 BaseApp.call_extension_hook. exec 新主进程的 fork 不调用这两个钩子
+
+    worker 通过管道通知主进程(见 Server.notify_master): 预热完成并开始接收调用后发送 ready,
+    达到 GRPC_MAX_REQUESTS/GRPC_MAX_RSS 限制时发送 recycle, 主进程立即拉起替代的 worker, 替代者 ready 之后
+    才向旧的 worker 发送 SIGTERM, 端口一直有 worker 在监听; 旧的 worker 处理完进行中的调用后以 RECYCLE_EXIT_CODE 退出,
+    见 binwen.recycle.WorkerRecycler
+
+    信号处理函数只记录收到的信号(通过 signal.set_wakeup_fd 唤醒主循环), fork 和回收 worker 都在主循环中进行:
+    信号处理函数可能在 fork 的钩子或者 logging 持有锁的时候被调用, 在其中 fork 会死锁
+
+    SIGHUP 平滑重载, 端口一直打开:
+    只修改了配置时, 主进程重新加载配置后把 SIGHUP 转发给已经 ready 的 worker, worker 在进程内重新加载配置(见 Server.reload),
+    还在启动的 worker 忽略 SIGHUP(默认处理是退出), ready 之后主进程再通知它重新加载;
+    不中断连接, 缓存和连接池等状态保留; CONFIG_RELOAD 为 True 时主进程检查配置文件, 有修改时同样重新加载后通知 worker;
+    已导入的代码文件有修改时, 主进程 fork 并 exec 一个新的主进程(重新执行启动命令, 加载新的代码和配置),
+    新主进程的 worker 都 ready 之后通知旧的主进程, 旧的 worker 处理完进行中的调用后退出, SO_REUSEPORT 下新旧 worker
+    同时监听同一个端口. 旧的主进程不退出: 它可能是容器的 1 号进程或者 supervisor 监控的进程, 退出会导致新的主进程也被停止;
+    之后它只等待新的主进程, 把收到的信号转发给新的主进程, 新的主进程退出时它也退出.
+    新的主进程再次 exec 时也由第一个主进程 fork, 不会形成越来越长的进程链
+
+    worker 停止(回收或者 exec 新的主进程)时, 它的监听队列中还没有 accept 的连接会被重置, 这是 SO_REUSEPORT 的限制;
+    Linux 5.14 以上设置 `sysctl net.ipv4.tcp_migrate_req=1` 后这些连接会迁移给监听同一个端口的其它 worker
+
+    s = Server(app, addrport='[::]:50051', workers=10, processes=4)
+    s.run()
+    """
+    # worker 存活时间短于该值即退出，视为启动失败，重启前先等待，避免疯狂 fork
+    min_worker_lifetime = 1
+    # 没有收到信号和通知时主循环检查 worker 的间隔(秒)
+    tick = 1
+    handled_signals = (signal.SIGINT, signal.SIGHUP, signal.SIGTERM, signal.SIGQUIT, signal.SIGCHLD)
+    # 新主进程等待 worker 就绪的最长时间, 超过后也通知旧的主进程
+    reload_timeout = 30
+    # 新主进程通过该环境变量得到通知旧主进程的管道, 不作为配置项, 见 binwen.config.RESERVED_ENV
+    parent_env = 'BINWEN_MASTER_FD'
+
+    def __init__(self, server):
+        self.server = server
+        self.processes = server.processes
+        self.workers = {}
+        self.alive = True
+        # 还没有 ready 的替代者 -> 请求回收的 worker
+        self.replacing = {}
+        # 已经 ready(安装了 SIGHUP 处理函数)的 worker, 重新加载配置时还在启动的 worker
+        self.ready = set()
+        self.stale = set()
+        # exec 出来还在启动的新主进程, 和已经接替当前主进程的新主进程
+        self.upgrading = None
+        self.successor = None
+        # 由旧主进程 exec 出来时, 通知旧主进程的管道, 还没有 ready 的 worker 数和等待的截止时间
+        self.parent_fd = int(os.environ.pop(self.parent_env, 0)) or None
+        self.pending_ready = 0
+        self.ready_deadline = None
+        self.code_mtimes = {}
+        # CONFIG_RELOAD 时检查配置文件的 ConfigWatcher 和下一次检查的时间
+        self.config_watcher = None
+        self.config_check_at = None
+        # 收到还没有处理的信号, 唤醒主循环的管道, worker 通知主进程的管道
+        self._signals = []
+        self._wakeup = None
+        self._channel = None
+        self._buffer = b''
+
+    def run(self):
+        self.register_signal()
+        self.open_channel()
+        self.code_mtimes = self.code_snapshot()
+        self.start_config_watcher()
+        self.freeze_gc()
+        if self.parent_fd is not None:
+            self.pending_ready = self.processes
+            self.ready_deadline = time.monotonic() + self.reload_timeout
+        for _ in range(self.processes):
+            self.spawn_worker()
+
+        quit_command = 'CTRL-BREAK' if sys.platform == 'win32' else 'CONTROL-C'
+        sys.stdout.write(
+            f"Starting server at {self.server.addrport} with {self.processes} processes (master: {os.getpid()})\n"
+            f" Quit the server with {quit_command}.\n"
+        )
+        self.server.write_extension_report()
+
+        try:
+            while self.workers or self.upgrading or self.successor:
+                self.wait(self.tick)
+                self.handle_signals()
+                self.handle_messages()
+                self.check_ready_timeout()
+                self.check_config()
+                if not self.reap():
+                    break
+        finally:
+            self.close_wakeup()
+            self.close_channel()
+        return True
+
+    def wait(self, timeout):
+        """
+        等待信号, worker 的通知或超时, 信号处理函数在 select 返回之前已经执行
+        """
+        for deadline in (self.ready_deadline, self.config_check_at):
+            if deadline is not None:
+                timeout = max(0, min(timeout, deadline - time.monotonic()))
+        wakeup = self._wakeup[0]
+        select.select([wakeup, self._channel[0]], [], [], timeout)
+        try:
+            while os.read(wakeup, 512):
+                pass
+        except BlockingIOError:
+            pass
+
+    def open_channel(self):
+        r, w = self._channel = os.pipe()
+        os.set_blocking(r, False)
+        self.server.master_fd = w
+
+    def close_channel(self):
+        if self._channel is not None:
+            for fd in self._channel:
+                os.close(fd)
+            self._channel = None
+            self.server.master_fd = None
+
+    def handle_messages(self):
+        try:
+            while True:
+                data = os.read(self._channel[0], 4096)
+                if not data:
+                    break
+                self._buffer += data
+        except BlockingIOError:
+            pass
+
+        *lines, self._buffer = self._buffer.split(b'\n')
+        for line in lines:
+            message, pid = line.decode().split()
+            self.handle_message(message, int(pid))
+
+    def handle_message(self, message, pid):
+        """
+        recycle: worker 即将回收, 先拉起替代的 worker
+        ready: worker 开始接收调用, 它替代的 worker 可以停止了; 来自新主进程时, 新主进程的 worker 都已经 ready
+        upgrade: 接替当前主进程的新主进程的代码有修改, 由当前主进程 exec 另一个新的主进程
+        """
+        if message == 'recycle':
+            if self.serving and pid in self.workers and pid not in self.replacing.values():
+                self.replacing[self.spawn_worker()] = pid
+        elif message == 'ready' and pid == self.upgrading:
+            self.promote(pid)
+        elif message == 'ready':
+            if pid in self.workers:
+                self.ready.add(pid)
+            if pid in self.stale:
+                self.stale.discard(pid)
+                self.kill_worker(pid, signal.SIGHUP)
+            old = self.replacing.pop(pid, None)
+            if old is not None:
+                logger.info(f'worker {pid} ready, stopping worker {old}')
+                self.kill_worker(old, signal.SIGTERM)
+            if self.pending_ready:
+                self.pending_ready -= 1
+                if not self.pending_ready:
+                    self.handoff()
+        elif message == 'upgrade' and pid == self.successor and self.alive:
+            self.reexec()
+
+    def handle_signals(self):
+        while self._signals:
+            signum = self._signals.pop(0)
+            if signum in (signal.SIGINT, signal.SIGTERM, signal.SIGQUIT):
+                self.stop()
+            elif signum == signal.SIGHUP and self.alive:
+                self.reload()
+
+    @property
+    def serving(self):
+        # 当前主进程的 worker 在接收调用: 没有停止, 也没有被新的主进程接替
+        return self.alive and self.successor is None
+
+    def reap(self):
+        """
+        回收已经退出的 worker, 没有子进程时返回 False
+        """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return False
+            if not pid:
+                return True
+            self.worker_exited(pid, status)
+
+    def worker_exited(self, pid, status):
+        if pid == self.upgrading:
+            self.upgrading = None
+            logger.error(f'new master {pid} exited (status: {status}), keeping the current workers')
+            return
+        if pid == self.successor:
+            self.successor = None
+            logger.info(f'master {pid} exited (status: {status})')
+            return
+
+        started_at = self.workers.pop(pid, None)
+        self.ready.discard(pid)
+        self.stale.discard(pid)
+        if started_at is None or not self.serving:
+            return
+
+        # 替代者 ready 之前退出时重新拉起替代者; 请求回收的 worker 先退出时, 替代者直接成为普通的 worker
+        replaced = self.replacing.pop(pid, None)
+        for new, old in list(self.replacing.items()):
+            if old == pid:
+                del self.replacing[new]
+
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == RECYCLE_EXIT_CODE:
+            logger.info(f'worker {pid} recycled')
+        else:
+            logger.warning(f'worker {pid} exited unexpectedly (status: {status}), restarting')
+            if time.monotonic() - started_at < self.min_worker_lifetime:
+                time.sleep(self.min_worker_lifetime)
+
+        if replaced is not None and replaced in self.workers:
+            self.replacing[self.spawn_worker()] = replaced
+        elif len(self.workers) - len(self.replacing) < self.processes:
+            self.spawn_worker()
+
+    def stop(self):
+        self.alive = False
+        self.kill_workers(signal.SIGTERM)
+        for pid in (self.upgrading, self.successor):
+            if pid is not None:
+                self.kill(pid, signal.SIGTERM)
+
+    def freeze_gc(self):
+        if self.server.gc_freeze:
+            # fork 之前冻结, worker 的垃圾回收不再遍历(写入)从主进程继承的对象, 共享的内存页保持不变
+            freeze_gc(collect=False)
+
+    def code_snapshot(self):
+        """
+        已导入的代码文件(不包括配置模块)的修改时间
+        """
+        config_modules = set(self.server.app.config_modules())
+        mtimes = {}
+        for module in list(sys.modules.values()):
+            path = getattr(module, '__file__', None)
+            if path and module not in config_modules:
+                try:
+                    mtimes[path] = os.stat(path).st_mtime_ns
+                except OSError:
+                    pass
+        return mtimes
+
+    def code_changed(self):
+        for path, mtime in self.code_mtimes.items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def reload(self):
+        """
+        代码有修改时 exec 新的主进程, 否则重新加载配置并通知 worker 重新加载;
+        已经被新的主进程接替时转发给它
+        """
+        if self.successor is not None:
+            self.kill(self.successor, signal.SIGHUP)
+            return True
+
+        if self.code_changed():
+            if self.parent_fd is not None:
+                # 由第一个主进程 exec 另一个新的主进程
+                return self.notify_parent('upgrade')
+            return self.reexec()
+
+        return self.reload_config()
+
+    def reload_config(self):
+        """
+        重新加载配置并通知 worker 重新加载, 之后 fork 的 worker 继承主进程的新配置
+        """
+        if not self.server.reload():
+            return False
+        for pid in list(self.workers):
+            if pid in self.ready:
+                self.kill_worker(pid, signal.SIGHUP)
+            else:
+                self.stale.add(pid)
+        return True
+
+    def start_config_watcher(self):
+        if self.server.app.config.get('CONFIG_RELOAD'):
+            self.config_watcher = ConfigWatcher(self.server.app, reload=self.reload_config)
+            self.config_check_at = time.monotonic() + self.config_watcher.interval
+
+    def check_config(self):
+        # 被新的主进程接替之后由新的主进程检查
+        if self.config_watcher is None or not self.serving or time.monotonic() < self.config_check_at:
+            return
+        self.config_check_at = time.monotonic() + self.config_watcher.interval
+        self.config_watcher.check()
+
+    def reexec(self):
+        """
+        fork 并 exec 新的主进程, 新主进程的 worker 都 ready 之后通过管道通知当前主进程, 见 promote
+        """
+        if self.upgrading is not None:
+            logger.warning(f'new master {self.upgrading} is already starting')
+            return False
+
+        argv = getattr(sys, 'orig_argv', None) or [sys.executable] + sys.argv
+        w = self._channel[1]
+        env = dict(os.environ, **{self.parent_env: str(w)})
+        pid = self.fork()
+        if pid:
+            self.upgrading = pid
+            logger.info(f'code changed, starting new master {pid}')
+            return True
+
+        try:
+            os.set_inheritable(w, True)
+            os.execve(sys.executable, argv, env)
+        finally:
+            os._exit(1)
+
+    def promote(self, pid):
+        """
+        新主进程的 worker 都已经 ready: 停止当前的 worker(或者之前接替的主进程), 之后只等待新的主进程
+        """
+        logger.info(f'new master {pid} ready, stopping the old workers')
+        self.upgrading = None
+        self.kill_workers(signal.SIGTERM)
+        self.replacing.clear()
+        if self.successor is not None:
+            self.kill(self.successor, signal.SIGTERM)
+        self.successor = pid
+
+    def handoff(self):
+        """
+        新主进程的 worker 都已就绪, 通知旧的主进程停止它的 worker
+        """
+        self.pending_ready = 0
+        self.ready_deadline = None
+        self.notify_parent('ready')
+
+    def check_ready_timeout(self):
+        if self.pending_ready and time.monotonic() >= self.ready_deadline:
+            logger.warning(f'workers not ready in {self.reload_timeout}s, stopping the old workers anyway')
+            self.handoff()
+
+    def notify_parent(self, message):
+        try:
+            os.write(self.parent_fd, f'{message} {os.getpid()}\n'.encode())
+        except OSError:
+            logger.exception(f'failed to notify the old master: {message}')
+            return False
+        return True
+
+    def fork(self):
+        """
+        fork 时屏蔽信号, 子进程恢复默认的信号处理之后才处理: 否则在这之前收到的信号(如 SIGTERM)会被主进程的处理函数吞掉
+        """
+        mask = signal.pthread_sigmask(signal.SIG_BLOCK, self.handled_signals)
+        try:
+            pid = os.fork()
+            if not pid:
+                self.reset_signal()
+                if self._channel is not None:
+                    os.close(self._channel[0])
+                if self.parent_fd is not None:
+                    os.close(self.parent_fd)
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+        return pid
+
+    def spawn_worker(self):
+        app = self.server.app
+        app.call_extension_hook('before_fork')
+        pid = self.fork()
+        if pid:
+            self.workers[pid] = time.monotonic()
+            return pid
+
+        code = 0
+        try:
+            app.call_extension_hook('after_fork_child')
+            self.server.serve()
+            if self.server.recycled:
+                code = RECYCLE_EXIT_CODE
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            logger.exception(f'worker {os.getpid()} crashed')
+            code = 1
+        finally:
+            stop_listeners()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def kill_worker(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            self.workers.pop(pid, None)
+
+    def kill_workers(self, signum):
+        for pid in list(self.workers):
+            self.kill_worker(pid, signum)
+
+    @staticmethod
+    def kill(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def register_signal(self):
+        r, w = self._wakeup = os.pipe()
+        os.set_blocking(r, False)
+        os.set_blocking(w, False)
+        signal.set_wakeup_fd(w)
+        for signum in self.handled_signals:
+            signal.signal(signum, self._signal_handler)
+
+    def close_wakeup(self):
+        if self._wakeup is not None:
+            signal.set_wakeup_fd(-1)
+            for fd in self._wakeup:
+                os.close(fd)
+            self._wakeup = None
+
+    def reset_signal(self):
+        # fork 出来的子进程不再唤醒主进程的主循环; 在 Server.register_signal 安装处理函数之前忽略 SIGHUP,
+        # 否则还在启动的 worker 收到转发的 SIGHUP 会退出
+        self.close_wakeup()
+        for signum in self.handled_signals:
+            signal.signal(signum, signal.SIG_IGN if signum == signal.SIGHUP else signal.SIG_DFL)
+
+    def _signal_handler(self, signum, frame):
+        self._signals.append(signum)
@@ -0,0 +1,91 @@
+import os
+import random
+import logging
+import resource
+import threading
+
+from binwen.servicer import tracker
+
+logger = logging.getLogger('binwen.server')
+
+# 达到回收条件后正常退出的 worker 的退出码, 主进程据此判断不是异常退出
+RECYCLE_EXIT_CODE = 3
+
+
+def current_rss():
+    """
+    当前进程的常驻内存(字节), 不支持 /proc 的系统上返回峰值
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS 的单位是字节, Linux 是 KB
+        return maxrss if os.uname().sysname == 'Darwin' else maxrss * 1024
+
+
+class WorkerRecycler:
+    """
+    worker 回收: 后台线程定期检查处理的调用数和常驻内存, 超过限制时调用 server.recycle(),
+    主进程先拉起新的 worker, 新的 worker 开始接收调用后旧的 worker 才停止接收新的调用, 进行中的调用处理完成后退出;
+    替代者 replace_timeout 秒内没有就绪时旧的 worker 也停止.
+    只在多进程模式(GRPC_PROCESSES > 1)下生效: 单进程模式下退出后到重新启动之前端口是关闭的, 不回收
+
+    GRPC_MAX_REQUESTS = 10000
+    GRPC_MAX_REQUESTS_JITTER = 1000  # 每个 worker 的上限加上 [0, jitter] 的随机数, 避免同时回收
+    GRPC_MAX_RSS = 512 * 1024 * 1024  # 字节
+    """
+    interval = 1
+    replace_timeout = 30
+
+    def __init__(self, server, max_requests=0, jitter=0, max_rss=0):
+        self.server = server
+        self.max_requests = max_requests + random.randint(0, jitter) if max_requests else 0
+        self.max_rss = max_rss
+        self.base = tracker.total
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_config(cls, server):
+        config = server.app.config
+        return cls(server, config['GRPC_MAX_REQUESTS'], config['GRPC_MAX_REQUESTS_JITTER'], config['GRPC_MAX_RSS'])
+
+    @property
+    def enabled(self):
+        return bool(self.max_requests or self.max_rss)
+
+    def check(self):
+        """
+        返回回收原因, 未达到限制时返回 None
+        """
+        requests = tracker.total - self.base
+        if self.max_requests and requests >= self.max_requests:
+            return f'handled {requests} requests (max: {self.max_requests})'
+
+        if self.max_rss:
+            rss = current_rss()
+            if rss >= self.max_rss:
+                return f'rss {rss >> 20}MB exceeds {self.max_rss >> 20}MB'
+        return None
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            reason = self.check()
+            if reason is not None:
+                logger.info(f'recycling worker {os.getpid()}: {reason}')
+                self.server.recycle()
+                if not self._stop.wait(self.replace_timeout) and not self.server.draining:
+                    logger.warning(f'replacement of worker {os.getpid()} not ready in {self.replace_timeout}s, '
+                                   f'draining anyway')
+                    self.server.drain_threadsafe()
+                return
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='binwen-worker-recycler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
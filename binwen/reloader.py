@@ -0,0 +1,77 @@
+import os
+import logging
+import threading
+
+logger = logging.getLogger('binwen.server')
+
+
+class ConfigWatcher:
+    """
+    配置热加载: 后台线程每隔 CONFIG_RELOAD_INTERVAL 秒检查配置模块和 CONFIG_JSON 文件的修改时间，
+    有变化时调用 app.reload_config()，加载或校验失败时保留原来的配置.
+    多进程模式下由主进程在主循环中检查, 重新加载后通知 worker 重新加载(新 fork 的 worker 继承主进程的配置),
+    见 binwen.prefork.Master
+
+    CONFIG_RELOAD = True
+    CONFIG_RELOAD_INTERVAL = 2
+    CONFIG_JSON = '/etc/myapp/config.json'
+    """
+
+    def __init__(self, app, interval=None, reload=None):
+        self.app = app
+        self.interval = interval if interval is not None else app.config['CONFIG_RELOAD_INTERVAL']
+        # 重新加载配置, 返回是否成功
+        self.reload = reload or self.reload_config
+        self.mtimes = self.snapshot()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def paths(self):
+        paths = [getattr(m, '__file__', None) for m in self.app.config_modules()]
+        paths.append(self.app.config.get('CONFIG_JSON'))
+        return [p for p in paths if p]
+
+    def snapshot(self):
+        mtimes = {}
+        for path in self.paths():
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def check(self):
+        """
+        配置文件有变化时重新加载, 返回是否替换了配置
+        """
+        mtimes = self.snapshot()
+        if mtimes == self.mtimes:
+            return False
+
+        self.mtimes = mtimes
+        if not self.reload():
+            return False
+        # CONFIG_JSON 可能被修改
+        self.mtimes = self.snapshot()
+        return True
+
+    def reload_config(self):
+        try:
+            self.app.reload_config()
+        except Exception:
+            logger.exception('config reload failed, keeping the current config')
+            return False
+        logger.info('config reloaded')
+        return True
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            self.check()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='binwen-config-watcher', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
@@ -1,55 +1,394 @@
+import gc
+import os
 import sys
 import time
+import asyncio
+import inspect
 import signal
 import logging
-from concurrent import futures
 
 import grpc
 
-from binwen import signals
+from binwen import exceptions, signals
+from binwen.prefork import Master
+from binwen.recycle import WorkerRecycler
+from binwen.reloader import ConfigWatcher
+from binwen.gcstats import gc_stats, freeze_gc
+from binwen.executors import PriorityThreadPoolExecutor, TimedThreadPoolExecutor
+from binwen.servicer import tracker
+from binwen.test.stub import Stub
+from binwen.utils.functional import import_obj
+
+logger = logging.getLogger('binwen.server')
+
+# GRPC_SERVER_OPTIONS_* 配置与 grpc channel argument 的对应关系, 不在此列的配置项映射为 `grpc.<key>`
+# 如 GRPC_SERVER_OPTIONS_MAX_RECEIVE_MESSAGE_LENGTH -> grpc.max_receive_message_length
+CHANNEL_ARGUMENTS = {
+    'http2_max_pings_without_data': 'grpc.http2.max_pings_without_data',
+    'http2_min_ping_interval_without_data_ms': 'grpc.http2.min_ping_interval_without_data_ms',
+    'http2_min_recv_ping_interval_without_data_ms': 'grpc.http2.min_recv_ping_interval_without_data_ms',
+    'http2_max_ping_strikes': 'grpc.http2.max_ping_strikes',
+}
+
+COMPRESSIONS = {
+    'none': grpc.Compression.NoCompression,
+    'deflate': grpc.Compression.Deflate,
+    'gzip': grpc.Compression.Gzip,
+}
 
 
 class Server:
 
-    def __init__(self, app, addrport=None, workers=3):
+    def __init__(self, app, addrport=None, workers=3, processes=1, aio=False, gc_freeze=None):
         self.app = app
+        self.log_handler = None
         self.setup_logger()
+        signals.config_changed.connect(self.on_config_changed)
         self.workers = workers
+        self.processes = processes
+        self.aio = aio
+        self.gc_freeze = app.config['GC_FREEZE'] if gc_freeze is None else gc_freeze
         self.addrport = addrport if addrport else "[::]:50051"
-        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=self.workers))
-        self.server.add_insecure_port(self.addrport)
+        # grpc server 在预热之后才创建(add_insecure_port 时端口就开始接受连接), 多进程模式下在 fork 出来的子进程中创建,
+        # asyncio 模式下在事件循环中创建
+        self.server = None
         self._stopped = False
+        self._draining_at = None
+        self.drain_time = None
+        self.warmup_time = None
+        self.config_watcher = None
+        self.recycler = None
+        self.recycled = False
+        # 多进程模式下通知主进程的管道, 由 binwen.prefork.Master 设置
+        self.master_fd = None
+        self._loop = None
+
+    @property
+    def prefork(self):
+        return self.processes > 1
+
+    def make_server_kwargs(self):
+        """
+        GRPC_SERVER_OPTIONS_MAX_RECEIVE_MESSAGE_LENGTH = 32 * 1024 * 1024
+        GRPC_SERVER_OPTIONS_KEEPALIVE_TIME_MS = 30000
+        GRPC_SERVER_OPTIONS_MAX_CONCURRENT_STREAMS = 100
+        GRPC_SERVER_OPTIONS_MAXIMUM_CONCURRENT_RPCS = 1000
+        GRPC_SERVER_OPTIONS_COMPRESSION = 'gzip'
+        """
+        config = dict(self.app.config.get_namespace('GRPC_SERVER_OPTIONS_'))
+        maximum_concurrent_rpcs = config.pop('maximum_concurrent_rpcs', None)
+        compression = config.pop('compression', None)
+        if isinstance(compression, str):
+            if compression.lower() not in COMPRESSIONS:
+                raise exceptions.ConfigException(
+                    f'unknown GRPC_SERVER_OPTIONS_COMPRESSION: {compression!r}, '
+                    f'expected one of: {", ".join(COMPRESSIONS)}'
+                )
+            compression = COMPRESSIONS[compression.lower()]
+
+        options = {CHANNEL_ARGUMENTS.get(k, f'grpc.{k}'): v for k, v in config.items()}
+        if self.prefork:
+            options['grpc.so_reuseport'] = 1
+
+        return {
+            'options': list(options.items()),
+            'maximum_concurrent_rpcs': maximum_concurrent_rpcs,
+            'compression': compression,
+        }
+
+    def make_executor(self):
+        config = dict(self.app.config.get_namespace('GRPC_PRIORITY_'))
+        if config.pop('enabled', False):
+            if not self.aio:
+                return PriorityThreadPoolExecutor(max_workers=self.workers, **config)
+            logger.warning('GRPC_PRIORITY_ENABLED is ignored in asyncio mode, calls are handled in FIFO order')
+        return TimedThreadPoolExecutor(max_workers=self.workers)
+
+    def make_server(self):
+        kwargs = self.make_server_kwargs()
+        executor = self.make_executor()
+        if self.aio:
+            # 普通(非 async def)的 handler 仍然在线程池中执行
+            server = grpc.aio.server(migration_thread_pool=executor, **kwargs)
+        else:
+            server = grpc.server(executor, **kwargs)
+        server.add_insecure_port(self.addrport)
+        return server
 
     def run(self):
+        self.setup_gc()
+        if self.prefork:
+            return Master(self).run()
+
+        quit_command = 'CTRL-BREAK' if sys.platform == 'win32' else 'CONTROL-C'
+        sys.stdout.write(f"Starting development server at {self.addrport}\n Quit the server with {quit_command}.\n")
+        self.write_extension_report()
+        return self.serve()
+
+    def write_extension_report(self):
+        report = self.app.extension_report()
+        if report:
+            sys.stdout.write(f" Extensions initialized: {report}\n")
+
+    def serve(self):
+        if self.aio:
+            return asyncio.run(self.serve_async())
+
+        servicers = self.make_servicers()
+        start = time.perf_counter()
+        for name, method, stub, _ in self.warmup(servicers):
+            self._check_warmup_request(name, method, stub)
+        self._warmed_up(start)
+        self.freeze_gc()
+        self.server = self.make_server()
         for name, (add_func, servicer) in self.app.servicers.items():
-            add_func(servicer(), self.server)
+            add_func(servicers[name], self.server)
         self.server.start()
-        signals.server_started.send(self)
         self.register_signal()
-        quit_command = 'CTRL-BREAK' if sys.platform == 'win32' else 'CONTROL-C'
-        sys.stdout.write(f"Starting development server at {self.addrport}\n Quit the server with {quit_command}.\n")
-        while not self._stopped:
-            time.sleep(1)
-        signals.server_stopped.send(self)
+        self.start_config_watcher()
+        self.start_recycler()
+        self.notify_ready()
+        self.app.call_extension_hook('on_server_start')
+        signals.server_started.send(self)
+        self.server.wait_for_termination()
+        self._terminated()
         return True
 
+    async def serve_async(self):
+        servicers = self.make_servicers()
+        self.check_async_servicers(servicers)
+        start = time.perf_counter()
+        for name, method, stub, rv in self.warmup(servicers):
+            if inspect.isawaitable(rv):
+                try:
+                    await rv
+                except Exception:
+                    logger.exception(f'warmup request {name}.{method} failed')
+                    continue
+            self._check_warmup_request(name, method, stub)
+        self._warmed_up(start)
+        self.freeze_gc()
+        self.server = self.make_server()
+        for name, (add_func, servicer) in self.app.servicers.items():
+            add_func(servicers[name], self.server)
+        await self.server.start()
+        self._loop = asyncio.get_running_loop()
+        self.register_async_signal()
+        self.start_config_watcher()
+        self.start_recycler()
+        self.notify_ready()
+        self.app.call_extension_hook('on_server_start')
+        signals.server_started.send(self)
+        await self.server.wait_for_termination()
+        self._terminated()
+        return True
+
+    def make_servicers(self):
+        return {name: servicer() for name, (add_func, servicer) in self.app.servicers.items()}
+
+    @staticmethod
+    def check_async_servicers(servicers):
+        """
+        grpc.aio 不支持 handler 的 experimental_thread_pool, @bulkhead 和 GRPC_BULKHEADS 不会生效
+        """
+        for name, servicer in servicers.items():
+            for attr, method in inspect.getmembers(type(servicer), inspect.isfunction):
+                if getattr(method, 'experimental_thread_pool', None) is not None:
+                    raise exceptions.ConfigException(
+                        f'bulkhead executor is not supported in asyncio mode: {name}.{attr}'
+                    )
+
+    def warmup_requests(self):
+        requests = self.app.config.get('WARMUP_REQUESTS')
+        if isinstance(requests, str):
+            requests = import_obj(requests)
+        if callable(requests):
+            requests = requests()
+        return requests or ()
+
+    def warmup(self, servicers):
+        """
+        创建 grpc server(绑定端口)之前预热, 避免扩容后最初的调用承担懒加载, 连接池创建等开销:
+        调用扩展的 warmup(app) 钩子和 server_warmup 信号, 然后在进程内(不经过网络)依次执行
+        WARMUP_REQUESTS 中录制的请求, 经过中间件和 servicer 的完整处理流程.
+        多进程模式下每个 worker 各自预热, server_started 信号在预热完成之后发送
+
+        WARMUP_REQUESTS = [
+            ('GreeterServicer', 'SayHello', helloworld_pb2.HelloRequest(name='warmup')),
+            ('GreeterServicer', 'SayHello', helloworld_pb2.HelloRequest(), {'x-user': '1'}),  # 带 metadata
+        ]
+        WARMUP_REQUESTS = 'helloworld.warmup.requests'  # 模块中的列表, 或返回列表的函数
+
+        返回 [(servicer 名, 方法名, stub, 返回值)], async 方法的返回值需要 await
+        """
+        self.app.call_extension_hook('warmup')
+        signals.server_warmup.send(self)
+
+        rv = []
+        for name, method, request, *metadata in self.warmup_requests():
+            if name not in servicers:
+                logger.warning(f'warmup request {name}.{method} skipped: unknown servicer {name}')
+                continue
+            stub = Stub(servicers[name])
+            try:
+                rv.append((name, method, stub, getattr(stub, method)(request, *metadata)))
+            except Exception:
+                logger.exception(f'warmup request {name}.{method} failed')
+        return rv
+
+    @staticmethod
+    def _check_warmup_request(name, method, stub):
+        if stub.ctx.code != grpc.StatusCode.OK:
+            logger.warning(f'warmup request {name}.{method} returned {stub.ctx.code}: {stub.ctx.details}')
+
+    def _warmed_up(self, start):
+        self.warmup_time = time.perf_counter() - start
+        logger.info(f'server warmed up in {self.warmup_time:.3f}s')
+
+    def setup_gc(self):
+        """
+        GC_THRESHOLD = (50000, 20, 20)  # gc.set_threshold 的参数, 调高第 0 代阈值减少回收次数
+        GC_STATS = True  # 统计回收次数和停顿时间, 见 binwen.gcstats.gc_stats
+        GC_FREEZE = True  # 预热之后(多进程模式下 fork 之前也会)调用 gc.freeze(), 也可以用 Server(gc_freeze=True)
+        """
+        threshold = self.app.config['GC_THRESHOLD']
+        if threshold:
+            gc.set_threshold(*threshold)
+        if self.app.config['GC_STATS']:
+            gc_stats.install()
+
+    def freeze_gc(self):
+        if self.gc_freeze:
+            # 多进程模式下的 worker 不先回收, 避免释放从主进程继承的内存触发 copy-on-write
+            frozen = freeze_gc(collect=not self.prefork)
+            logger.info(f'gc frozen, {frozen} objects in the permanent generation')
+
+    def start_config_watcher(self):
+        # 多进程模式下由主进程检查并通知 worker 重新加载, 见 binwen.prefork.Master
+        if self.app.config.get('CONFIG_RELOAD') and not self.prefork:
+            self.config_watcher = ConfigWatcher(self.app, reload=self.reload).start()
+
+    def start_recycler(self):
+        recycler = WorkerRecycler.from_config(self)
+        if not recycler.enabled:
+            return
+        if not self.prefork:
+            logger.warning('GRPC_MAX_REQUESTS/GRPC_MAX_RSS only take effect with multiple processes, '
+                           'recycling a single process would close the port until it is restarted')
+            return
+        self.recycler = recycler.start()
+
+    def recycle(self):
+        """
+        回收当前 worker: 通知主进程拉起新的 worker, 新的 worker 开始接收调用后主进程发送 SIGTERM 优雅停止当前 worker,
+        在这之前当前 worker 继续接收调用, 见 binwen.recycle.WorkerRecycler
+        """
+        self.recycled = True
+        self.notify_master('recycle')
+
+    @property
+    def draining(self):
+        return self._draining_at is not None
+
+    def drain_threadsafe(self):
+        # 在其它线程中停止, asyncio 模式下在事件循环中调用 drain
+        if self.aio:
+            self._loop.call_soon_threadsafe(self.drain)
+        else:
+            self.drain()
+
+    def drain(self, grace=None):
+        """
+        停止接收新的调用，进行中的调用处理完成(或超过 grace 秒)后服务退出
+        """
+        if self._draining_at is not None:
+            return
+
+        if grace is None:
+            grace = self.app.config['GRPC_GRACE']
+        self._draining_at = time.monotonic()
+        logger.info(f'draining server, {tracker.inflight} calls in flight, grace: {grace}s')
+        signals.server_draining.send(self)
+        stopping = self.server.stop(grace)
+        if self.aio:
+            asyncio.ensure_future(stopping)
+
+    def _terminated(self):
+        self._stopped = True
+        if self.config_watcher is not None:
+            self.config_watcher.stop()
+        if self.recycler is not None:
+            self.recycler.stop()
+        if self._draining_at is not None:
+            self.drain_time = time.monotonic() - self._draining_at
+            logger.info(f'server drained in {self.drain_time:.3f}s')
+        if gc_stats.installed:
+            stats = gc_stats.snapshot()
+            logger.info(f"gc collections: {stats['collections']}, pause total: {sum(stats['pause_total']):.3f}s, "
+                        f"max: {stats['pause_max'] * 1000:.1f}ms")
+        self.app.call_extension_hook('on_server_stop')
+        signals.server_stopped.send(self)
+
     def setup_logger(self):
         fmt = self.app.config['GRPC_LOG_FORMAT']
         lvl = self.app.config['GRPC_LOG_LEVEL']
-        h = self.app.config['GRPC_LOG_HANDLER']
+        h = self.log_handler = self.app.config['GRPC_LOG_HANDLER']
         h.setFormatter(logging.Formatter(fmt))
         logger = logging.getLogger()
         logger.setLevel(lvl)
         logger.addHandler(h)
 
+    def on_config_changed(self, app, old, new):
+        """
+        GRPC_LOG_LEVEL 和 GRPC_LOG_FORMAT 热加载后立即生效, GRPC_LOG_HANDLER 修改后需要重启
+        """
+        if new['GRPC_LOG_LEVEL'] != old['GRPC_LOG_LEVEL']:
+            logging.getLogger().setLevel(new['GRPC_LOG_LEVEL'])
+        if new['GRPC_LOG_FORMAT'] != old['GRPC_LOG_FORMAT']:
+            self.log_handler.setFormatter(logging.Formatter(new['GRPC_LOG_FORMAT']))
+
     def register_signal(self):
         signal.signal(signal.SIGINT, self._stop_handler)
-        signal.signal(signal.SIGHUP, self._stop_handler)
+        signal.signal(signal.SIGHUP, self._reload_handler)
         signal.signal(signal.SIGTERM, self._stop_handler)
         signal.signal(signal.SIGQUIT, self._stop_handler)
 
+    def register_async_signal(self):
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGQUIT):
+            loop.add_signal_handler(signum, self.drain)
+        loop.add_signal_handler(signal.SIGHUP, self.reload)
+
+    def reload(self):
+        """
+        SIGHUP: 在进程内重新加载配置, 不关闭端口, 不中断连接, 缓存等进程状态保留;
+        失败(如修改了 static_config_keys 中的配置项)时保留原来的配置. 多进程模式见 binwen.prefork.Master
+        """
+        try:
+            self.app.reload_config()
+        except Exception:
+            logger.exception('config reload failed, keeping the current config')
+            return False
+        logger.info('config reloaded')
+        return True
+
+    def notify_ready(self):
+        # 多进程模式下通知主进程当前 worker 已经预热完成并开始接收调用
+        self.notify_master('ready')
+
+    def notify_master(self, message):
+        """
+        多进程模式下通过管道通知主进程, 一行 `<message> <pid>`, 见 binwen.prefork.Master.handle_message
+        """
+        if self.master_fd is None:
+            return
+        try:
+            os.write(self.master_fd, f'{message} {os.getpid()}\n'.encode())
+        except OSError:
+            logger.exception(f'failed to notify master: {message}')
+
+    def _reload_handler(self, signum, frame):
+        self.reload()
+
     def _stop_handler(self, signum, frame):
-        grace = self.app.config['GRPC_GRACE']
-        self.server.stop(grace)
-        time.sleep(grace or 1)
-        self._stopped = True
+        self.drain()
@@ -1,30 +1,283 @@
+import inspect
+import threading
+from fnmatch import fnmatchcase
 from types import FunctionType
 from functools import wraps
 
-from binwen import current_app
+from binwen import current_app, exceptions
+from binwen.executors import get_bulkhead
+from binwen.globals import RequestContext
+from binwen.middleware import MiddlewareMixin
+from binwen.utils.functional import get_handler_name
 
 
-def wrap_handler(handler):
+class CallTracker:
+    """
+    统计当前进程中正在处理(in-flight)以及已处理的调用数, 流式返回的调用在迭代结束之前都计入 in-flight
+
+    with tracker:
+        handler(servicer, request, context)
+    """
+
+    def __init__(self):
+        self.inflight = 0
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        with self._lock:
+            self.inflight += 1
+            self.total += 1
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self._lock:
+            self.inflight -= 1
+
+
+tracker = CallTracker()
+
+
+def exempt_middleware(*middlewares):
+    """
+    servicer 的方法不经过指定的中间件, 不指定时不经过任何中间件
+
+    class HealthServicer(health_pb2_grpc.HealthServicer, metaclass=ServicerMeta):
+
+        @exempt_middleware()
+        def Check(self, request, context):
+            ...
+
+        @exempt_middleware('binwen.middleware.ServiceLogMiddleware')
+        def Watch(self, request, context):
+            ...
+    """
+    def decorator(func):
+        func.__bwexempt__ = {_middleware_name(m) for m in middlewares} or None
+        return func
+    return decorator
+
+
+def _middleware_name(middleware):
+    if isinstance(middleware, str):
+        return middleware
+    return f'{middleware.__module__}.{middleware.__name__}'
+
+
+def _match(name, patterns):
+    return any(fnmatchcase(name, p) for p in patterns)
+
+
+def select_middlewares(handler, middlewares, scopes=None):
+    """
+    按 @exempt_middleware 和 MIDDLEWARE_SCOPES 配置筛选 handler 需要经过的中间件，
+    scopes 中的 include/exclude 按 `Servicer.Method` 做通配符匹配
+
+    MIDDLEWARE_SCOPES = {
+        'app.middleware.AuthMiddleware': {
+            'include': ['UserServicer.*', 'OrderServicer.*'],
+            'exclude': ['*.Ping'],
+        },
+    }
+    """
+    if hasattr(handler, '__bwexempt__') and handler.__bwexempt__ is None:
+        return ()
+
+    exempt = getattr(handler, '__bwexempt__', ())
+    scopes = scopes or {}
+    method = get_handler_name(handler)
+
+    selected = []
+    for m in middlewares:
+        name = _middleware_name(m)
+        if name in exempt:
+            continue
+        scope = scopes.get(name)
+        if scope:
+            if 'include' in scope and not _match(method, scope['include']):
+                continue
+            if _match(method, scope.get('exclude', ())):
+                continue
+        selected.append(m)
+    return tuple(selected)
+
+
+def _overrides(middleware, name):
+    return getattr(middleware, name) is not getattr(MiddlewareMixin, name)
+
+
+def _fuse(handler, befores, afters):
+    if not befores and not afters:
+        return handler
+
+    def fused(servicer, request, context):
+        for before in befores:
+            request, context = before(servicer, request, context)
+        response = handler(servicer, request, context)
+        for after in afters:
+            response = after(servicer, response)
+        return response
+
+    return fused
+
+
+def _fuse_async(handler, befores, afters):
+    if not befores and not afters:
+        return handler
+
+    async def fused(servicer, request, context):
+        for before in befores:
+            request, context = before(servicer, request, context)
+        response = await handler(servicer, request, context)
+        for after in afters:
+            response = after(servicer, response)
+        return response
+
+    return fused
+
+
+def compile_handler(app, handler, middlewares):
+    """
+    把中间件链编译成一个可调用对象, middlewares 中靠前的在内层
+
+    只重写了 before_handler/after_handler 的中间件不再各自包一层，连续的这类中间件的钩子合并到
+    同一个函数中依次调用，没有重写的钩子直接跳过；重写了 __call__(async handler 为 __acall__)
+    的中间件保持原来的嵌套调用
+    """
+    is_async = inspect.iscoroutinefunction(handler)
+    call_name = '__acall__' if is_async else '__call__'
+    fuse = _fuse_async if is_async else _fuse
+
     h = handler
+    befores, afters = (), ()
+    for m in middlewares:
+        if is_async and _overrides(m, '__call__') and not _overrides(m, '__acall__'):
+            raise exceptions.ConfigException(
+                f'middleware {m.__module__}.{m.__name__} does not support async handler: {handler.__qualname__}'
+            )
+
+        if _overrides(m, call_name):
+            h = fuse(h, befores, afters)
+            befores, afters = (), ()
+            middleware = m(app, h, handler)
+            h = middleware.__acall__ if is_async else middleware
+            continue
 
-    for m in current_app.middlewares:
-        h = m(current_app, h, handler)
+        middleware = m(app, h, handler)
+        if _overrides(m, 'before_handler'):
+            befores = (middleware.before_handler, ) + befores
+        if _overrides(m, 'after_handler'):
+            afters = afters + (middleware.after_handler, )
 
-    @wraps(handler)
-    def wrapped(self, request, context):
-        return h(self, request, context)
+    return fuse(h, befores, afters)
+
+
+def wrap_handler(handler):
+    app = current_app._get_current_object()
+    middlewares = select_middlewares(handler, current_app.middlewares, current_app.config.get('MIDDLEWARE_SCOPES'))
+    h = compile_handler(current_app, handler, middlewares)
+
+    if inspect.iscoroutinefunction(handler) or inspect.isasyncgenfunction(handler):
+        if get_bulkhead(handler) is not None:
+            raise exceptions.ConfigException(
+                f'bulkhead executor does not support async handler: {handler.__qualname__}'
+            )
+
+    if inspect.isasyncgenfunction(handler):
+        # 流式返回的 async handler, grpc.aio 按 async generator 迭代 wrapped, 整个迭代过程都在 RequestContext 中
+        @wraps(handler)
+        async def wrapped(self, request, context):
+            token = RequestContext(request, context, app).push()
+            try:
+                with tracker:
+                    async for response in h(self, request, context):
+                        yield response
+            finally:
+                RequestContext.pop(token)
+
+        return wrapped
+
+    if inspect.iscoroutinefunction(handler):
+        @wraps(handler)
+        async def wrapped(self, request, context):
+            token = RequestContext(request, context, app).push()
+            try:
+                with tracker:
+                    return await h(self, request, context)
+            finally:
+                RequestContext.pop(token)
+
+        return wrapped
+
+    if inspect.isgeneratorfunction(handler):
+        # 流式返回的 handler, 每次迭代时设置 RequestContext, 两次迭代之间以及调用方提前结束迭代时不会遗留在线程中
+        @wraps(handler)
+        def wrapped(self, request, context):
+            ctx = RequestContext(request, context, app)
+            with tracker:
+                token = ctx.push()
+                try:
+                    responses = iter(h(self, request, context))
+                finally:
+                    RequestContext.pop(token)
+                try:
+                    while True:
+                        token = ctx.push()
+                        try:
+                            response = next(responses)
+                        except StopIteration:
+                            return
+                        finally:
+                            RequestContext.pop(token)
+                        yield response
+                finally:
+                    close = getattr(responses, 'close', None)
+                    if close is not None:
+                        token = ctx.push()
+                        try:
+                            close()
+                        finally:
+                            RequestContext.pop(token)
+    else:
+        @wraps(handler)
+        def wrapped(self, request, context):
+            token = RequestContext(request, context, app).push()
+            try:
+                with tracker:
+                    return h(self, request, context)
+            finally:
+                RequestContext.pop(token)
+
+    executor = get_bulkhead(handler)
+    if executor is not None:
+        wrapped = executor.bind(wrapped)
 
     return wrapped
 
 
 class ServicerMeta(type):
+    """
+    定义 servicer 类时只记录其中的 handler, 第一次实例化(注册到 grpc server)时才按当前 app 的中间件配置
+    包装 handler 并缓存在类上, 导入 servicer 模块不依赖已经创建好的 app
+    """
+    _wrap_lock = threading.RLock()
+
     def __new__(cls, name, bases, kws):
-        _kws = {}
-        for k, v in kws.items():
-            if isinstance(v, FunctionType):
-                v = wrap_handler(v)
-            _kws[k] = v
-        cls_obj = super().__new__(cls, name, bases, _kws)
+        cls_obj = super().__new__(cls, name, bases, kws)
         cls_obj.__isbwservicercls__ = True
+        cls_obj.__bwhandlers__ = {k: v for k, v in kws.items() if isinstance(v, FunctionType)}
+        cls_obj.__bwwrapped__ = False
         return cls_obj
 
+    def __call__(cls, *args, **kwargs):
+        if not cls.__dict__['__bwwrapped__']:
+            cls.wrap_handlers()
+        return super().__call__(*args, **kwargs)
+
+    def wrap_handlers(cls):
+        with cls._wrap_lock:
+            for klass in reversed(cls.__mro__):
+                if not isinstance(klass, ServicerMeta) or klass.__dict__['__bwwrapped__']:
+                    continue
+                for k, v in klass.__bwhandlers__.items():
+                    setattr(klass, k, wrap_handler(v))
+                klass.__bwwrapped__ = True
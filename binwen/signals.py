@@ -1,5 +1,8 @@
 import blinker
 
 
+server_warmup = blinker.signal('server_warmup')
 server_started = blinker.signal('server_started')
+server_draining = blinker.signal('server_draining')
 server_stopped = blinker.signal('server_stopped')
+config_changed = blinker.signal('config_changed')
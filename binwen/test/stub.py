@@ -19,6 +19,9 @@ class Context:
     def invocation_metadata(self):
         return self.metadata
 
+    def time_remaining(self):
+        return None
+
 
 class Stub:
 
@@ -1,4 +1,28 @@
-from threading import RLock
+from threading import Lock, RLock
+
+# 正在计算的 (id(instance), name) -> 锁, 计算完成后即删除, 只有第一次计算时才会用到
+_locks = {}
+_locks_lock = Lock()
+
+
+def _compute_once(instance, name, lookup, store, func):
+    key = (id(instance), name)
+    with _locks_lock:
+        lock = _locks.setdefault(key, RLock())
+
+    with lock:
+        try:
+            # 等待锁期间其他线程可能已经计算完成
+            return lookup(instance)
+        except (KeyError, AttributeError):
+            pass
+        try:
+            value = func(instance)
+            store(instance, value)
+            return value
+        finally:
+            with _locks_lock:
+                _locks.pop(key, None)
 
 
 class SafeCachedProperty:
@@ -15,22 +39,68 @@ class SafeCachedProperty:
     assert ins.cached_count == 0
     ins.count = 10
     assert ins.cached_count == 0
+
+    非数据描述符: 计算结果保存在 instance.__dict__ 中，之后的访问直接命中 __dict__ 不再经过描述符，
+    只有第一次计算时按实例和属性加锁，不同实例之间互不影响
     """
     def __init__(self, func, name=None, doc=None):
         self.func = func
         self.__doc__ = doc or getattr(func, '__doc__')
         self.name = name or func.__name__
-        self.lock = RLock()
 
     def __get__(self, instance, cls=None):
-        with self.lock:
-            if instance is None:
-                return self
-            try:
-                return instance.__dict__[self.name]
-            except KeyError:
-                res = instance.__dict__[self.name] = self.func(instance)
-                return res
+        if instance is None:
+            return self
+        try:
+            return instance.__dict__[self.name]
+        except KeyError:
+            return _compute_once(instance, self.name, self._lookup, self._store, self.func)
+
+    def _lookup(self, instance):
+        return instance.__dict__[self.name]
+
+    def _store(self, instance, value):
+        instance.__dict__[self.name] = value
+
+
+class SlotsCachedProperty:
+    """
+    用于定义了 __slots__ 的类, 计算结果保存在 slot 中(默认为 `_<属性名>`)，需要在 __slots__ 中声明
+
+    class Point:
+        __slots__ = ('x', 'y', '_norm')
+
+        @slots_cached_property
+        def norm(self):
+            return math.hypot(self.x, self.y)
+    """
+    def __init__(self, func, slot=None, doc=None):
+        self.func = func
+        self.__doc__ = doc or getattr(func, '__doc__')
+        self.name = func.__name__
+        self.slot = slot or f'_{func.__name__}'
+        self.member = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.member = getattr(owner, self.slot, None)
+        if self.member is None or not hasattr(self.member, '__set__'):
+            raise TypeError(f'{owner.__name__}.__slots__ must declare {self.slot!r} to cache {name!r}')
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        try:
+            return self.member.__get__(instance, cls)
+        except AttributeError:
+            return _compute_once(instance, self.name, self.member.__get__, self.member.__set__, self.func)
+
+    def __set__(self, instance, value):
+        self.member.__set__(instance, value)
+
+    def __delete__(self, instance):
+        self.member.__delete__(instance)
 
 
 cached_property = SafeCachedProperty
+slots_cached_property = SlotsCachedProperty
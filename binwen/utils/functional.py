@@ -85,6 +85,15 @@ def import_obj(import_name):
         raise ImportError(e)
 
 
+def get_handler_name(handler):
+    """
+    返回 servicer 方法的名字 `Servicer.Method`
+
+    get_handler_name(GreeterServicer.SayHello) -> 'GreeterServicer.SayHello'
+    """
+    return '.'.join(handler.__qualname__.split('.')[-2:])
+
+
 class Singleton(type):
     """
     class A(metaclass=utils.Singleton):
@@ -1,10 +1,19 @@
 import os
 import re
 import time
+import queue
 import fcntl
+import atexit
 import logging
+import weakref
+import threading
 from logging.config import dictConfig
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
+
+_listeners = []
+_reporters = weakref.WeakSet()
+_flusher = None
+_flusher_lock = threading.Lock()
 
 
 def has_level_handler(logger):
@@ -23,6 +32,186 @@ def has_level_handler(logger):
     return False
 
 
+class DeferredQueueHandler(QueueHandler):
+    """
+    直接把 LogRecord 放进队列，不在调用线程中格式化，格式化和输出都在 QueueListener 的线程中完成
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def enqueue_handlers(logger, default_handler=None, propagate=None):
+    """
+    把 logger 的 handler 移到后台线程中执行，调用线程只负责把未格式化的 LogRecord 放进队列,
+    logger 没有 handler 时使用 default_handler; propagate 为 None 时不修改 logger.propagate
+
+    enqueue_handlers(logging.getLogger('binwen.access'), logging.StreamHandler(), propagate=False)
+    """
+    if any(isinstance(h, DeferredQueueHandler) for h in logger.handlers):
+        return logger
+
+    handlers = logger.handlers[:] or ([default_handler] if default_handler else [])
+    q = queue.SimpleQueue()
+    listener = QueueListener(q, *handlers, respect_handler_level=True)
+    logger.handlers = [DeferredQueueHandler(q)]
+    if propagate is not None:
+        logger.propagate = propagate
+    listener.start()
+    _listeners.append(listener)
+    return logger
+
+
+class ForwardHandler(logging.Handler):
+    """
+    把 LogRecord 交给另一个 logger 的 handler 处理; parent 为 True 时交给 logger 的上级 logger,
+    上级 logger 在输出时才确定, 之后才配置的上级 logger(如 `binwen`)及其 handler 同样生效
+    """
+
+    def __init__(self, logger, parent=False):
+        super().__init__()
+        self.logger = logger
+        self.parent = parent
+
+    def emit(self, record):
+        logger = self.logger.parent if self.parent else self.logger
+        if logger is not None:
+            logger.handle(record)
+
+
+class ErrorReporter:
+    """
+    按异常类型和抛出位置合并相同的异常: 第一次出现时输出完整的 traceback，之后每 interval 秒最多输出一次
+    这段时间内出现的次数, 不会因为依赖的服务故障而在每次调用时都格式化、输出 traceback
+
+    日志经 `<logger>.errors` 在后台线程中格式化后交给 logger 的 handler 输出
+
+    reporter = ErrorReporter(app.logger, interval=60)
+    try:
+        ...
+    except Exception as e:
+        reporter.report(e)
+
+    之后不再出现的异常, 由后台线程在 interval 到期后输出剩余的次数, 进程退出时(stop_listeners)也会输出
+    """
+    # 不同的异常数超过该值时输出剩余的次数后清空统计，防止占用过多内存
+    max_keys = 1024
+    # 后台线程检查剩余次数的间隔(秒)
+    flush_interval = 1
+
+    def __init__(self, logger, interval=60):
+        self.interval = interval
+        self.logger = enqueue_handlers(
+            logging.getLogger(f'{logger.name}.errors'), ForwardHandler(logger), propagate=False
+        )
+        self._seen = {}
+        self._lock = threading.Lock()
+        _reporters.add(self)
+
+    @staticmethod
+    def key(exc):
+        tb = exc.__traceback__
+        if tb is None:
+            return type(exc), None, None
+        while tb.tb_next is not None:
+            tb = tb.tb_next
+        return type(exc), tb.tb_frame.f_code.co_filename, tb.tb_lineno
+
+    def report(self, exc):
+        """
+        返回是否输出了日志
+        """
+        key = self.key(exc)
+        now = time.monotonic()
+        evicted = []
+        with self._lock:
+            entry = self._seen.get(key)
+            if entry is None:
+                if len(self._seen) >= self.max_keys:
+                    evicted = self._pending(now, force=True)
+                    self._seen.clear()
+                # [上次输出的时间, 之后出现的次数, 最后一次异常的 args]; 不保留异常对象, 不让 traceback 引用的栈帧一直存活,
+                # 输出次数时才转换为文本
+                self._seen[key] = [now, 0, None]
+            else:
+                entry[1] += 1
+                entry[2] = exc.args
+                if now - entry[0] < self.interval:
+                    start_flusher()
+                    return False
+                count, elapsed = entry[1], now - entry[0]
+                entry[0], entry[1], entry[2] = now, 0, None
+
+        for args in evicted:
+            self.log_count(*args)
+        if entry is None:
+            self.logger.error('%s', exc, exc_info=exc)
+        else:
+            self.log_count(key, count, elapsed, exc.args)
+        return True
+
+    def log_count(self, key, count, elapsed, args):
+        exc_type, filename, lineno = key
+        # 与 BaseException.__str__ 相同
+        message = '' if not args else str(args[0]) if len(args) == 1 else str(args)
+        self.logger.error(
+            '%s at %s:%s occurred %d times in the last %.0fs, last: %s',
+            exc_type.__name__, filename, lineno, count, elapsed, message
+        )
+
+    def flush(self, force=False):
+        """
+        输出 interval 到期(force 为 True 时不论是否到期)且还没有输出的次数, 返回输出的条数
+        """
+        now = time.monotonic()
+        with self._lock:
+            pending = self._pending(now, force)
+
+        for args in pending:
+            self.log_count(*args)
+        return len(pending)
+
+    def _pending(self, now, force):
+        # 调用时持有 self._lock
+        pending = []
+        for key, entry in self._seen.items():
+            if entry[1] and (force or now - entry[0] >= self.interval):
+                pending.append((key, entry[1], now - entry[0], entry[2]))
+                entry[0], entry[1], entry[2] = now, 0, None
+        return pending
+
+
+def _flush_reporters():
+    while True:
+        time.sleep(ErrorReporter.flush_interval)
+        for reporter in list(_reporters):
+            reporter.flush()
+
+
+def start_flusher():
+    """
+    启动输出剩余次数的后台线程, fork 出来的子进程中第一次合并异常时重新启动
+    """
+    global _flusher
+    if _flusher is not None and _flusher.is_alive():
+        return
+    with _flusher_lock:
+        if _flusher is None or not _flusher.is_alive():
+            _flusher = threading.Thread(target=_flush_reporters, name='binwen-error-reporter', daemon=True)
+            _flusher.start()
+
+
+@atexit.register
+def stop_listeners():
+    """
+    输出合并的异常剩余的次数和队列中剩余的日志, 并停止后台线程
+    """
+    for reporter in list(_reporters):
+        reporter.flush(force=True)
+    while _listeners:
+        _listeners.pop().stop()
+
+
 DEFAULT_LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -11,5 +11,5 @@ def f1(name, **kwargs):
 @cli.command('plusone')
 @cli.option('-n', '--number', type=int)
 def f2(number, **kwargs):
-    app = current_app
-    app.config['NUMBER'] = number + 1
+    with current_app.update_config() as config:
+        config['NUMBER'] = number + 1
@@ -1,46 +1,101 @@
 # Generated by the gRPC Python protocol compiler plugin. DO NOT EDIT!
+"""Client and server classes corresponding to protobuf-defined services."""
 import grpc
+import warnings
 
 from helloworld.proto import helloword2_pb2 as helloworld_dot_proto_dot_helloword2__pb2
 
+GRPC_GENERATED_VERSION = '1.84.0'
+GRPC_VERSION = grpc.__version__
+_version_not_supported = False
 
-class GreeterStub(object):
-  """The greeting service definition.
-  """
+try:
+    from grpc._utilities import first_version_is_lower
+    _version_not_supported = first_version_is_lower(GRPC_VERSION, GRPC_GENERATED_VERSION)
+except ImportError:
+    _version_not_supported = True
 
-  def __init__(self, channel):
-    """Constructor.
+if _version_not_supported:
+    raise RuntimeError(
+        f'The grpc package installed is at version {GRPC_VERSION},'
+        + ' but the generated code in helloworld/proto/helloword2_pb2_grpc.py depends on'
+        + f' grpcio>={GRPC_GENERATED_VERSION}.'
+        + f' Please upgrade your grpc module to grpcio>={GRPC_GENERATED_VERSION}'
+        + f' or downgrade your generated code using grpcio-tools<={GRPC_VERSION}.'
+    )
 
-    Args:
-      channel: A grpc.Channel.
+
+class GreeterStub:
+    """The greeting service definition.
     """
-    self.SayHello = channel.unary_unary(
-        '/helloworld2.Greeter/SayHello',
-        request_serializer=helloworld_dot_proto_dot_helloword2__pb2.HelloRequest.SerializeToString,
-        response_deserializer=helloworld_dot_proto_dot_helloword2__pb2.HelloReply.FromString,
-        )
 
+    def __init__(self, channel):
+        """Constructor.
+
+        Args:
+            channel: A grpc.Channel.
+        """
+        self.SayHello = channel.unary_unary(
+                '/helloworld2.Greeter/SayHello',
+                request_serializer=helloworld_dot_proto_dot_helloword2__pb2.HelloRequest.SerializeToString,
+                response_deserializer=helloworld_dot_proto_dot_helloword2__pb2.HelloReply.FromString,
+                _registered_method=True)
 
-class GreeterServicer(object):
-  """The greeting service definition.
-  """
 
-  def SayHello(self, request, context):
-    """Sends a greeting
+class GreeterServicer:
+    """The greeting service definition.
     """
-    context.set_code(grpc.StatusCode.UNIMPLEMENTED)
-    context.set_details('Method not implemented!')
-    raise NotImplementedError('Method not implemented!')
+
+    def SayHello(self, request, context):
+        """Sends a greeting
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
 
 
 def add_GreeterServicer_to_server(servicer, server):
-  rpc_method_handlers = {
-      'SayHello': grpc.unary_unary_rpc_method_handler(
-          servicer.SayHello,
-          request_deserializer=helloworld_dot_proto_dot_helloword2__pb2.HelloRequest.FromString,
-          response_serializer=helloworld_dot_proto_dot_helloword2__pb2.HelloReply.SerializeToString,
-      ),
-  }
-  generic_handler = grpc.method_handlers_generic_handler(
-      'helloworld2.Greeter', rpc_method_handlers)
-  server.add_generic_rpc_handlers((generic_handler,))
+    rpc_method_handlers = {
+            'SayHello': grpc.unary_unary_rpc_method_handler(
+                    servicer.SayHello,
+                    request_deserializer=helloworld_dot_proto_dot_helloword2__pb2.HelloRequest.FromString,
+                    response_serializer=helloworld_dot_proto_dot_helloword2__pb2.HelloReply.SerializeToString,
+            ),
+    }
+    generic_handler = grpc.method_handlers_generic_handler(
+            'helloworld2.Greeter', rpc_method_handlers)
+    server.add_generic_rpc_handlers((generic_handler,))
+    server.add_registered_method_handlers('helloworld2.Greeter', rpc_method_handlers)
+
+
+ # This class is part of an EXPERIMENTAL API.
+class Greeter:
+    """The greeting service definition.
+    """
+
+    @staticmethod
+    def SayHello(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/helloworld2.Greeter/SayHello',
+            helloworld_dot_proto_dot_helloword2__pb2.HelloRequest.SerializeToString,
+            helloworld_dot_proto_dot_helloword2__pb2.HelloReply.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
@@ -1,5 +1,8 @@
+import os
 import sys
+import types
 import logging
+import threading
 from unittest import mock
 
 import pytest
@@ -39,9 +42,9 @@ def test_baseapp(caplog):
         servicers.helloworld_pb2_grpc.add_GreeterServicer_to_server,
         servicers.GreeterServicer)
 
+    _app._extensions = {'celeryapp': extensions.celeryapp}
     with pytest.raises(exceptions.ConfigException):
-        _app._register_extension('celeryapp', extensions.celeryapp)
-        _app._register_extension('celeryapp', extensions.celeryapp)
+        _app.load_extensions_in_module(extensions)
     _app._extensions = {}
     _app.load_extensions_in_module(extensions)
     ext = _app.extensions.celeryapp
@@ -50,3 +53,190 @@ def test_baseapp(caplog):
     with caplog.at_level(logging.DEBUG):
         _app.logger.debug('test')
         assert caplog.text
+
+
+def test_extension_hooks():
+    calls = []
+
+    class Ext:
+        def __init__(self, name):
+            self.name = name
+
+        def init_app(self, app):
+            calls.append((self.name, 'init_app'))
+
+        def before_fork(self, app):
+            calls.append((self.name, 'before_fork'))
+
+        def after_fork_child(self, app):
+            calls.append((self.name, 'after_fork_child'))
+
+        def on_server_start(self, app):
+            calls.append((self.name, 'on_server_start'))
+
+    class InitOnly:
+        def init_app(self, app):
+            pass
+
+    _app = app.BaseApp('./tests/demo', env='test')
+    _app.load_extensions_in_module(types.SimpleNamespace(a=Ext('a'), b=Ext('b'), c=InitOnly()))
+    assert calls == [('a', 'init_app'), ('b', 'init_app')]
+
+    calls.clear()
+    _app.call_extension_hook('on_server_start')
+    _app.call_extension_hook('on_server_stop')
+    assert calls == [('a', 'on_server_start'), ('b', 'on_server_start')]
+
+    calls.clear()
+    _app.call_extension_hook('before_fork')
+    _app.call_extension_hook('after_fork_child')
+    assert calls == [('b', 'before_fork'), ('a', 'before_fork'), ('a', 'after_fork_child'), ('b', 'after_fork_child')]
+
+    # fork 钩子只在 fork worker 时调用(见 binwen.prefork.Master.spawn_worker), 其它 fork 不触发
+    calls.clear()
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0 if not calls else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+    assert not calls
+
+
+def test_extension_dependencies():
+    db_started, calls = threading.Event(), []
+
+    class Ext:
+        def __init__(self, name, depends_on=(), lazy_init=False):
+            self.name = name
+            self.depends_on = depends_on
+            self.lazy_init = lazy_init
+            self.value = name
+
+        def init_app(self, app):
+            if self.name == 'db':
+                db_started.set()
+            elif self.name == 'cache':
+                # db 和 cache 互不依赖, 并发初始化
+                assert db_started.wait(5)
+            calls.append(self.name)
+
+        def on_server_start(self, app):
+            calls.append(f'{self.name}.start')
+
+    _app = app.BaseApp('./tests/demo', env='test')
+    _app.config['EXTENSION_INIT_WORKERS'] = 4
+    _app.load_extensions_in_module(types.SimpleNamespace(
+        db=Ext('db'),
+        cache=Ext('cache'),
+        search=Ext('search', depends_on=('db', 'cache')),
+        report=Ext('report', depends_on=('search', ), lazy_init=True),
+    ))
+    assert sorted(calls[:2]) == ['cache', 'db']
+    assert calls[2:] == ['search']
+    assert list(_app.extension_init_times) == calls
+    assert 'report (lazy)' in _app.extension_report()
+
+    calls.clear()
+    _app.call_extension_hook('on_server_start')
+    assert calls == ['cache.start', 'db.start', 'search.start']
+
+    calls.clear()
+    assert _app.extensions.report.value == 'report'
+    assert _app.extensions.report.value == 'report'
+    assert calls == ['report']
+    assert 'report' in _app.extension_init_times
+    assert 'lazy' not in _app.extension_report()
+    assert type(_app.extensions.report) is Ext
+
+
+def test_lazy_extension_direct_access():
+    calls = []
+
+    class Ext:
+        lazy_init = True
+
+        def __init__(self, name, depends_on=()):
+            self.name = name
+            self.depends_on = depends_on
+
+        def init_app(self, app):
+            calls.append(self.name)
+            # init_app 中访问自身的属性不会再次触发初始化
+            self.value = self.name.upper()
+
+    module = types.SimpleNamespace(db=Ext('db'), cache=Ext('cache', depends_on=('db', )))
+    _app = app.BaseApp('./tests/demo', env='test')
+    _app.load_extensions_in_module(module)
+    assert calls == []
+    assert 'cache (lazy)' in _app.extension_report()
+
+    # `from extensions import cache` 直接导入的对象在第一次访问属性时初始化, 依赖先初始化
+    cache = module.cache
+    assert _app.extensions.cache is cache
+    assert cache.value == 'CACHE'
+    assert calls == ['db', 'cache']
+    assert type(cache) is Ext and type(module.db) is Ext
+    assert module.db.value == 'DB'
+    assert calls == ['db', 'cache']
+
+
+def test_extension_serial_init():
+    calls = []
+
+    class Ext:
+        def __init__(self, name, *depends_on):
+            self.name = name
+            self.depends_on = depends_on
+
+        def init_app(self, app):
+            calls.append((self.name, threading.current_thread() is threading.main_thread()))
+
+        def on_server_start(self, app):
+            calls.append(self.name)
+
+    # 默认在主线程中依次初始化, 依赖在前, 其余按名字排序
+    _app = app.BaseApp('./tests/demo', env='test')
+    _app.load_extensions_in_module(types.SimpleNamespace(a=Ext('a', 'c'), b=Ext('b'), c=Ext('c')))
+    assert calls == [('c', True), ('a', True), ('b', True)]
+
+    # 之后加载的扩展模块可以依赖之前的扩展, 钩子按所有模块的加载顺序调用
+    calls.clear()
+    _app._extensions = {}
+    _app.load_extensions_in_module(types.SimpleNamespace(d=Ext('d', 'b')))
+    assert calls == [('d', True)]
+    calls.clear()
+    _app.call_extension_hook('on_server_start')
+    assert calls == ['c', 'a', 'b', 'd']
+
+
+def test_extension_dependency_errors():
+    class Ext:
+        def __init__(self, *depends_on):
+            self.depends_on = depends_on
+
+        def init_app(self, app):
+            pass
+
+    _app = app.BaseApp('./tests/demo', env='test')
+    with pytest.raises(exceptions.ConfigException, match='unknown extension: c'):
+        _app.load_extensions_in_module(types.SimpleNamespace(a=Ext('c')))
+
+    with pytest.raises(exceptions.ConfigException, match='cycle: a -> b -> a'):
+        _app.load_extensions_in_module(types.SimpleNamespace(a=Ext('b'), b=Ext('a')))
+
+
+def test_load_modules_importing_proxies(tmp_path, monkeypatch):
+    package = tmp_path / 'proxyapp'
+    package.mkdir()
+    (package / '__init__.py').write_text('')
+    (package / 'servicers.py').write_text(
+        'from binwen import current_request, current_context, current_metadata, current_config\n'
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    _app = app.BaseApp('./tests/demo', env='test')
+    _app.config['INSTALLED_APPS'] = ['proxyapp']
+    # 启动时这些代理没有绑定对象, 加载 servicer 和扩展时跳过, 不抛出 RuntimeError
+    assert _app.load_servicers_in_app() == {}
+    module = sys.modules['proxyapp.servicers']
+    assert _app.load_extensions_in_module(module) == {}
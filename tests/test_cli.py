@@ -13,6 +13,16 @@ def test_server(app):
     with mock.patch('binwen.commands.Server', autospec=True) as mocked:
         assert cli.main() == 0
         mocked.return_value.run.assert_called_with()
+        assert mocked.call_args[1]['workers'] == app.config['GRPC_WORKERS']
+        assert mocked.call_args[1]['processes'] == app.config['GRPC_PROCESSES']
+        assert mocked.call_args[1]['gc_freeze'] is None
+
+    sys.argv = 'bw run -w 8 -p 2 --gc-freeze'.split()
+    with mock.patch('binwen.commands.Server', autospec=True) as mocked:
+        assert cli.main() == 0
+        assert mocked.call_args[1]['workers'] == 8
+        assert mocked.call_args[1]['processes'] == 2
+        assert mocked.call_args[1]['gc_freeze'] is True
 
 
 def test_shell(app):
@@ -117,7 +127,8 @@ def test_cli_command(app):
         def load(self):
             @cli.cli.command('xyz')
             def f2(**kwargs):
-                app.config['XYZ'] = 'hello'
+                with app.update_config() as config:
+                    config['XYZ'] = 'hello'
             return f2
 
     def new_entry_iter(name):
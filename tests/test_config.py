@@ -1,7 +1,16 @@
 import os
 import json
+import time
+from unittest import mock
 
-from binwen.config import ConfigAttribute, Config
+import pytest
+
+from binwen.app import BaseApp
+from binwen.config import ConfigAttribute, Config, FrozenConfig, DEFAULT_CONFIG
+from binwen.exceptions import ConfigException
+from binwen.globals import RequestContext, current_config
+from binwen.reloader import ConfigWatcher
+from binwen.signals import config_changed
 
 TEST_KEY = 'foo'
 SECRET_KEY = 'config'
@@ -16,7 +25,8 @@ def common_object_test(app):
 
 
 def test_config_from_object(app):
-    app.config.from_object(__name__)
+    with app.update_config() as config:
+        config.from_object(__name__)
     common_object_test(app)
 
 
@@ -44,27 +54,31 @@ def test_config_from_class(app):
     assert 'TEST_KEY' in d
     s = repr(config)
     assert '<Config' in s
-    app.config.from_object(Test)
+    with app.update_config() as config:
+        config.from_object(Test)
     common_object_test(app)
 
 
 def test_config_from_json(app):
     current_dir = os.path.dirname(os.path.abspath(__file__))
-    app.config.from_json(os.path.join(current_dir, 'config.json'))
+    with app.update_config() as config:
+        config.from_json(os.path.join(current_dir, 'config.json'))
     common_object_test(app)
 
 
 def test_config_from_mapping(app):
-    app.config.from_mapping({
-        'SECRET_KEY': 'config',
-        'TEST_KEY': 'foo'
-    })
+    with app.update_config() as config:
+        config.from_mapping({
+            'SECRET_KEY': 'config',
+            'TEST_KEY': 'foo'
+        })
     common_object_test(app)
 
-    app.config.from_mapping(
-        SECRET_KEY='config',
-        TEST_KEY='foo'
-    )
+    with app.update_config() as config:
+        config.from_mapping(
+            SECRET_KEY='config',
+            TEST_KEY='foo'
+        )
     common_object_test(app)
 
 
@@ -78,3 +92,184 @@ def test_config_attribute():
     assert 'foo' in a.x
     a.x = json.dumps({'a': 1})
     assert 'a' in a.config['n_x']
+
+
+def test_frozen_config(app):
+    assert isinstance(app.config, FrozenConfig)
+    config = app.config
+    with pytest.raises(TypeError):
+        config['TEST_KEY'] = 'bar'
+    with pytest.raises(TypeError):
+        config.test_key = 'bar'
+    with pytest.raises(TypeError):
+        config.from_mapping({'TEST_KEY': 'bar'})
+
+    with app.update_config() as new:
+        new['TEST_KEY'] = 'bar'
+        new['GRPC_SERVER_OPTIONS_A'] = 1
+        # 退出前 app.config 不变
+        assert 'TEST_KEY' not in app.config
+
+    assert isinstance(app.config, FrozenConfig)
+    assert app.config is not config
+    assert 'TEST_KEY' not in config
+    assert app.config['TEST_KEY'] == app.config['test_key'] == app.config.test_key == 'bar'
+    assert 'test_key' in app.config
+    namespace = app.config.get_namespace('GRPC_SERVER_OPTIONS_')
+    assert namespace == {'a': 1}
+    assert app.config.get_namespace('GRPC_SERVER_OPTIONS_') is namespace
+
+
+def test_frozen_config_attribute():
+    calls = []
+
+    def converter(value):
+        calls.append(value)
+        return json.loads(value)
+
+    class App:
+        x = ConfigAttribute('n_x', converter)
+
+    a = App()
+    a.config = FrozenConfig({'n_x': json.dumps({'foo': 'bar'}), 'keys': 1})
+    assert a.x == a.x == {'foo': 'bar'}
+    assert len(calls) == 1
+    assert a.config.keys() == {'N_X', 'KEYS'}
+    assert a.config.KEYS == 1
+    with pytest.raises(TypeError):
+        a.x = '{}'
+
+
+def test_config_from_env():
+    config = Config(DEFAULT_CONFIG)
+    config['RATIO'] = 0.5
+    config['HOSTS'] = ('a', )
+    config['ENV_TYPES'] = {'NEW_PORT': int}
+    environ = {
+        'BINWEN_GRPC_WORKERS': '16',
+        'BINWEN_DEBUG': 'yes',
+        'BINWEN_RATIO': '0.75',
+        'BINWEN_INSTALLED_APPS': 'users, orders',
+        'BINWEN_HOSTS': '["b", "c"]',
+        'BINWEN_GRPC_BULKHEADS': '{"ReportServicer": {"max_workers": 2}}',
+        'BINWEN_TIMEZONE': '8',
+        'BINWEN_NEW_NUMBER': '10',
+        'BINWEN_NEW_PORT': '6380',
+        'BINWEN_NEW_NAME': 'hello',
+        'BINWEN_lower': 'ignored',
+        'BINWEN_ENV': 'prod',
+        'BINWEN_MASTER_FD': '7',
+        'OTHER_GRPC_WORKERS': '1',
+    }
+    config.from_env(environ=environ)
+    assert config['GRPC_WORKERS'] == 16
+    assert config['DEBUG'] is True
+    assert config['RATIO'] == 0.75
+    assert config['INSTALLED_APPS'] == ['users', 'orders']
+    assert config['HOSTS'] == ('b', 'c')
+    assert config['GRPC_BULKHEADS'] == {'ReportServicer': {'max_workers': 2}}
+    assert config['TIMEZONE'] == '8'
+    # 没有默认值的配置项不猜测类型, 声明了类型时按声明转换
+    assert config['NEW_NUMBER'] == '10'
+    assert config['NEW_PORT'] == 6380
+    assert config['NEW_NAME'] == 'hello'
+    assert 'LOWER' not in config
+    # 框架自身使用的环境变量不作为配置项
+    assert 'ENV' not in config and 'MASTER_FD' not in config
+
+    config.from_env(prefix='APP_', environ={'APP_GRPC_WORKERS': '4'})
+    assert config['GRPC_WORKERS'] == 4
+
+    with pytest.raises(ConfigException):
+        config.from_env(environ={'BINWEN_DEBUG': 'maybe'})
+    with pytest.raises(ConfigException):
+        config.from_env(environ={'BINWEN_GRPC_WORKERS': 'many'})
+    with pytest.raises(ConfigException):
+        config.from_env(environ={'BINWEN_GRPC_LOG_HANDLER': 'logging.FileHandler'})
+    with pytest.raises(ConfigException):
+        config.from_env(environ={'BINWEN_NEW_PORT': 'x'})
+
+
+def test_reload_config(app, tmp_path):
+    path = tmp_path / 'config.json'
+    path.write_text(json.dumps({'RELOAD_VALUE': 1}))
+    with app.update_config() as config:
+        config['CONFIG_JSON'] = str(path)
+
+    changes = []
+
+    def on_changed(sender, old, new):
+        changes.append((old, new))
+
+    config_changed.connect(on_changed)
+    try:
+        with mock.patch.dict(os.environ, {'BINWEN_CONFIG_JSON': str(path)}):
+            old = app.config
+            ctx = RequestContext(None, None, app)
+            token = ctx.push()
+            try:
+                new = app.reload_config()
+                # 进行中的调用通过 current_config 读取的仍然是调用开始时的配置
+                assert current_config._get_current_object() is old
+                assert app.config is new
+            finally:
+                RequestContext.pop(token)
+
+            assert app.config is new
+            assert isinstance(new, FrozenConfig)
+            assert new['RELOAD_VALUE'] == 1
+            assert changes == [(old, new)]
+
+            path.write_text(json.dumps({'RELOAD_VALUE': 'text'}))
+            with pytest.raises(ConfigException):
+                app.reload_config()
+            path.write_text(json.dumps({'INSTALLED_APPS': []}))
+            with pytest.raises(ConfigException):
+                app.reload_config()
+            assert app.config is new
+            assert len(changes) == 1
+    finally:
+        config_changed.disconnect(on_changed)
+
+
+def test_reload_config_keeps_runtime_keys(app):
+    class App(BaseApp):
+        def ready(self):
+            self.config['READY_VALUE'] = 'ready'
+            self.config.setdefault('PRO_NAME', 'ready')
+
+    _app = App(app.root_path, env=app.env)
+    _app.config = _app.load_config()
+    _app.ready()
+    _app.freeze_config()
+    with _app.update_config() as config:
+        config['UPDATED_VALUE'] = 1
+
+    # ready() 和 update_config 中添加的配置项不在配置文件中, 热加载后沿用当前的值
+    new = _app.reload_config()
+    assert new['READY_VALUE'] == 'ready'
+    assert new['UPDATED_VALUE'] == 1
+    assert new['PRO_NAME'] == 'demo'
+
+
+def test_config_watcher(app, tmp_path):
+    path = tmp_path / 'config.json'
+    path.write_text(json.dumps({'RELOAD_VALUE': 1}))
+    with app.update_config() as config:
+        config['CONFIG_JSON'] = str(path)
+
+    watcher = ConfigWatcher(app, interval=0.01)
+    assert str(path) in watcher.paths()
+    assert any(p.endswith(os.path.join('config', 'test.py')) for p in watcher.paths())
+    assert not watcher.check()
+
+    with mock.patch.dict(os.environ, {'BINWEN_CONFIG_JSON': str(path)}):
+        path.write_text(json.dumps({'RELOAD_VALUE': 2}))
+        os.utime(path, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+        assert watcher.check()
+        assert app.config['RELOAD_VALUE'] == 2
+
+        path.write_text('{invalid')
+        os.utime(path, ns=(time.time_ns(), time.time_ns() + 2 * 10 ** 9))
+        assert not watcher.check()
+        assert app.config['RELOAD_VALUE'] == 2
@@ -0,0 +1,153 @@
+import time
+import threading
+from unittest import mock
+
+import grpc
+
+from binwen.executors import (
+    BulkheadExecutor, PriorityThreadPoolExecutor, TimedThreadPoolExecutor,
+    bulkhead, get_bulkhead, priority, queue_wait, queue_stats
+)
+from binwen.pb2 import default_pb2
+from binwen.test.stub import Context
+
+
+def test_bulkhead_executor():
+    executor = BulkheadExecutor('test', max_workers=1, max_queue=1)
+    event = threading.Event()
+    waiting = [executor.submit(event.wait), executor.submit(event.wait)]
+    assert executor.pending == 2
+
+    handler = executor.bind(lambda servicer, request, context: 'ok')
+    assert handler.experimental_thread_pool is executor
+
+    ctx = Context()
+    ret = executor.submit(handler, None, None, ctx).result()
+    assert isinstance(ret, default_pb2.Empty)
+    assert ctx.code is grpc.StatusCode.RESOURCE_EXHAUSTED
+    assert executor.rejected == 1
+
+    event.set()
+    for f in waiting:
+        f.result()
+    ctx = Context()
+    assert executor.submit(handler, None, None, ctx).result() == 'ok'
+    assert ctx.code is grpc.StatusCode.OK
+    executor.shutdown()
+    assert executor.pending == 0
+
+
+def test_get_bulkhead(app):
+    with app.update_config() as config:
+        config['GRPC_BULKHEADS'] = {
+            'ReportServicer.Generate': {'max_workers': 2, 'max_queue': 4},
+            'ExportServicer': {'max_workers': 1},
+        }
+
+    class ReportServicer:
+        def Generate(self, request, context):
+            pass
+
+        def Lookup(self, request, context):
+            pass
+
+        @bulkhead(max_workers=3)
+        def Heavy(self, request, context):
+            pass
+
+    class ExportServicer:
+        def Csv(self, request, context):
+            pass
+
+        def Json(self, request, context):
+            pass
+
+    executor = get_bulkhead(ReportServicer.Generate)
+    assert executor.max_pending == 6
+    assert get_bulkhead(ReportServicer.Generate) is executor
+    assert get_bulkhead(ReportServicer.Lookup) is None
+    assert get_bulkhead(ReportServicer.Heavy).max_pending == 3
+    assert get_bulkhead(ExportServicer.Csv) is get_bulkhead(ExportServicer.Json)
+
+
+class FakeRpcEvent:
+    def __init__(self, priority=None):
+        self.invocation_metadata = (('x-priority', priority),) if priority is not None else ()
+
+
+blocking = threading.Event()
+
+
+def block(event):
+    # 唯一的 worker 开始执行之后再提交其他任务，保证它们都在队列中排序
+    blocking.set()
+    event.wait()
+    blocking.clear()
+
+
+def test_priority_executor():
+    executor = PriorityThreadPoolExecutor(max_workers=1, aging=10)
+    event = threading.Event()
+    order = []
+    blocker = executor.submit(block, event)
+    assert blocking.wait(5)
+
+    @priority(3)
+    def handler():
+        pass
+
+    def run(name, *args):
+        order.append(name)
+
+    futs = [
+        executor.submit(run, 'default', FakeRpcEvent()),
+        executor.submit(run, 'low', FakeRpcEvent('-1')),
+        executor.submit(run, 'method', FakeRpcEvent(), handler),
+        executor.submit(run, 'high', FakeRpcEvent('5')),
+        executor.submit(run, 'invalid', FakeRpcEvent('x')),
+        executor.submit(run, 'overflow', FakeRpcEvent('1000')),
+    ]
+    event.set()
+    blocker.result()
+    for f in futs:
+        f.result()
+    assert order == ['overflow', 'high', 'method', 'default', 'invalid', 'low']
+    executor.shutdown()
+
+
+def test_priority_executor_aging():
+    executor = PriorityThreadPoolExecutor(max_workers=1, aging=1)
+    event = threading.Event()
+    order = []
+    blocker = executor.submit(block, event)
+    assert blocking.wait(5)
+
+    def run(name, *args):
+        order.append(name)
+
+    # 排队 3 秒的低优先级调用排在刚提交的高一级的调用前面
+    with mock.patch('time.monotonic', return_value=100):
+        low = executor.submit(run, 'low')
+    with mock.patch('time.monotonic', return_value=103):
+        high = executor.submit(run, 'high', FakeRpcEvent('1'))
+
+    event.set()
+    for f in (blocker, low, high):
+        f.result()
+    assert order == ['low', 'high']
+    executor.shutdown()
+
+
+def test_queue_wait():
+    executor = TimedThreadPoolExecutor(max_workers=1)
+    count = queue_stats.count
+    event = threading.Event()
+    executor.submit(event.wait)
+    waiting = executor.submit(queue_wait)
+    time.sleep(0.05)
+    event.set()
+    assert waiting.result() >= 0.05
+    assert queue_stats.count == count + 2
+    assert queue_stats.max >= 0.05
+    assert queue_wait() is None
+    executor.shutdown()
@@ -0,0 +1,56 @@
+import pytest
+
+from binwen.limiter import AIMDLimiter, GradientLimiter, create_limiter
+
+
+def test_limiter_acquire():
+    limiter = AIMDLimiter(initial_limit=2)
+    assert limiter.acquire()
+    assert limiter.acquire()
+    assert not limiter.acquire()
+    assert limiter.inflight == 2
+    assert limiter.rejected == 1
+
+    limiter.release(0.01)
+    assert limiter.inflight == 1
+    assert limiter.acquire()
+
+
+def test_aimd_limiter():
+    limiter = AIMDLimiter(initial_limit=10, min_limit=2, max_limit=11, backoff_ratio=0.5, timeout=0.1)
+    for _ in range(6):
+        limiter.acquire()
+    limiter.release(0.01)
+    assert limiter.limit == 11
+    limiter.release(0.01)
+    assert limiter.limit == 11
+
+    limiter.release(0.5)
+    assert limiter.limit == 5
+    limiter.release(0.5)
+    limiter.release(0.5)
+    assert limiter.limit == 2
+
+
+def test_gradient_limiter():
+    limiter = GradientLimiter(initial_limit=20, max_limit=100, smoothing=0.5)
+    for _ in range(200):
+        limiter.acquire()
+        limiter.inflight = 20
+        limiter.release(0.01)
+    grown = limiter.limit
+    assert grown > 20
+
+    for _ in range(50):
+        limiter.inflight = grown
+        limiter.release(1.0)
+    assert limiter.limit < grown
+
+
+def test_create_limiter():
+    assert isinstance(create_limiter(), AIMDLimiter)
+    limiter = create_limiter(algorithm='gradient', initial_limit=5)
+    assert isinstance(limiter, GradientLimiter)
+    assert limiter.limit == 5
+    with pytest.raises(KeyError):
+        create_limiter(algorithm='unknown')
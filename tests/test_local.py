@@ -1,5 +1,11 @@
 import copy
-from binwen.local import LocalProxy
+import asyncio
+import inspect
+from contextvars import ContextVar
+
+import pytest
+
+from binwen.local import LocalProxy, global_proxy
 
 
 def test_std_class_attributes():
@@ -171,3 +177,52 @@ def test_deepcopy_on_proxy():
 
     assert copy.deepcopy(p2) == [a]
     assert copy.deepcopy(p2)[0] is not a
+
+
+def test_global_proxy():
+    namespace = {'app': None}
+    p = global_proxy(namespace, 'app')
+    assert not p
+
+    namespace['app'] = [1]
+    assert p == [1]
+    assert len(p) == 1
+    namespace['app'] = {'a': 1}
+    assert p['a'] == 1
+
+
+def test_context_var_proxy():
+    class Request:
+        def __init__(self, name):
+            self.name = name
+
+    var = ContextVar('request')
+    p = LocalProxy(var, name='request')
+    assert not p
+    assert repr(p) == '<LocalProxy unbound>'
+    with pytest.raises(RuntimeError):
+        p.name
+    # 没有绑定对象时 __class__ 返回代理自身的类型, inspect.getmembers(module, inspect.isclass) 等不会抛出异常
+    assert p.__class__ is LocalProxy
+    assert not isinstance(p, type)
+    assert not inspect.isclass(p)
+
+    class Ctx:
+        def __init__(self, name):
+            self.request = Request(name)
+
+    async def handle(name):
+        var.set(Ctx(name))
+        await asyncio.sleep(0)
+        return p.name
+
+    async def main():
+        return await asyncio.gather(*(handle(i) for i in range(3)))
+
+    assert asyncio.run(main()) == [0, 1, 2]
+
+    token = var.set(Ctx('x'))
+    assert p.name == 'x'
+    assert isinstance(p, Request)
+    var.reset(token)
+    assert not p
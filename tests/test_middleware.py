@@ -1,5 +1,17 @@
+import asyncio
+import logging
+from concurrent import futures
 from unittest import mock
-from binwen.middleware import MiddlewareMixin, GuardMiddleware
+
+import grpc
+import pytest
+
+from binwen.limiter import AIMDLimiter
+from binwen.middleware import (
+    MiddlewareMixin, GuardMiddleware, DeadlineMiddleware, ConcurrencyLimitMiddleware, AccessLogMiddleware
+)
+from binwen.pb2 import default_pb2
+from binwen.utils.functional import get_handler_name
 
 
 class FakeInMiddleware(MiddlewareMixin):
@@ -44,5 +56,237 @@ def test_base_middleware(app):
         ]
 
     ctx = mock.MagicMock()
-    ret = h(None, 1, ctx)
+    with mock.patch.object(GuardMiddleware.reporter, 'report') as report:
+        ret = h(None, 1, ctx)
+    assert ctx.set_code.called
+    assert isinstance(report.call_args[0][0], ValueError)
+
+
+def test_base_middleware_async(app):
+    async def async_handler(servicer, request, context):
+        if request is not None:
+            raise ValueError
+        return context
+
+    h = FakeInMiddleware(app, async_handler, async_handler).__acall__
+    h = FakeOutMiddleware(app, h, async_handler).__acall__
+    h = GuardMiddleware(app, h, async_handler).__acall__
+
+    ret = asyncio.run(h(None, None, {'msg': ''}))
+    assert ret['msg'].strip().split('\n') == [
+        'Out.before_handler',
+        'In.before_handler',
+        'In.after_handler',
+        'Out.after_handler'
+        ]
+
+    ctx = mock.MagicMock()
+    asyncio.run(h(None, 1, ctx))
     assert ctx.set_code.called
+
+
+def test_deadline_middleware(app):
+    called = []
+
+    def h(servicer, request, context):
+        called.append(request)
+        return 'ok'
+
+    m = DeadlineMiddleware(app, h, h)
+    ctx = mock.MagicMock()
+    ctx.time_remaining.return_value = 0.5
+    assert m(None, 1, ctx) == 'ok'
+
+    ctx.time_remaining.return_value = 0
+    assert isinstance(m(None, 2, ctx), default_pb2.Empty)
+    ctx.set_code.assert_called_with(grpc.StatusCode.DEADLINE_EXCEEDED)
+    assert called == [1]
+    assert DeadlineMiddleware.rejected >= 1
+
+    # 多个线程同时拒绝时计数不丢失
+    rejected = DeadlineMiddleware.rejected
+    with futures.ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda i: m(None, i, ctx), range(400)))
+    assert DeadlineMiddleware.rejected == rejected + 400
+
+
+def test_concurrency_limit_middleware(app):
+    def h(servicer, request, context):
+        return m(servicer, request - 1, context) if request else 'ok'
+
+    with mock.patch.object(ConcurrencyLimitMiddleware, 'limiter', AIMDLimiter(initial_limit=2, max_limit=2)):
+        m = ConcurrencyLimitMiddleware(app, h, h)
+        ctx = mock.MagicMock()
+        assert m(None, 1, ctx) == 'ok'
+        assert not ctx.set_code.called
+
+        ret = m(None, 2, ctx)
+        assert isinstance(ret, default_pb2.Empty)
+        ctx.set_code.assert_called_with(grpc.StatusCode.RESOURCE_EXHAUSTED)
+        assert m.limiter.rejected == 1
+        assert m.limiter.inflight == 0
+
+
+def test_middleware_config_changed(app):
+    def h(servicer, request, context):
+        return default_pb2.Empty()
+
+    logger = logging.getLogger('binwen.access')
+    level = logger.level
+    try:
+        with mock.patch.object(GuardMiddleware, 'reporter', None), \
+                mock.patch.object(ConcurrencyLimitMiddleware, 'limiter', None), \
+                mock.patch.object(AccessLogMiddleware, 'logger', None):
+            guard = GuardMiddleware(app, h, h)
+            limit = ConcurrencyLimitMiddleware(app, h, h)
+            access = AccessLogMiddleware(app, h, h)
+            limiter = limit.limiter
+            assert access.logger.isEnabledFor(logging.INFO)
+
+            # 热加载的配置对已经创建的 reporter, limiter 和访问日志生效
+            with app.update_config() as config:
+                config['ERROR_REPORT_INTERVAL'] = 5
+                config['ACCESS_LOG_LEVEL'] = 'WARNING'
+            assert guard.reporter.interval == 5
+            assert not access.logger.isEnabledFor(logging.INFO)
+            assert limit.limiter is limiter
+
+            with app.update_config() as config:
+                config['CONCURRENCY_LIMIT_INITIAL_LIMIT'] = 7
+            assert limit.limiter is not limiter
+            assert limit.limiter.limit == 7
+    finally:
+        logger.setLevel(level)
+
+
+def test_access_log_middleware(app):
+    records = []
+
+    class Capture(logging.Handler):
+        def emit(self, record):
+            records.append(record)
+
+    logger = logging.getLogger('binwen.test.access')
+    logger.setLevel(logging.INFO)
+    logger.addHandler(Capture())
+
+    def h(servicer, request, context):
+        return default_pb2.Empty()
+
+    with mock.patch.object(AccessLogMiddleware, 'logger', logger):
+        m = AccessLogMiddleware(app, h, h)
+        ctx = mock.MagicMock()
+        ctx.code.return_value = None
+        assert isinstance(m(None, default_pb2.Empty(), ctx), default_pb2.Empty)
+
+        logger.setLevel(logging.WARNING)
+        m(None, default_pb2.Empty(), ctx)
+
+    assert len(records) == 1
+    record = records[0]
+    assert record.method == get_handler_name(h)
+    assert record.code == grpc.StatusCode.OK
+    assert record.duration_ms >= 0
+    assert record.request_size == record.response_size == 0
+    # 调用线程中不格式化大小, 在 getMessage 时才转换为字符串
+    assert not any(isinstance(arg, str) for arg in record.args[-2:])
+    assert record.getMessage().endswith('request=0B response=0B')
+
+
+def test_access_log_error(app):
+    """
+    handler 抛出异常时在外层的中间件设置状态码之前记录访问日志, 状态码不能是 OK
+    """
+    from binwen import exceptions
+
+    records = []
+
+    class Capture(logging.Handler):
+        def emit(self, record):
+            records.append(record)
+
+    logger = logging.getLogger('binwen.test.access_error')
+    logger.setLevel(logging.INFO)
+    logger.addHandler(Capture())
+
+    class NotFound(exceptions.RpcException):
+        code = grpc.StatusCode.NOT_FOUND
+
+    def h(servicer, request, context):
+        raise request
+
+    async def ah(servicer, request, context):
+        raise request
+
+    ctx = mock.MagicMock()
+    ctx.code.return_value = None
+    with mock.patch.object(AccessLogMiddleware, 'logger', logger):
+        m = AccessLogMiddleware(app, h, h)
+        for e in (ValueError(), NotFound()):
+            with pytest.raises(type(e)):
+                m(None, e, ctx)
+        am = AccessLogMiddleware(app, ah, ah)
+        with pytest.raises(ValueError):
+            asyncio.run(am.__acall__(None, ValueError(), ctx))
+
+    assert [r.code for r in records] == [
+        grpc.StatusCode.INTERNAL, grpc.StatusCode.NOT_FOUND, grpc.StatusCode.INTERNAL
+    ]
+    assert records[0].response_size is None
+    # request 不是 protobuf 消息, 也没有 response
+    assert records[0].getMessage().endswith('request=- response=-')
+
+
+def test_access_log_level(app):
+    """
+    经过 Server.setup_logger(root 为 GRPC_LOG_LEVEL=WARNING) 之后访问日志仍然输出到 GRPC_LOG_HANDLER,
+    上级 logger 的 handler 在后台线程中执行
+    """
+    import threading
+    import time
+    from io import StringIO
+    from binwen.server import Server
+
+    stream = StringIO()
+    with app.update_config() as config:
+        config['GRPC_LOG_HANDLER'] = logging.StreamHandler(stream)
+
+    threads = []
+
+    class Capture(logging.Handler):
+        def emit(self, record):
+            threads.append(threading.current_thread())
+
+    logger = logging.getLogger('binwen.access')
+    root = logging.getLogger()
+    level, handlers, propagate, root_level, root_handlers = (
+        logger.level, logger.handlers[:], logger.propagate, root.level, root.handlers[:]
+    )
+
+    def h(servicer, request, context):
+        return default_pb2.Empty()
+
+    try:
+        logger.setLevel(logging.NOTSET)
+        logger.handlers = []
+        logger.propagate = True
+        Server(app, processes=2)
+        assert root.level == logging.WARNING
+        root.addHandler(Capture())
+
+        with mock.patch.object(AccessLogMiddleware, 'logger', None):
+            m = AccessLogMiddleware(app, h, h)
+            assert m.logger.isEnabledFor(logging.INFO)
+            ctx = mock.MagicMock()
+            ctx.code.return_value = None
+            m(None, default_pb2.Empty(), ctx)
+        for _ in range(200):
+            if threads:
+                break
+            time.sleep(0.01)
+        assert threads and threads[0] is not threading.current_thread()
+        assert f'{get_handler_name(h)} StatusCode.OK' in stream.getvalue()
+    finally:
+        logger.setLevel(level)
+        root.setLevel(root_level)
+        logger.handlers, logger.propagate, root.handlers = handlers, propagate, root_handlers
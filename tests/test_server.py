@@ -1,29 +1,616 @@
+import gc
 import os
+import logging
+import time
+import socket
+import select
+import sys
 import signal
 import threading
 from unittest import mock
 
+import grpc
+import pytest
+
+from binwen.exceptions import ConfigException
 from binwen.server import Server
-from binwen.signals import server_started, server_stopped
+from binwen.executors import BulkheadExecutor, PriorityThreadPoolExecutor, TimedThreadPoolExecutor
+from binwen.gcstats import GCStats, gc_stats
+from binwen.prefork import Master
+from binwen.recycle import WorkerRecycler, RECYCLE_EXIT_CODE, current_rss
+from binwen.servicer import tracker
+from binwen.signals import server_warmup, server_started, server_draining, server_stopped
+
+
+def non_daemon_threads():
+    return sum(not t.daemon for t in threading.enumerate())
 
 
 def test_server(app, log_stream):
+    # 之前的测试可能留下了线程池的空闲线程, 中间件的日志线程是 daemon 线程
+    threads = non_daemon_threads()
     s = Server(app)
     assert not s._stopped
 
     def log_started(s):
         app.logger.warn('started!')
+        os.kill(os.getpid(), signal.SIGINT)
+
+    def log_draining(s):
+        app.logger.warn('draining!')
 
     def log_stopped(s):
         app.logger.warn('stopped!')
 
     server_started.connect(log_started)
+    server_draining.connect(log_draining)
     server_stopped.connect(log_stopped)
 
-    with mock.patch('time.sleep', new=lambda s: os.kill(os.getpid(), signal.SIGINT)):
+    with mock.patch.object(app, 'call_extension_hook') as hook:
+        assert s.run()
+    assert [c[0][0] for c in hook.call_args_list] == ['warmup', 'on_server_start', 'on_server_stop']
+    # grpc 的 cancel_all_calls_after_grace 线程在 server 停止后才退出
+    for _ in range(100):
+        if non_daemon_threads() == threads:
+            break
+        time.sleep(0.01)
+    assert non_daemon_threads() == threads
+    assert s._stopped
+    # 没有进行中的调用时不需要等待 grace 秒
+    assert s.drain_time < app.config['GRPC_GRACE']
+
+    server_started.disconnect(log_started)
+    server_draining.disconnect(log_draining)
+    server_stopped.disconnect(log_stopped)
+
+    content = log_stream.getvalue()
+    assert 'started!' in content and 'draining!' in content and 'stopped!' in content
+
+
+def fake_waitpid(master, steps):
+    """
+    按顺序返回 steps 中的 (pid, status); 信号编号表示主进程这时收到了信号, 函数表示这时执行的操作
+    """
+    steps = iter(steps)
+
+    def waitpid(pid, options):
+        step = next(steps, None)
+        if step is None:
+            raise ChildProcessError
+        if isinstance(step, int):
+            master._signal_handler(step, None)
+            return 0, 0
+        if callable(step):
+            step()
+            return 0, 0
+        return step
+    return waitpid
+
+
+def wait_exit(pid, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        exited, status = os.waitpid(pid, os.WNOHANG)
+        if exited:
+            return os.waitstatus_to_exitcode(status)
+        assert time.monotonic() < deadline, f'process {pid} did not exit'
+        time.sleep(0.01)
+
+
+def test_prefork_master(app):
+    s = Server(app, processes=2)
+    assert s.prefork
+    assert s.server is None
+
+    master = Master(s)
+    steps = [(101, 9), signal.SIGTERM, (102, 0), (103, 0)]
+    with mock.patch('os.fork', side_effect=[101, 102, 103]) as fork, \
+            mock.patch('os.waitpid', new=fake_waitpid(master, steps)), \
+            mock.patch('os.kill') as kill, \
+            mock.patch('time.sleep'), \
+            mock.patch('select.select'), \
+            mock.patch('signal.signal'):
+        assert master.run()
+
+    # worker 101 crashed and was replaced by 103, then both got SIGTERM
+    assert fork.call_count == 3
+    assert not master.alive
+    assert not master.workers
+    kill.assert_any_call(103, signal.SIGTERM)
+
+
+def child_pids(pid):
+    pids = []
+    for name in os.listdir('/proc'):
+        try:
+            with open(f'/proc/{name}/stat') as f:
+                stat = f.read()
+        except (OSError, ValueError):
+            continue
+        if int(stat.rsplit(')', 1)[1].split()[1]) == pid:
+            pids.append(int(name))
+    return pids
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self'), reason='requires /proc')
+def test_prefork_process(app):
+    # 真实 fork 出来的主进程: 两个 worker 同时请求回收, 替代者 ready 之后旧的 worker 才停止
+    s = Server(app, processes=2)
+    r, w = os.pipe()
+    pid = os.fork()
+    if not pid:
+        code = 1
+        try:
+            os.close(r)
+            master = Master(s)
+
+            def serve():
+                # fork 时 master.workers 中是已经启动的 worker, 最初的两个 worker 请求回收, 替代者通知 ready
+                message = 'recycle' if len(master.workers) < 2 else 'ready'
+
+                def stop(*args):
+                    os.write(w, f'stop {os.getpid()}\n'.encode())
+                    os._exit(RECYCLE_EXIT_CODE)
+
+                signal.signal(signal.SIGTERM, stop)
+                os.write(w, f'{message} {os.getpid()}\n'.encode())
+                s.notify_master(message)
+                signal.pause()
+
+            s.serve = serve
+            code = 0 if master.run() else 1
+        finally:
+            os._exit(code)
+
+    os.close(w)
+    buffer = b''
+    try:
+        deadline = time.monotonic() + 10
+        while buffer.count(b'stop') < 2:
+            assert select.select([r], [], [], deadline - time.monotonic())[0], 'workers not recycled'
+            data = os.read(r, 4096)
+            assert data, 'master exited'
+            buffer += data
+
+        os.kill(pid, signal.SIGTERM)
+        assert wait_exit(pid) == 0
+    finally:
+        os.close(r)
+        for p in child_pids(pid) + [pid]:
+            try:
+                os.kill(p, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    events = [line.split() for line in buffer.decode().splitlines()]
+
+    # 端口一直有 worker 在监听: 两个 worker 启动之后任何时候都至少有两个 worker
+    live, started = 0, False
+    for event, _ in events:
+        live += -1 if event == 'stop' else 1
+        started = started or live == 2
+        assert not started or live >= 2
+    recycled = {p for e, p in events if e == 'recycle'}
+    assert len(recycled) == 2 and recycled == {p for e, p in events if e == 'stop'}
+
+
+def test_server_warmup(app, log_stream):
+    from helloworld.proto import helloworld_pb2
+
+    with app.update_config() as config:
+        config['WARMUP_REQUESTS'] = [
+            ('GreeterServicer', 'SayHello', helloworld_pb2.HelloRequest(name='warmup')),
+            ('GreeterServicer', 'SayHello', None, {'x-warmup': '1'}),
+            ('Unknown', 'SayHello', None),
+        ]
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    def connect():
+        with socket.create_connection(('127.0.0.1', port), timeout=1):
+            pass
+
+    events = []
+
+    def on_warmup(s):
+        events.append('warmup')
+        # 预热时还没有绑定端口, 连接被拒绝
+        with pytest.raises(ConnectionRefusedError):
+            connect()
+
+    def on_started(s):
+        connect()
+        events.append('started')
+        os.kill(os.getpid(), signal.SIGINT)
+
+    server_warmup.connect(on_warmup)
+    server_started.connect(on_started)
+    s = Server(app, addrport=f'127.0.0.1:{port}')
+    assert s.server is None
+    try:
         assert s.run()
-        assert threading.active_count() == 1
-        assert s._stopped
+    finally:
+        server_warmup.disconnect(on_warmup)
+        server_started.disconnect(on_started)
 
+    assert events == ['warmup', 'started']
+    assert s.warmup_time is not None
     content = log_stream.getvalue()
-    assert 'started!' in content and 'stopped!' in content
+    # servicer 名字写错时只记录警告
+    assert 'unknown servicer Unknown' in content
+    # request 为 None 时 SayHello 抛出异常, 只记录警告
+    assert 'warmup request GreeterServicer.SayHello returned StatusCode.' in content
+
+
+def test_prefork_recycle(app):
+    master = Master(Server(app, processes=2))
+
+    def recycle():
+        # 101 回收前通知主进程, 替代者 103 先启动, 重复的通知忽略
+        master.handle_message('recycle', 101)
+        master.handle_message('recycle', 101)
+        assert master.replacing == {103: 101}
+        assert not kill.called
+
+    def ready():
+        master.handle_message('ready', 103)
+        kill.assert_called_once_with(101, signal.SIGTERM)
+
+    steps = [recycle, ready, (101, RECYCLE_EXIT_CODE << 8), signal.SIGTERM, (102, 0), (103, 0)]
+    with mock.patch('os.fork', side_effect=[101, 102, 103]) as fork, \
+            mock.patch('os.waitpid', new=fake_waitpid(master, steps)), \
+            mock.patch('os.kill') as kill, \
+            mock.patch('time.sleep') as sleep, \
+            mock.patch('select.select'), \
+            mock.patch('signal.signal'):
+        assert master.run()
+
+    assert fork.call_count == 3
+    assert not master.replacing
+    assert not sleep.called
+    kill.assert_any_call(103, signal.SIGTERM)
+
+
+def test_prefork_reload(app):
+    master = Master(Server(app, processes=2))
+
+    def ready():
+        master.handle_message('ready', 101)
+
+    def reloaded():
+        # 只修改了配置: 主进程在主循环中重新加载后转发给 ready 的 worker, 不 fork 新的 worker
+        reload_config.assert_called_once_with()
+        kill.assert_called_once_with(101, signal.SIGHUP)
+        assert master.stale == {102}
+        assert fork.call_count == 2
+
+    def started():
+        # 还在启动的 worker ready 之后再通知它重新加载
+        master.handle_message('ready', 102)
+        kill.assert_called_with(102, signal.SIGHUP)
+        assert not master.stale
+
+    steps = [ready, signal.SIGHUP, reloaded, started, signal.SIGTERM, (101, 0), (102, 0)]
+    with mock.patch('os.fork', side_effect=[101, 102]) as fork, \
+            mock.patch('os.waitpid', new=fake_waitpid(master, steps)), \
+            mock.patch('os.kill') as kill, \
+            mock.patch('select.select'), \
+            mock.patch('signal.signal'), \
+            mock.patch.object(app, 'reload_config') as reload_config:
+        assert master.run()
+    assert master.code_mtimes and not master.code_changed()
+
+    # 配置加载失败时不通知 worker
+    with mock.patch.object(app, 'reload_config', side_effect=ValueError), mock.patch('os.kill') as kill:
+        assert not master.reload()
+    assert not kill.called
+
+
+def test_prefork_fork_hooks(app):
+    master = Master(Server(app, processes=2))
+    with mock.patch.object(app, 'call_extension_hook') as hook, mock.patch('os.fork', return_value=101):
+        assert master.spawn_worker() == 101
+    hook.assert_called_once_with('before_fork')
+
+    # worker 中先调用 after_fork_child 再启动 server
+    calls = []
+    with mock.patch.object(app, 'call_extension_hook', side_effect=calls.append), \
+            mock.patch('os.fork', return_value=0), mock.patch('signal.signal'), \
+            mock.patch('binwen.prefork.stop_listeners'), \
+            mock.patch.object(master.server, 'serve', side_effect=lambda: calls.append('serve')), \
+            mock.patch('os._exit', side_effect=SystemExit) as _exit:
+        with pytest.raises(SystemExit):
+            master.spawn_worker()
+    assert calls == ['before_fork', 'after_fork_child', 'serve']
+    _exit.assert_called_once_with(0)
+
+
+def test_prefork_worker_ignores_sighup(app):
+    # worker 在 Server.register_signal 之前收到转发的 SIGHUP 不能退出
+    master = Master(Server(app, processes=2))
+    pid = master.fork()
+    if pid == 0:
+        os._exit(0 if signal.getsignal(signal.SIGHUP) == signal.SIG_IGN else 1)
+    assert wait_exit(pid) == 0
+
+
+def test_prefork_reexec(app, tmp_path):
+    master = Master(Server(app, processes=2))
+    module = tmp_path / 'reexec_module.py'
+    module.write_text('x = 1\n')
+    master.code_mtimes = {str(module): module.stat().st_mtime_ns}
+    assert not master.code_changed()
+    os.utime(module, ns=(0, 0))
+    assert master.code_changed()
+
+    master.open_channel()
+    r, w = master._channel
+    try:
+        # 代码有修改: fork 并 exec 新的主进程, 不重新加载配置
+        with mock.patch('os.fork', return_value=200), mock.patch.object(app, 'reload_config') as reload_config:
+            assert master.reload()
+        assert master.upgrading == 200 and not reload_config.called
+        with mock.patch('os.fork') as fork:
+            assert not master.reexec()
+        assert not fork.called
+
+        # 新主进程的 worker 都 ready 之后停止当前的 worker, 当前主进程不退出, 之后的 SIGHUP 转发给新主进程
+        master.workers = {101: time.monotonic()}
+        with mock.patch('os.kill') as kill:
+            master.handle_message('ready', 200)
+            kill.assert_called_once_with(101, signal.SIGTERM)
+            assert master.successor == 200 and master.upgrading is None and not master.serving
+            master.worker_exited(101, RECYCLE_EXIT_CODE << 8)
+            master.reload()
+            kill.assert_called_with(200, signal.SIGHUP)
+
+            # 新主进程的代码再次修改时由当前主进程 exec, 另一个新主进程 ready 之后停止 200
+            with mock.patch('os.fork', return_value=201):
+                master.handle_message('upgrade', 200)
+            assert master.upgrading == 201
+            master.handle_message('ready', 201)
+            kill.assert_called_with(200, signal.SIGTERM)
+            assert master.successor == 201
+        master.worker_exited(200, 0)
+        assert master.successor == 201
+        master.worker_exited(201, 0)
+        assert master.successor is None
+
+        # exec 的子进程: 新主进程通过环境变量得到通知当前主进程的管道
+        master.upgrading = None
+        with mock.patch('os.fork', return_value=0), mock.patch('os.close'), mock.patch('os.execve') as execve, \
+                mock.patch('os._exit', side_effect=SystemExit) as _exit, mock.patch('signal.signal'):
+            with pytest.raises(SystemExit):
+                master.reexec()
+        path, argv, env = execve.call_args[0]
+        assert path == sys.executable and env[Master.parent_env] == str(w)
+        assert os.get_inheritable(w)
+        _exit.assert_called_once_with(1)
+
+        # 新主进程: worker 都 ready 之后通知旧的主进程
+        with mock.patch.dict(os.environ, {Master.parent_env: str(w)}):
+            new = Master(Server(app, processes=2))
+        assert new.parent_fd == w and Master.parent_env not in os.environ
+        new.pending_ready = 2
+        new.handle_message('ready', 401)
+        new.handle_message('ready', 402)
+        assert new.pending_ready == 0
+        assert os.read(r, 100) == f'ready {os.getpid()}\n'.encode()
+
+        # 超时没有 ready 时也通知旧的主进程
+        new.pending_ready, new.ready_deadline = 1, time.monotonic() - 1
+        new.check_ready_timeout()
+        assert new.pending_ready == 0 and new.ready_deadline is None
+        assert os.read(r, 100) == f'ready {os.getpid()}\n'.encode()
+
+        # 新主进程的代码有修改时请求旧的主进程 exec
+        new.code_mtimes = {str(module): 0}
+        os.utime(module)
+        with mock.patch('os.fork') as fork:
+            assert new.reload()
+        assert not fork.called
+        assert os.read(r, 100) == f'upgrade {os.getpid()}\n'.encode()
+    finally:
+        master.close_channel()
+
+
+def test_prefork_config_watcher(app):
+    with app.update_config() as config:
+        config['CONFIG_RELOAD'] = True
+
+    # 多进程模式下 worker 不检查配置文件, 由主进程检查后通知 worker, 之后 fork 的 worker 继承主进程的配置
+    s = Server(app, processes=2)
+    s.start_config_watcher()
+    assert s.config_watcher is None
+
+    master = Master(s)
+    master.start_config_watcher()
+    assert master.config_watcher is not None
+    master.check_config()
+    master.workers = {101: time.monotonic()}
+    master.ready = {101}
+    master.config_check_at = time.monotonic()
+    master.config_watcher.mtimes = {}
+    with mock.patch.object(app, 'reload_config') as reload_config, mock.patch('os.kill') as kill:
+        master.check_config()
+    reload_config.assert_called_once_with()
+    kill.assert_called_once_with(101, signal.SIGHUP)
+    assert master.config_check_at > time.monotonic()
+
+
+def test_server_reload(app, log_stream):
+    s = Server(app)
+    with mock.patch.object(app, 'reload_config') as reload_config:
+        s._reload_handler(signal.SIGHUP, None)
+    reload_config.assert_called_once_with()
+    assert not s._stopped and s._draining_at is None
+
+    with mock.patch.object(app, 'reload_config', side_effect=ValueError('bad config')):
+        assert not s.reload()
+    assert 'config reload failed' in log_stream.getvalue()
+
+    # 热加载的 GRPC_LOG_LEVEL 和 GRPC_LOG_FORMAT 立即生效
+    root = logging.getLogger()
+    level, formatter = root.level, s.log_handler.formatter
+    try:
+        with app.update_config() as config:
+            config['GRPC_LOG_LEVEL'] = 'ERROR'
+            config['GRPC_LOG_FORMAT'] = '%(message)s'
+        assert root.level == logging.ERROR
+        assert s.log_handler.formatter._fmt == '%(message)s'
+    finally:
+        root.setLevel(level)
+        s.log_handler.setFormatter(formatter)
+
+
+def test_worker_recycler(app):
+    s = Server(app, processes=2)
+    recycler = WorkerRecycler(s, max_requests=10, jitter=5)
+    assert recycler.enabled and 10 <= recycler.max_requests <= 15
+    assert not WorkerRecycler(s).enabled
+    assert not WorkerRecycler.from_config(s).enabled
+
+    with mock.patch.object(tracker, 'total', tracker.total + 15):
+        assert 'handled 15 requests' in recycler.check()
+    assert recycler.check() is None
+
+    assert current_rss() > 0
+    recycler = WorkerRecycler(s, max_rss=100 << 20)
+    with mock.patch('binwen.recycle.current_rss', return_value=50 << 20):
+        assert recycler.check() is None
+    with mock.patch('binwen.recycle.current_rss', return_value=200 << 20):
+        assert recycler.check() == 'rss 200MB exceeds 100MB'
+
+    # 通知主进程拉起替代者, 替代者 ready 之后主进程发送 SIGTERM, 在这之前继续接收调用
+    r, s.master_fd = os.pipe()
+    try:
+        with mock.patch.object(s, 'drain') as drain:
+            s.recycle()
+        assert s.recycled and not drain.called
+        assert os.read(r, 100) == f'recycle {os.getpid()}\n'.encode()
+    finally:
+        os.close(r)
+        os.close(s.master_fd)
+
+    # 替代者超时没有 ready 时自行停止
+    recycler = WorkerRecycler(s, max_requests=1)
+    recycler.interval = recycler.replace_timeout = 0.01
+    with mock.patch.object(tracker, 'total', tracker.total + 1), \
+            mock.patch.object(s, 'recycle') as recycle, \
+            mock.patch.object(s, 'drain') as drain:
+        recycler.run()
+    recycle.assert_called_once_with()
+    drain.assert_called_once_with()
+
+
+def test_single_process_no_recycle(app, log_stream):
+    with app.update_config() as config:
+        config['GRPC_MAX_REQUESTS'] = 100
+
+    s = Server(app)
+    s.start_recycler()
+    assert s.recycler is None
+    assert 'only take effect with multiple processes' in log_stream.getvalue()
+
+    s = Server(app, processes=2)
+    s.start_recycler()
+    assert s.recycler is not None
+    s.recycler.stop()
+
+
+def test_server_options(app):
+    with app.update_config() as config:
+        config.from_mapping({
+            'GRPC_SERVER_OPTIONS_MAX_RECEIVE_MESSAGE_LENGTH': 32 * 1024 * 1024,
+            'GRPC_SERVER_OPTIONS_KEEPALIVE_TIME_MS': 30000,
+            'GRPC_SERVER_OPTIONS_HTTP2_MAX_PINGS_WITHOUT_DATA': 0,
+            'GRPC_SERVER_OPTIONS_MAXIMUM_CONCURRENT_RPCS': 100,
+            'GRPC_SERVER_OPTIONS_COMPRESSION': 'gzip',
+        })
+
+    kwargs = Server(app, processes=2).make_server_kwargs()
+    assert kwargs['maximum_concurrent_rpcs'] == 100
+    assert kwargs['compression'] is grpc.Compression.Gzip
+    assert dict(kwargs['options']) == {
+        'grpc.max_receive_message_length': 32 * 1024 * 1024,
+        'grpc.keepalive_time_ms': 30000,
+        'grpc.http2.max_pings_without_data': 0,
+        'grpc.so_reuseport': 1,
+    }
+
+    with app.update_config() as config:
+        config['GRPC_SERVER_OPTIONS_COMPRESSION'] = 'brotli'
+    with pytest.raises(ConfigException, match='none, deflate, gzip'):
+        Server(app).make_server_kwargs()
+
+
+def test_server_priority_executor(app, log_stream):
+    with app.update_config() as config:
+        config['GRPC_PRIORITY_ENABLED'] = True
+
+    executor = Server(app).make_executor()
+    assert isinstance(executor, PriorityThreadPoolExecutor)
+    executor.shutdown()
+
+    # asyncio 模式下不支持优先级调度, 记录警告
+    executor = Server(app, aio=True).make_executor()
+    assert isinstance(executor, TimedThreadPoolExecutor)
+    executor.shutdown()
+    assert 'GRPC_PRIORITY_ENABLED is ignored in asyncio mode' in log_stream.getvalue()
+
+
+def test_async_server_rejects_bulkheads():
+    class ReportServicer:
+        def Generate(self, request, context):
+            pass
+
+    Server.check_async_servicers({'ReportServicer': ReportServicer()})
+
+    # grpc.aio 忽略 experimental_thread_pool, 舱壁线程池不会生效
+    ReportServicer.Generate = BulkheadExecutor('aio-test', max_workers=1).bind(ReportServicer.Generate)
+    with pytest.raises(ConfigException, match='ReportServicer.Generate'):
+        Server.check_async_servicers({'ReportServicer': ReportServicer()})
+    ReportServicer.Generate.experimental_thread_pool.shutdown()
+
+
+def test_server_gc(app):
+    with app.update_config() as config:
+        config['GC_THRESHOLD'] = (5000, 20, 20)
+        config['GC_STATS'] = True
+
+    threshold = gc.get_threshold()
+    s = Server(app, gc_freeze=True)
+    assert s.gc_freeze and not Server(app).gc_freeze
+    try:
+        with mock.patch.object(gc_stats, 'install') as install, \
+                mock.patch('binwen.server.freeze_gc', return_value=10) as freeze, \
+                mock.patch.object(Server, 'make_server'):
+            assert s.run()
+        assert gc.get_threshold() == (5000, 20, 20)
+        install.assert_called_once_with()
+        freeze.assert_called_once_with(collect=True)
+    finally:
+        gc.set_threshold(*threshold)
+
+
+def test_gc_stats():
+    stats = GCStats()
+    stats.install()
+    stats.install()
+    assert gc.callbacks.count(stats) == 1
+    try:
+        gc.collect()
+        gc.collect(0)
+    finally:
+        stats.uninstall()
+    assert stats not in gc.callbacks
+
+    snapshot = stats.snapshot()
+    assert snapshot['collections'][0] >= 1 and snapshot['collections'][2] >= 1
+    assert snapshot['pause_max'] >= snapshot['last_pause'] > 0
+    assert sum(snapshot['pause_total']) >= snapshot['pause_max']
+
+    stats.reset()
+    assert stats.snapshot()['collections'] == [0, 0, 0]
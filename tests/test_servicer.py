@@ -1,7 +1,16 @@
+import asyncio
+import inspect
+from unittest import mock
+
 import grpc
+import pytest
 
-from binwen.servicer import ServicerMeta
-from binwen import exceptions
+from binwen.servicer import (
+    ServicerMeta, compile_handler, exempt_middleware, select_middlewares, tracker, wrap_handler
+)
+from binwen.middleware import MiddlewareMixin, GuardMiddleware
+from binwen.test.stub import Context, Stub
+from binwen import exceptions, current_request, current_context, current_metadata
 from binwen.pb2 import default_pb2
 
 
@@ -46,3 +55,242 @@ def test_meta_servicer(app, log_stream):
     assert ret == 'Got it!'
 
     assert log_stream.tell() > p
+
+
+def test_meta_servicer_async(app, log_stream):
+    class HelloServicer(metaclass=ServicerMeta):
+
+        async def return_error(self, request, context):
+            raise exceptions.BadRequestException('error')
+
+        async def return_normal(self, request, context):
+            return 'Got it!'
+
+    servicer = HelloServicer()
+    context = Context()
+    assert inspect.iscoroutinefunction(HelloServicer.return_normal)
+
+    ret = asyncio.run(servicer.return_error(None, context))
+    assert isinstance(ret, default_pb2.Empty)
+    assert context.code is grpc.StatusCode.INVALID_ARGUMENT
+    assert context.details == 'error'
+
+    ret = asyncio.run(servicer.return_normal(None, context))
+    assert ret == 'Got it!'
+    assert 'HelloServicer.return_normal' in log_stream.getvalue()
+
+
+def test_async_handler_unsupported_middleware(app):
+    class SyncOnlyMiddleware(MiddlewareMixin):
+        def __call__(self, servicer, request, context):
+            return self.handler(servicer, request, context)
+
+    async def handler(self, request, context):
+        pass
+
+    with mock.patch.object(app, 'middlewares', (SyncOnlyMiddleware,)):
+        with pytest.raises(exceptions.ConfigException):
+            wrap_handler(handler)
+
+
+def test_async_streaming_handler(app):
+    class StreamServicer(metaclass=ServicerMeta):
+        async def Count(self, request, context):
+            for i in range(int(request)):
+                await asyncio.sleep(0)
+                yield f'{current_request.decode()}-{i}'.encode()
+
+    servicer = StreamServicer()
+    assert inspect.isasyncgenfunction(StreamServicer.Count)
+
+    async def main():
+        server = grpc.aio.server()
+        server.add_generic_rpc_handlers((grpc.method_handlers_generic_handler('test.Stream', {
+            'Count': grpc.unary_stream_rpc_method_handler(servicer.Count),
+        }), ))
+        port = server.add_insecure_port('127.0.0.1:0')
+        await server.start()
+        try:
+            async with grpc.aio.insecure_channel(f'127.0.0.1:{port}') as channel:
+                return [r async for r in channel.unary_stream('/test.Stream/Count')(b'3')]
+        finally:
+            await server.stop(None)
+
+    assert asyncio.run(main()) == [b'3-0', b'3-1', b'3-2']
+    assert not current_request
+
+
+def test_streaming_handler_request_context(app):
+    class StreamServicer(metaclass=ServicerMeta):
+        def Count(self, request, context):
+            for i in range(request):
+                yield current_request._get_current_object(), current_metadata.get('x-user'), i
+
+    stub = Stub(StreamServicer())
+    responses = stub.Count(2, metadata={'x-user': 'a'})
+    assert not current_request
+    assert next(responses) == (2, 'a', 0)
+    # 两次迭代之间 RequestContext 不会遗留在当前线程中
+    assert not current_request
+    assert list(responses) == [(2, 'a', 1)]
+
+    responses = stub.Count(3)
+    next(responses)
+    responses.close()
+    assert not current_request
+
+
+def test_streaming_handler_inflight(app):
+    class StreamServicer(metaclass=ServicerMeta):
+        def Count(self, request, context):
+            yield from range(request)
+
+        async def CountAsync(self, request, context):
+            for i in range(request):
+                yield i
+
+    servicer = StreamServicer()
+    inflight = tracker.inflight
+    responses = Stub(servicer).Count(2)
+    assert next(responses) == 0
+    # 流式调用在迭代结束之前都计入 in-flight
+    assert tracker.inflight == inflight + 1
+    assert list(responses) == [1]
+    assert tracker.inflight == inflight
+
+    async def consume():
+        responses = servicer.CountAsync(2, Context())
+        assert await responses.__anext__() == 0
+        assert tracker.inflight == inflight + 1
+        assert [r async for r in responses] == [1]
+
+    asyncio.run(consume())
+    assert tracker.inflight == inflight
+
+
+class BeforeMiddleware(MiddlewareMixin):
+    def before_handler(self, servicer, request, context):
+        context.append(f'{request}.before')
+        return request + 1, context
+
+
+class AfterMiddleware(MiddlewareMixin):
+    def after_handler(self, servicer, response):
+        return f'{response}.after'
+
+
+def test_compile_handler(app):
+    def handler(servicer, request, context):
+        context.append(f'{request}.handler')
+        return request
+
+    # 只有钩子的中间件合并为一层, 没有重写任何方法的中间件直接跳过
+    h = compile_handler(app, handler, [BeforeMiddleware, MiddlewareMixin, AfterMiddleware, BeforeMiddleware])
+    assert h.__name__ == 'fused'
+    context = []
+    assert h(None, 0, context) == '2.after'
+    assert context == ['0.before', '1.before', '2.handler']
+
+    assert compile_handler(app, handler, [MiddlewareMixin]) is handler
+
+    h = compile_handler(app, handler, [BeforeMiddleware, GuardMiddleware, AfterMiddleware])
+    context = []
+    assert h(None, 0, context) == '1.after'
+    assert context == ['0.before', '1.handler']
+    ctx = mock.MagicMock()
+    h(None, 'x', ctx)
+    ctx.set_code.assert_called_with(grpc.StatusCode.INTERNAL)
+
+
+def test_select_middlewares():
+    class UserServicer:
+        def Get(self, request, context):
+            pass
+
+        def Ping(self, request, context):
+            pass
+
+        @exempt_middleware()
+        def Health(self, request, context):
+            pass
+
+        @exempt_middleware(GuardMiddleware, 'tests.test_servicer.AfterMiddleware')
+        def List(self, request, context):
+            pass
+
+    middlewares = (BeforeMiddleware, AfterMiddleware, GuardMiddleware)
+    scopes = {
+        'tests.test_servicer.BeforeMiddleware': {'include': ['UserServicer.*'], 'exclude': ['*.Ping']},
+        'tests.test_servicer.AfterMiddleware': {'include': ['OrderServicer.*']},
+    }
+    assert select_middlewares(UserServicer.Get, middlewares) == middlewares
+    assert select_middlewares(UserServicer.Get, middlewares, scopes) == (BeforeMiddleware, GuardMiddleware)
+    assert select_middlewares(UserServicer.Ping, middlewares, scopes) == (GuardMiddleware, )
+    assert select_middlewares(UserServicer.Health, middlewares, scopes) == ()
+    assert select_middlewares(UserServicer.List, middlewares) == (BeforeMiddleware, )
+
+
+def test_meta_servicer_deferred_wrap():
+    from binwen import current_app
+    assert not current_app
+
+    class BaseServicer(metaclass=ServicerMeta):
+        def hello(self, request, context):
+            return 'hello'
+
+    class HelloServicer(BaseServicer):
+        def world(self, request, context):
+            return 'world'
+
+    # 定义 servicer 时不需要 app, handler 在第一次实例化时才包装
+    assert HelloServicer.__bwhandlers__ == {'world': HelloServicer.world}
+    assert not HelloServicer.__bwwrapped__
+
+    with mock.patch('binwen.servicer.wrap_handler', side_effect=lambda h: h) as wrapped:
+        servicer = HelloServicer()
+        HelloServicer()
+        assert wrapped.call_count == 2
+
+    assert HelloServicer.__bwwrapped__ and BaseServicer.__bwwrapped__
+    assert servicer.hello(None, None) == 'hello'
+    assert servicer.world(None, None) == 'world'
+
+
+def test_request_context(app):
+    class HelloServicer(metaclass=ServicerMeta):
+
+        def hello(self, request, context):
+            return current_request._get_current_object(), current_context._get_current_object(), current_metadata.get('x-user')
+
+        async def hello_async(self, request, context):
+            await asyncio.sleep(0)
+            return current_request._get_current_object(), current_context._get_current_object(), current_metadata.get('x-user')
+
+    assert not current_request
+
+    servicer = HelloServicer()
+    context = mock.MagicMock()
+    context.invocation_metadata.return_value = (('x-user', 'a'), ('x-user', 'b'), ('x-trace', 't'))
+    assert servicer.hello('req', context) == ('req', context, 'a')
+    assert asyncio.run(servicer.hello_async('req2', context)) == ('req2', context, 'a')
+    assert not current_request
+
+    async def concurrent():
+        contexts = [Context() for _ in range(3)]
+        for i, c in enumerate(contexts):
+            c.initial_metadata({'x-user': i})
+        return await asyncio.gather(*(servicer.hello_async(i, c) for i, c in enumerate(contexts)))
+
+    assert [(r[0], r[2]) for r in asyncio.run(concurrent())] == [(0, 0), (1, 1), (2, 2)]
+
+
+def test_request_context_metadata_parsed_once():
+    from binwen.globals import RequestContext
+
+    context = mock.MagicMock()
+    context.invocation_metadata.return_value = (('k', 'v'), )
+    ctx = RequestContext(None, context)
+    assert not context.invocation_metadata.called
+    assert ctx.metadata == {'k': 'v'}
+    assert ctx.metadata is ctx.metadata
+    assert context.invocation_metadata.call_count == 1
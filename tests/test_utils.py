@@ -1,8 +1,11 @@
+import time
 import pytest
 import logging
+import threading
+from unittest import mock
 from binwen.utils.functional import import_obj, Singleton
-from binwen.utils.cache import cached_property
-from binwen.utils.log import has_level_handler
+from binwen.utils.cache import cached_property, slots_cached_property
+from binwen.utils.log import has_level_handler, enqueue_handlers, stop_listeners, ErrorReporter, ForwardHandler
 
 
 class BA:
@@ -44,6 +47,69 @@ def test_cached_property():
     assert ins.cached_count == 0
     ins.count = 10
     assert ins.cached_count == 0
+    assert ins.__dict__['cached_count'] == 0
+
+
+def test_cached_property_concurrent():
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    class ForTest:
+        def __init__(self, block):
+            self.block = block
+
+        @cached_property
+        def value(self):
+            calls.append(self)
+            n = len(calls)
+            if self.block:
+                started.set()
+                release.wait(5)
+            return n
+
+    slow, fast = ForTest(True), ForTest(False)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(slow.value)) for _ in range(3)]
+    for t in threads:
+        t.start()
+    assert started.wait(5)
+    # 另一个实例的计算不会被正在计算的实例阻塞
+    assert fast.value == 2
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert results == [1, 1, 1]
+    assert calls == [slow, fast]
+
+
+def test_slots_cached_property():
+    class Point:
+        __slots__ = ('x', '_norm')
+
+        def __init__(self, x):
+            self.x = x
+
+        @slots_cached_property
+        def norm(self):
+            return abs(self.x)
+
+    p = Point(-3)
+    assert isinstance(Point.norm, slots_cached_property)
+    assert p.norm == 3
+    p.x = 5
+    assert p.norm == 3
+    del p.norm
+    assert p.norm == 5
+
+    with pytest.raises(Exception):
+        class Broken:
+            __slots__ = ('x', )
+
+            @slots_cached_property
+            def norm(self):
+                return self.x
 
 
 def test_singleton():
@@ -90,3 +156,171 @@ def test_has_level_handler():
     h3.setLevel(logging.DEBUG)
     l3.addHandler(h3)
     assert has_level_handler(l3)
+
+
+def test_enqueue_handlers():
+    threads = []
+
+    class Capture(logging.Handler):
+        def emit(self, record):
+            threads.append((threading.current_thread(), self.format(record)))
+
+    logger = logging.getLogger('testapp.queued')
+    logger.setLevel(logging.INFO)
+    assert enqueue_handlers(logger, Capture(), propagate=False) is logger
+    assert enqueue_handlers(logger) is logger
+    assert len(logger.handlers) == 1
+    assert not logger.propagate
+
+    # 默认不修改 propagate
+    propagating = logging.getLogger('testapp.queued.propagating')
+    enqueue_handlers(propagating, Capture())
+    assert propagating.propagate
+
+    logger.info('hello %s', 'world')
+    stop_listeners()
+    assert threads[0][0] is not threading.current_thread()
+    assert threads[0][1] == 'hello world'
+
+
+def test_forward_handler_resolves_parent():
+    records = []
+
+    class Capture(logging.Handler):
+        def emit(self, record):
+            records.append(record.getMessage())
+
+    # 创建 ForwardHandler 时还没有 testapp.forward, 上级 logger 是 root; 之后创建的 testapp.forward 同样收到
+    child = logging.getLogger('testapp.forward.child')
+    child.propagate = False
+    child.addHandler(ForwardHandler(child, parent=True))
+    parent = logging.getLogger('testapp.forward')
+    parent.propagate = False
+    parent.addHandler(Capture())
+    child.error('forwarded')
+    assert records == ['forwarded']
+
+
+def test_error_reporter():
+    records = []
+
+    class Capture(logging.Handler):
+        def emit(self, record):
+            records.append((record, self.format(record)))
+
+    logger = logging.getLogger('testapp.reporter')
+    logger.setLevel(logging.ERROR)
+    logger.addHandler(Capture())
+    reporter = ErrorReporter(logger, interval=60)
+
+    def fail(i):
+        raise ValueError(i)
+
+    for i in range(3):
+        try:
+            fail(i)
+        except ValueError as e:
+            assert reporter.report(e) is (i == 0)
+    try:
+        raise KeyError('other')
+    except KeyError as e:
+        assert reporter.report(e)
+
+    # 间隔时间到了之后输出这段时间内出现的次数
+    reporter.interval = 0
+    try:
+        fail(3)
+    except ValueError as e:
+        assert reporter.report(e)
+
+    stop_listeners()
+    assert len(records) == 3
+    assert records[0][0].name == 'testapp.reporter.errors'
+    assert 'Traceback' in records[0][1] and 'in fail' in records[0][1]
+    assert "KeyError: 'other'" in records[1][1]
+    assert 'ValueError at' in records[2][1] and 'occurred 3 times' in records[2][1]
+    assert 'Traceback' not in records[2][1]
+
+
+def test_error_reporter_flush():
+    records = []
+
+    class Capture(logging.Handler):
+        def emit(self, record):
+            records.append(record.getMessage())
+
+    logger = logging.getLogger('testapp.reporter_flush')
+    logger.setLevel(logging.ERROR)
+    logger.addHandler(Capture())
+    reporter = ErrorReporter(logger, interval=60)
+
+    def fail(i):
+        raise ValueError(i)
+
+    for i in range(3):
+        try:
+            fail(i)
+        except ValueError as e:
+            reporter.report(e)
+
+    # 异常不再出现: interval 没有到期时不输出, 到期后由后台线程输出剩余的次数
+    assert reporter.flush() == 0
+    with mock.patch.object(ErrorReporter, 'flush_interval', 0.01):
+        reporter.interval = 0.05
+        deadline = time.monotonic() + 5
+        while not any('occurred' in r for r in records) and time.monotonic() < deadline:
+            time.sleep(0.01)
+    assert reporter.flush() == 0
+    stop_listeners()
+    assert len(records) == 2
+    assert 'occurred 2 times' in records[1] and 'last: 2' in records[1]
+
+    # 进程退出时输出还没有到期的次数
+    logger = logging.getLogger('testapp.reporter_exit')
+    logger.setLevel(logging.ERROR)
+    logger.addHandler(Capture())
+    reporter = ErrorReporter(logger, interval=60)
+    for i in range(3):
+        try:
+            fail(i)
+        except ValueError as e:
+            reporter.report(e)
+    stop_listeners()
+    assert 'occurred 2 times' in records[-1]
+
+
+def test_error_reporter_max_keys():
+    records = []
+
+    class Capture(logging.Handler):
+        def emit(self, record):
+            records.append(record.getMessage())
+
+    logger = logging.getLogger('testapp.reporter_max_keys')
+    logger.setLevel(logging.ERROR)
+    logger.addHandler(Capture())
+    reporter = ErrorReporter(logger, interval=60)
+    reporter.max_keys = 2
+
+    def fail(i):
+        raise ValueError(i)
+
+    def other(i):
+        raise KeyError(i)
+
+    for f in (fail, fail, other):
+        try:
+            f(1)
+        except Exception as e:
+            reporter.report(e)
+    # 只保存最后一次异常的 args, 不引用异常对象和它的 traceback, 也不在调用线程中转换为文本
+    assert [entry[2] for entry in reporter._seen.values()] == [(1, ), None]
+
+    # 超过 max_keys 清空统计之前输出剩余的次数
+    try:
+        raise TypeError('third')
+    except TypeError as e:
+        reporter.report(e)
+    assert len(reporter._seen) == 1
+    stop_listeners()
+    assert any('ValueError at' in r and 'occurred 1 times' in r and 'last: 1' in r for r in records)